@@ -0,0 +1,109 @@
+# бенчмарк декодирования фото: полное cv2.imread против уменьшенного декодирования с предзагрузкой
+# и повторное декодирование для мелких лиц: оригинал целиком против уменьшения по самому мелкому лицу
+import os
+import sys
+import json
+import time
+import argparse
+import resource
+import subprocess
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'ml_worker'))
+
+PHOTO_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.gif', '.bmp', '.webp')
+MODES = ("full", "reduced", "reduced_prefetch", "small_faces_full", "small_faces_detail")
+SMALL_FACE = 64     # сторона мелкого лица в уменьшенном фото, пикселей (в режимах small_faces_*)
+
+
+def peak_rss_mb():
+    # ru_maxrss в Linux — в килобайтах
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def run_mode(mode, paths, small_face=SMALL_FACE):
+    """
+    Декодирует все фото в одном режиме и возвращает время и пиковый RSS текущего процесса.
+    small_faces_* — как в детекторе при лице размером small_face в уменьшенном фото: после детекции
+    фото декодируется ещё раз, целиком (full) или в уменьшении по этому лицу (detail).
+    """
+    import cv2
+    from decode import decode_image, detail_reduction, ImagePrefetcher
+    from detector import REC_MIN_FACE_SIZE
+
+    pixels = 0
+    started = time.perf_counter()
+
+    if mode == "full":
+        for path in paths:
+            img = cv2.imread(path)
+            if img is not None:
+                pixels += img.shape[0] * img.shape[1]
+    elif mode == "reduced":
+        for path in paths:
+            decoded = decode_image(path)
+            if decoded is not None:
+                pixels += decoded.image.shape[0] * decoded.image.shape[1]
+    elif mode == "reduced_prefetch":
+        for _, decoded in ImagePrefetcher(paths):
+            if decoded is not None:
+                pixels += decoded.image.shape[0] * decoded.image.shape[1]
+    else:
+        for path in paths:
+            decoded = decode_image(path)
+            if decoded is None:
+                continue
+            pixels += decoded.image.shape[0] * decoded.image.shape[1]
+            if decoded.scale == 1:
+                continue
+            if mode == "small_faces_full":
+                detail = decoded.full()
+            else:
+                detail = decoded.reduced(detail_reduction(decoded.scale, small_face, REC_MIN_FACE_SIZE))
+            if detail is not None:
+                pixels += detail.shape[0] * detail.shape[1]
+            del decoded, detail
+
+    elapsed = time.perf_counter() - started
+    return {
+        "mode": mode,
+        "images": len(paths),
+        "total_s": round(elapsed, 3),
+        "per_image_ms": round(1000 * elapsed / max(1, len(paths)), 2),
+        "decoded_mpix": round(pixels / 1e6, 1),
+        "peak_rss_mb": round(peak_rss_mb(), 1),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Бенчмарк декодирования фото для детекции")
+    parser.add_argument("input_dir", nargs="?", default="data/photos/raw_uploads")
+    parser.add_argument("--limit", type=int, default=200, help="сколько фото взять из папки")
+    parser.add_argument("--small-face", type=int, default=SMALL_FACE,
+                        help="сторона мелкого лица в уменьшенном фото для режимов small_faces_*")
+    parser.add_argument("--mode", choices=MODES, help="(внутреннее) выполнить один режим в этом процессе")
+    args = parser.parse_args()
+
+    paths = sorted(
+        os.path.join(args.input_dir, f) for f in os.listdir(args.input_dir)
+        if f.lower().endswith(PHOTO_EXTENSIONS)
+    )[:args.limit]
+
+    if args.mode:
+        print(json.dumps(run_mode(args.mode, paths, args.small_face)))
+        return
+
+    # каждый режим — в отдельном процессе, чтобы пиковый RSS не смешивался
+    results = []
+    for mode in MODES:
+        out = subprocess.run(
+            [sys.executable, os.path.abspath(__file__), args.input_dir, "--limit", str(args.limit),
+             "--small-face", str(args.small_face), "--mode", mode],
+            check=True, capture_output=True, text=True,
+        ).stdout
+        results.append(json.loads(out.strip().splitlines()[-1]))
+
+    print(json.dumps({"benchmark": "decode", "results": results}, indent=2))
+
+
+if __name__ == "__main__":
+    main()
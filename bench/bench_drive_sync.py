@@ -0,0 +1,64 @@
+# бенчмарк синхронизации с Google Drive на заглушке API: первая синхронизация, повторная и после изменений
+import os
+import sys
+import json
+import argparse
+import tempfile
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'scr'))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import load_photos
+from fake_drive_api import FakeDriveAPI
+
+
+def run(args, work_dir):
+    api = FakeDriveAPI(fail_every=args.fail_every, latency=args.latency).start()
+    root = api.add_folder("root")
+    file_ids = []
+    for f in range(args.folders):
+        folder = api.add_folder(f"folder_{f}", root)
+        for i in range(args.photos):
+            # -- одинаковые имена в разных папках: локальные файлы не должны перезаписывать друг друга
+            file_ids.append(api.add_file(f"IMG_{i:04d}.jpg", os.urandom(args.size_kb * 1024), folder))
+
+    # -- заглушке не нужна авторизация, клиенты потоков создаются заново с её адресом
+    load_photos.DRIVE_API_URL = api.base_url
+    load_photos.SERVICE_ACCOUNT_FILE = None
+    local_path = os.path.join(work_dir, "raw_uploads")
+    manifest_path = os.path.join(work_dir, "drive_manifest.sqlite")
+
+    results = []
+    try:
+        for name in ("first_sync", "repeat_sync", "changed_sync"):
+            if name == "changed_sync":
+                for file_id in file_ids[:args.changed]:
+                    api.update_file(file_id, os.urandom(args.size_kb * 1024))
+            before = dict(api.stats)
+            stats = load_photos.sync_folder(root, local_path, manifest_path, download_threads=args.threads)
+            results.append({"pass": name, **stats, **{k: api.stats[k] - before[k] for k in api.stats}})
+        results.append({"pass": "local_files", "count": len(os.listdir(local_path))})
+    finally:
+        api.stop()
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Бенчмарк синхронизации фото с Google Drive (заглушка API)")
+    parser.add_argument("--folders", type=int, default=4)
+    parser.add_argument("--photos", type=int, default=50, help="фото в каждой папке")
+    parser.add_argument("--size-kb", type=int, default=256)
+    parser.add_argument("--threads", type=int, default=load_photos.DOWNLOAD_THREADS)
+    parser.add_argument("--changed", type=int, default=10, help="сколько файлов изменить перед третьим проходом")
+    parser.add_argument("--latency", type=float, default=0.02, help="задержка ответа заглушки, с")
+    parser.add_argument("--fail-every", type=int, default=0, help="каждый N-й запрос содержимого получает 503")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as work_dir:
+        results = run(args, work_dir)
+    print(json.dumps({"benchmark": "drive_sync", "files": args.folders * args.photos, "size_kb": args.size_kb,
+                      "threads": args.threads, "results": results}, indent=2))
+
+
+if __name__ == "__main__":
+    main()
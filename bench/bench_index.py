@@ -0,0 +1,114 @@
+# бенчмарк поисковых индексов: recall@1 и сходство относительно точного Flat (доля прошедших порог), задержка и память
+import os
+import sys
+import json
+import time
+import argparse
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'ml_worker'))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import faiss
+from index_factory import DEFAULT_INDEX_CONFIG, BACKENDS, build_index, centroid_arrays, search_centroids
+from synthetic import make_identities, sample_faces
+from update import THRESHOLD
+
+
+def load_vectors(args):
+    """Центроиды из реальной базы (--from-index) или синтетические личности."""
+    if args.from_index:
+        from embedder import load_cluster_index
+        from metadata_store import open_metadata_store
+        meta_store = open_metadata_store(os.path.dirname(args.from_index), readonly=True)
+        ids, vectors = centroid_arrays(load_cluster_index(args.from_index, meta_store))
+        return ids, vectors
+    vectors = make_identities(args.n, seed=args.seed)
+    return np.arange(1, args.n + 1, dtype=np.int64), vectors
+
+
+def percentile_ms(latencies, q):
+    return round(1000 * float(np.percentile(latencies, q)), 3)
+
+
+def bench_backend(backend, ids, vectors, queries, gt, gt_sims, centroids, args):
+    """
+    Замеры одного типа индекса. Сходство берётся так же, как у воркера и бота (search_centroids: для IVF-PQ —
+    пересчёт по точным центроидам; --no-rerank — сырое сходство индекса) и сравнивается с точным Flat.
+    """
+    config = dict(DEFAULT_INDEX_CONFIG, backend=backend)
+    if args.nprobe:
+        config["nprobe"] = args.nprobe
+    if args.ef_search:
+        config["ef_search"] = args.ef_search
+
+    started = time.perf_counter()
+    index = build_index(config, ids, vectors)
+    build_s = time.perf_counter() - started
+    centroids = None if args.no_rerank else centroids
+
+    # задержка одиночного запроса (как у бота)
+    latencies = []
+    predicted = np.empty(len(queries), dtype=np.int64)
+    predicted_sims = np.empty(len(queries), dtype=np.float32)
+    for i, q in enumerate(queries):
+        t0 = time.perf_counter()
+        sims, found = search_centroids(index, centroids, q[np.newaxis, :], 1)
+        latencies.append(time.perf_counter() - t0)
+        predicted[i], predicted_sims[i] = found[0, 0], sims[0, 0]
+
+    # пропускная способность пакетного поиска (как у воркера)
+    t0 = time.perf_counter()
+    search_centroids(index, centroids, queries, 1)
+    batch_s = time.perf_counter() - t0
+
+    error = predicted_sims - gt_sims
+
+    return {
+        "backend": backend,
+        "params": {k: config[k] for k in ("hnsw_m", "ef_search", "nlist", "nprobe", "pq_m", "pq_nbits")},
+        "build_s": round(build_s, 3),
+        "recall_at_1": round(float(np.mean(predicted == gt)), 4),
+        # -- порог сравнивается со сходством индекса: доля запросов выше порога должна совпадать с Flat
+        "threshold_pass_rate": round(float(np.mean(predicted_sims >= THRESHOLD)), 4),
+        "threshold_agreement": round(float(np.mean((predicted_sims >= THRESHOLD) == (gt_sims >= THRESHOLD))), 4),
+        "similarity_error_mean": round(float(np.mean(error)), 4),
+        "similarity_error_max_abs": round(float(np.max(np.abs(error))), 4),
+        "latency_p50_ms": percentile_ms(latencies, 50),
+        "latency_p99_ms": percentile_ms(latencies, 99),
+        "batch_qps": round(len(queries) / batch_s, 1),
+        "memory_mb": round(len(faiss.serialize_index(index)) / 2 ** 20, 2),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Бенчмарк поисковых индексов FAISS")
+    parser.add_argument("--n", type=int, default=100_000, help="число кластеров в синтетической базе")
+    parser.add_argument("--queries", type=int, default=1000)
+    parser.add_argument("--backends", default=",".join(BACKENDS))
+    parser.add_argument("--from-index", help="путь к faiss_index.idx реальной базы вместо синтетики")
+    parser.add_argument("--nprobe", type=int)
+    parser.add_argument("--ef-search", type=int)
+    parser.add_argument("--noise", type=float, default=0.028,
+                        help="шум запросов вокруг центров (0.028 — косинус ≈ 0.85, 0.045 — косинус ≈ 0.7)")
+    parser.add_argument("--no-rerank", action="store_true", help="сырое сходство IVF-PQ без пересчёта по центроидам")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    ids, vectors = load_vectors(args)
+    queries, _ = sample_faces(vectors, args.queries, noise=args.noise, seed=args.seed + 1)
+
+    # эталон — точный поиск по Flat; он же — индекс центроидов для пересчёта сходства IVF-PQ
+    centroids = faiss.IndexIDMap2(faiss.IndexFlatIP(vectors.shape[1]))
+    centroids.add_with_ids(vectors, ids)
+    gt_sims, gt = centroids.search(queries, 1)
+    gt_sims, gt = gt_sims[:, 0], gt[:, 0]
+
+    results = [bench_backend(b, ids, vectors, queries, gt, gt_sims, centroids, args) for b in args.backends.split(",")]
+    print(json.dumps({"benchmark": "index", "vectors": len(ids), "queries": len(queries), "threshold": THRESHOLD,
+                      "flat_threshold_pass_rate": round(float(np.mean(gt_sims >= THRESHOLD)), 4),
+                      "results": results}, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,303 @@
+# бенчмарк горячих путей без файлов моделей и фото: кластеризация, сохранение и обновление базы, поиск, папки пользователей
+import os
+import sys
+import json
+import time
+import logging
+import argparse
+import platform
+import shutil
+import tempfile
+import subprocess
+import cv2
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'ml_worker'))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from synthetic import normalize, sample_event
+from quality import REJECT_REASONS
+from bench_startup import measure_imports
+
+
+# задержки моделей buffalo_l на одном ядре CPU, мс: детекция на 640×640, landmark_3d_68 и распознавание — на лицо
+MODEL_LATENCY_MS = {"detection": 40.0, "landmark_3d_68": 8.0, "recognition": 30.0}
+# опорные точки ArcFace для лица 112×112 (insightface.utils.face_align.arcface_dst)
+ARCFACE_KPS = np.array([[38.2946, 51.6963], [73.5318, 51.5014], [56.0252, 71.7366],
+                        [41.5493, 92.3655], [70.7299, 92.2041]], dtype=np.float32)
+
+
+class StubDetection:
+    """RetinaFace без сети: задержка и одно лицо в центре кадра (треть короткой стороны)."""
+    taskname = "detection"
+
+    def __init__(self, latency):
+        self.latency = latency
+
+    def prepare(self, ctx_id, **kwargs):
+        pass
+
+    def detect(self, img, max_num=0, metric="default"):
+        time.sleep(self.latency)
+        height, width = img.shape[:2]
+        side = min(height, width) / 3
+        x1, y1 = (width - side) / 2, (height - side) / 2
+        bboxes = np.array([[x1, y1, x1 + side, y1 + side, 0.9]], dtype=np.float32)
+        return bboxes, (ARCFACE_KPS * side / 112 + [x1, y1])[None].astype(np.float32)
+
+
+class StubLandmark:
+    """landmark_3d_68 без сети: задержка на лицо и фронтальная поза (фильтр качества её проверяет)."""
+    taskname = "landmark_3d_68"
+
+    def __init__(self, latency):
+        self.latency = latency
+
+    def prepare(self, ctx_id, **kwargs):
+        pass
+
+    def get(self, img, face):
+        time.sleep(self.latency)
+        face.landmark_3d_68 = np.zeros((68, 3), dtype=np.float32)
+        face.pose = np.zeros(3, dtype=np.float32)
+        return face.landmark_3d_68
+
+
+class StubRecognition:
+    """
+    ArcFace без сети: задержка на каждое лицо батча, эмбеддинги — по очереди из embeddings
+    (бенчмарк кладёт туда эмбеддинг лица перед каждым запросом).
+    """
+    taskname = "recognition"
+    input_size = (112, 112)
+
+    def __init__(self, latency):
+        self.latency = latency
+        self.embeddings = []
+
+    def prepare(self, ctx_id, **kwargs):
+        pass
+
+    def get_feat(self, imgs):
+        time.sleep(self.latency * len(imgs))
+        feats = [self.embeddings.pop(0) for _ in imgs]
+        return np.stack(feats)
+
+
+def stub_models(allowed_modules, providers=None, intra_op_threads=None, **kwargs):
+    """
+    Заменяет detector.load_models: FaceDetector остаётся настоящим (декодирование, фильтр качества,
+    выравнивание и батч распознавания замеряются), а вместо сессий ONNX Runtime — заглушки с задержкой MODEL_LATENCY_MS.
+    """
+    stubs = (StubDetection, StubLandmark, StubRecognition)
+    return {stub.taskname: stub(MODEL_LATENCY_MS[stub.taskname] / 1000)
+            for stub in stubs if stub.taskname in allowed_modules}
+
+
+def query_photo(path, seed=0, size=(1280, 960)):
+    """Фото запроса как из Telegram (длинная сторона 1280): текстура, чтобы выровненное лицо прошло проверку резкости."""
+    noise = np.random.default_rng(seed).integers(0, 256, size=(size[1], size[0], 3), dtype=np.uint8)
+    cv2.imwrite(path, cv2.GaussianBlur(noise, (3, 3), 0))
+
+
+# -- модели insightface подменяются до создания FaceDetector (файлы моделей не нужны)
+import detector
+detector.load_models = stub_models
+
+import faiss
+import search
+import update
+from embedder import FaceEmbeddingDatabaseFAISS
+from metadata_store import open_metadata_store
+from albums import RAW_DIR, USERS_DIR, sync_user_folders
+
+DEFAULT_SIZES = "10000,100000"    # 1000000 — по флагу --sizes (нужно около 8 ГБ памяти)
+
+
+def percentile_ms(latencies, q):
+    return round(1000 * float(np.percentile(latencies, q)), 3)
+
+
+def timed(fn, *args, **kwargs):
+    started = time.perf_counter()
+    result = fn(*args, **kwargs)
+    return result, round(time.perf_counter() - started, 3)
+
+
+def cluster_purity(face_user_ids, labels):
+    """Доля лиц, совпадающих по человеку с большинством своего кластера (1.0 — кластеры не смешивают людей)."""
+    pairs, counts = np.unique(np.stack([np.asarray(face_user_ids), labels], axis=1), axis=0, return_counts=True)
+    best = np.zeros(int(pairs[:, 0].max()) + 1, dtype=np.int64)
+    np.maximum.at(best, pairs[:, 0], counts)
+    return round(float(best.sum()) / len(labels), 4)
+
+
+def face_infos(embs, photo_ids, raw_dir):
+    return [{"embedding": emb, "photo_id": photo_id, "path": os.path.join(raw_dir, f"{photo_id}.jpg"),
+             "bbox": [0.0, 0.0, 100.0, 100.0], "pose": (0.0, 0.0, 0.0), "det_score": 0.9}
+            for emb, photo_id in zip(embs, photo_ids)]
+
+
+def bench_size(n_faces, args):
+    """Все замеры для одного размера базы; рабочая папка — текущая (временная)."""
+    faces, labels, photo_ids = sample_event(n_faces, seed=args.seed)
+    n_update = min(args.update_faces, n_faces // 10)
+    n_base = n_faces - n_update - args.warmup_faces
+    result = {"faces": n_faces, "identities": int(labels.max()) + 1, "photos": len(set(photo_ids))}
+
+    # -- исходные фото — пустые файлы: альбомы и папки пользователей работают только с путями
+    os.makedirs(RAW_DIR, exist_ok=True)
+    if not args.no_folders:
+        for photo_id in dict.fromkeys(photo_ids):
+            open(os.path.join(RAW_DIR, f"{photo_id}.jpg"), "wb").close()
+
+    # -- 1. кластеризация и сохранение базы (как --recluster)
+    db = FaceEmbeddingDatabaseFAISS()
+    db.index.add(faces[:n_base])
+    db.meta = [{"photo_id": p, "bbox": [0.0, 0.0, 100.0, 100.0], "pose": (0.0, 0.0, 0.0), "det_score": 0.9}
+               for p in photo_ids[:n_base]]
+    (_, clusters), result["cluster_embeddings_s"] = timed(db.cluster_embeddings)
+    result["clusters"] = len(clusters)
+    result["cluster_purity"] = cluster_purity(db.face_user_ids, labels[:n_base])
+    _, result["save_database_s"] = timed(db.save_database, update.SAVE_DIR)
+    meta_store = open_metadata_store(update.SAVE_DIR)
+    with meta_store.transaction():
+        meta_store.set_photo_paths({p: os.path.join(RAW_DIR, f"{p}.jpg") for p in photo_ids[:n_base]})
+    del db
+
+    # -- 2. update_db на тёплой базе: первый вызов строит поисковый индекс и снимок, замеряется второй
+    warmup = slice(n_base, n_base + args.warmup_faces)
+    update.update_db(face_infos(faces[warmup], photo_ids[warmup], RAW_DIR))
+    batch = face_infos(faces[n_base + args.warmup_faces:], photo_ids[n_base + args.warmup_faces:], RAW_DIR)
+    changed, result["update_db_s"] = timed(update.update_db, batch)
+    result["update_db_faces"] = len(batch)
+    result["update_db_changed_users"] = len(changed)
+
+    # -- 3. папки пользователей (замена save_user_photos): все пользователи и только изменённые
+    if not args.no_folders:
+        all_users = [int(c["user_id"]) for c in meta_store.all()]
+        _, result["user_folders_all_s"] = timed(sync_user_folders, meta_store, all_users, USERS_DIR, RAW_DIR)
+        _, result["user_folders_changed_s"] = timed(sync_user_folders, meta_store, changed, USERS_DIR, RAW_DIR)
+    meta_store.close()
+
+    # -- 4. vectorize_face: путь запроса бота (настоящий FaceDetector, модели — заглушки с задержкой)
+    rng = np.random.default_rng(args.seed + 1)
+    query_faces = normalize(faces[rng.integers(0, n_faces, size=args.queries)]
+                            + 0.028 * rng.standard_normal((args.queries, faces.shape[1]), dtype=np.float32))
+    search._default_engine = None
+    engine = search.get_engine()
+    recognition = engine.detector.models["recognition"]
+    recognition.embeddings = [query_faces[0]]
+    engine.warm_up()                    # как бот перед приёмом запросов: первый вызов не попадает в p99
+    os.makedirs(search.TEMPORARY_DIR, exist_ok=True)
+    template = os.path.join(search.TEMPORARY_DIR, "template.jpg")
+    query_photo(template, args.seed)
+
+    latencies, matched = [], 0
+    for i in range(args.queries):
+        path = os.path.join(search.TEMPORARY_DIR, f"query_{i}.jpg")
+        shutil.copyfile(template, path)      # vectorize_face удаляет фото запроса
+        recognition.embeddings = [query_faces[i]]
+        started = time.perf_counter()
+        found = search.vectorize_face(path)
+        latencies.append(time.perf_counter() - started)
+        matched += found is not None
+    result["search"] = {
+        "queries": args.queries,
+        "model_latency_ms": dict(MODEL_LATENCY_MS),
+        "faces_rejected": sum(engine.detector.quality.pop_stats()[r] for r in REJECT_REASONS),
+        "p50_ms": percentile_ms(latencies, 50),
+        "p99_ms": percentile_ms(latencies, 99),
+        "match_rate": round(matched / args.queries, 4),
+    }
+    engine.close()
+    search._default_engine = None
+    return result
+
+
+def _flatten(result, prefix=""):
+    """Числовые метрики времени (…_s, …_ms) одного размера: {"search.p50_ms": 1.2, ...}."""
+    flat = {}
+    for key, value in result.items():
+        if isinstance(value, dict):
+            flat.update(_flatten(value, f"{prefix}{key}."))
+        elif key.endswith(("_s", "_ms")):
+            flat[prefix + key] = value
+    return flat
+
+
+def compare(report, baseline, tolerance):
+    """Метрики, выросшие относительно baseline больше чем на tolerance (доля); время старта — как отдельный размер."""
+    previous = {r["faces"]: _flatten(r) for r in baseline.get("results", [])}
+    previous["startup"] = _flatten(baseline.get("startup", {}))
+    current = [(r["faces"], _flatten(r)) for r in report["results"]] + [("startup", _flatten(report["startup"]))]
+    regressions = []
+    for faces, flat in current:
+        old = previous.get(faces)
+        if old is None:
+            continue
+        for key, value in flat.items():
+            if key in old and old[key] > 0 and value > old[key] * (1 + tolerance):
+                regressions.append({"faces": faces, "metric": key, "baseline": old[key], "current": value,
+                                    "ratio": round(value / old[key], 2)})
+    return regressions
+
+
+def environment():
+    try:
+        commit = subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                                cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() or None
+    except OSError:
+        commit = None
+    return {"commit": commit, "python": platform.python_version(), "faiss": faiss.__version__,
+            "cpus": os.cpu_count(), "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S")}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Бенчмарк кластеризации, обновления базы и поиска без моделей")
+    parser.add_argument("--sizes", default=DEFAULT_SIZES, help="число лиц через запятую (например, 10000,100000,1000000)")
+    parser.add_argument("--update-faces", type=int, default=1000, help="лиц в замеряемом update_db")
+    parser.add_argument("--warmup-faces", type=int, default=10)
+    parser.add_argument("--queries", type=int, default=300)
+    for taskname, latency in MODEL_LATENCY_MS.items():
+        parser.add_argument(f"--{taskname.replace('_', '-')}-latency-ms", type=float, default=latency,
+                            help=f"задержка заглушки модели {taskname}, мс" + ("" if taskname == "detection" else " на лицо"))
+    parser.add_argument("--no-folders", action="store_true", help="не замерять папки пользователей (экономит диск)")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--startup-runs", type=int, default=3, help="запусков замера импорта в новом процессе (медиана)")
+    parser.add_argument("--output", help="куда записать JSON (по умолчанию — только stdout)")
+    parser.add_argument("--baseline", help="JSON прошлого запуска: метрики, выросшие больше --tolerance, попадут в regressions")
+    parser.add_argument("--tolerance", type=float, default=0.2)
+    args = parser.parse_args()
+    for taskname in MODEL_LATENCY_MS:
+        MODEL_LATENCY_MS[taskname] = getattr(args, f"{taskname}_latency_ms")
+
+    logging.disable(logging.INFO)       # логи модулей не мешают JSON
+    cwd = os.getcwd()
+    results = []
+    for n_faces in (int(s) for s in args.sizes.split(",")):
+        with tempfile.TemporaryDirectory() as work_dir:
+            os.chdir(work_dir)      # update_db и SearchEngine работают с относительными путями data/...
+            try:
+                results.append(bench_size(n_faces, args))
+            finally:
+                os.chdir(cwd)
+
+    # -- холодный старт без моделей: импорт бота и поиска в новом процессе (с моделями — bench_startup.py)
+    report = {"benchmark": "pipeline", "environment": environment(),
+              "startup": measure_imports(args.startup_runs), "results": results}
+    if args.baseline:
+        with open(args.baseline, "r", encoding="utf-8") as f:
+            report["regressions"] = compare(report, json.load(f), args.tolerance)
+
+    payload = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            f.write(payload + "\n")
+    print(payload)
+    if report.get("regressions"):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
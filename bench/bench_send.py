@@ -0,0 +1,64 @@
+# бенчмарк отправки альбома: первая отправка (загрузка файлов) против повторной (по file_id) на заглушке Bot API
+import os
+import sys
+import json
+import time
+import asyncio
+import argparse
+import tempfile
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'bot'))
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'ml_worker'))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from telegram import Bot
+from photo_sender import FileIdCache, PhotoSender
+from fake_bot_api import FakeBotAPI
+
+
+async def run(args, work_dir):
+    paths = []
+    for i in range(args.photos):
+        path = os.path.join(work_dir, f"photo_{i:04d}.jpg")
+        with open(path, "wb") as f:
+            f.write(os.urandom(args.size_kb * 1024))
+        paths.append(path)
+
+    api = FakeBotAPI(flood_every=args.flood_every).start()
+    cache = FileIdCache(os.path.join(work_dir, "file_ids.sqlite"))
+    sender = PhotoSender(cache, rate=args.rate)
+    results = []
+    try:
+        async with Bot("123:fake", base_url=api.base_url) as bot:
+            for name in ("first_send", "repeat_send"):
+                before = dict(api.stats)
+                started = time.perf_counter()
+                delivered = await sender.send_album(bot, 1, paths)
+                results.append({
+                    "pass": name,
+                    "delivered": delivered,
+                    "total_s": round(time.perf_counter() - started, 3),
+                    **{k: api.stats[k] - before[k] for k in api.stats},
+                })
+    finally:
+        cache.close()
+        api.stop()
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Бенчмарк отправки фото пользователю (заглушка Bot API)")
+    parser.add_argument("--photos", type=int, default=200)
+    parser.add_argument("--size-kb", type=int, default=256)
+    parser.add_argument("--rate", type=float, default=1000.0, help="сообщений в секунду для TokenBucket")
+    parser.add_argument("--flood-every", type=int, default=0, help="каждый N-й запрос получает 429")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as work_dir:
+        results = asyncio.run(run(args, work_dir))
+    print(json.dumps({"benchmark": "send", "photos": args.photos, "size_kb": args.size_kb, "results": results}, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,126 @@
+# бенчмарк холодного старта: импорты, загрузка моделей с кэшем оптимизированных графов и без него, прогрев
+import os
+import sys
+import json
+import argparse
+import tempfile
+import statistics
+import subprocess
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+ML_WORKER_DIR = os.path.join(ROOT, 'ml_worker')
+BOT_DIR = os.path.join(ROOT, 'bot')
+
+# импорт до первого обращения к моделям: бот должен отвечать на проверку живости почти сразу
+IMPORT_CASES = {
+    "bot_import_s": (BOT_DIR, "import main"),
+    "search_import_s": (ML_WORKER_DIR, "import search"),
+}
+
+# каждый замер — в новом процессе: кэши модулей, ONNX Runtime и страницы файлов не переходят между запусками
+_IMPORT_CODE = """
+import sys, time, json
+sys.path.insert(0, {path!r})
+started = time.perf_counter()
+{statement}
+print(json.dumps({{"s": time.perf_counter() - started}}))
+"""
+
+_ENGINE_CODE = """
+import os, sys, time, json
+started = time.perf_counter()
+sys.path.insert(0, {path!r})
+import numpy as np
+from search import SearchEngine
+imported = time.perf_counter()
+engine = SearchEngine()
+loaded = time.perf_counter()
+timings = engine.warm_up() if {warm_up!r} else {{}}
+ready = time.perf_counter()
+image = np.zeros((720, 1280, 3), dtype=np.uint8)
+engine.detector.analyze(image)
+first = time.perf_counter()
+engine.detector.analyze(image)
+second = time.perf_counter()
+print(json.dumps({{
+    "import_s": imported - started,
+    "engine_init_s": loaded - imported,
+    "warm_up_s": ready - loaded,
+    "warm_up_index_s": timings.get("index_s", 0.0),
+    "ready_s": ready - started,
+    "first_request_ms": 1000 * (first - ready),
+    "second_request_ms": 1000 * (second - first),
+}}))
+"""
+
+
+def run_fresh(code, env=None, cwd=None):
+    """Запускает код в новом интерпретаторе и возвращает напечатанный им JSON."""
+    proc = subprocess.run([sys.executable, "-c", code], capture_output=True, text=True, cwd=cwd,
+                          env=dict(os.environ, **(env or {})))
+    if proc.returncode != 0:
+        lines = proc.stderr.strip().splitlines()
+        raise RuntimeError(lines[-1] if lines else f"код возврата {proc.returncode}")
+    return json.loads(proc.stdout.strip().splitlines()[-1])
+
+
+def median_of(runs, fn):
+    samples = [fn() for _ in range(runs)]
+    return {key: round(statistics.median(s[key] for s in samples), 3) for key in samples[0]}
+
+
+def measure_imports(runs=3):
+    """Время импорта модулей бота и поиска в новом процессе (медиана runs запусков)."""
+    result = {}
+    for name, (path, statement) in IMPORT_CASES.items():
+        code = _IMPORT_CODE.format(path=path, statement=statement)
+        result[name] = median_of(runs, lambda: run_fresh(code))["s"]
+    return result
+
+
+def measure_engine(runs=3, data_dir=None):
+    """
+    Холодный старт поискового движка с моделями: первый запуск без кэша графов ONNX Runtime,
+    затем runs запусков с кэшем — с прогревом и без него (первый запрос после «готовности»).
+    """
+    with tempfile.TemporaryDirectory() as cache_dir:
+        env = {"PHOTOFINDER_ORT_CACHE": cache_dir}
+        warm = _ENGINE_CODE.format(path=ML_WORKER_DIR, warm_up=True)
+        cold = _ENGINE_CODE.format(path=ML_WORKER_DIR, warm_up=False)
+        return {
+            "no_graph_cache": run_fresh(warm, env, data_dir),
+            "graph_cache": median_of(runs, lambda: run_fresh(warm, env, data_dir)),
+            "graph_cache_no_warm_up": median_of(runs, lambda: run_fresh(cold, env, data_dir)),
+        }
+
+
+def measure_startup(runs=3, models=True, data_dir=None):
+    result = {"imports": measure_imports(runs)}
+    if models:
+        try:
+            result["engine"] = measure_engine(runs, data_dir)
+        except RuntimeError as e:
+            # -- нет insightface или моделей buffalo_l: остаются только замеры импорта
+            result["engine"] = {"error": str(e)}
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Бенчмарк холодного старта бота и поиска")
+    parser.add_argument("--runs", type=int, default=3, help="запусков на каждый замер (берётся медиана)")
+    parser.add_argument("--no-models", action="store_true", help="только импорты (без insightface и моделей)")
+    parser.add_argument("--data-dir", help="рабочая папка с data/vectors (по умолчанию — текущая)")
+    parser.add_argument("--output", help="куда записать JSON (по умолчанию — только stdout)")
+    args = parser.parse_args()
+
+    report = {"benchmark": "startup", "runs": args.runs,
+              "results": measure_startup(args.runs, not args.no_models, args.data_dir)}
+    payload = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            f.write(payload + "\n")
+    print(payload)
+
+
+if __name__ == "__main__":
+    main()
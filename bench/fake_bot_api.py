@@ -0,0 +1,151 @@
+# локальная заглушка Telegram Bot API для проверки отправки фото без реального Telegram
+import json
+import time
+import argparse
+import threading
+from email import message_from_bytes
+from urllib.parse import parse_qs
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+class FakeBotAPI:
+    """
+    Отвечает на getMe, sendDocument, sendPhoto и sendMediaGroup так же, как Bot API:
+    загруженным файлам выдаёт новые file_id, отправленные по file_id — возвращает как есть.
+    flood_every=N — каждый N-й запрос отправки получает 429 с retry_after (проверка RetryAfter).
+    Считает запросы, загруженные байты и ответы 429.
+    """
+    def __init__(self, host="127.0.0.1", port=0, flood_every=0, retry_after=1):
+        self.flood_every = flood_every
+        self.retry_after = retry_after
+        self.stats = {"requests": 0, "send_requests": 0, "uploaded_files": 0, "uploaded_bytes": 0,
+                      "reused_file_ids": 0, "messages": 0, "flood_429": 0}
+        self._lock = threading.Lock()
+        self._next_id = 0
+        self.server = ThreadingHTTPServer((host, port), self._handler())
+
+    @property
+    def base_url(self):
+        host, port = self.server.server_address[:2]
+        return f"http://{host}:{port}/bot"
+
+    def start(self):
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    # -- разбор запроса: multipart (с файлами) или form-urlencoded (только параметры)
+
+    @staticmethod
+    def _parse(content_type, body):
+        fields, files = {}, {}
+        if content_type.startswith("multipart/form-data"):
+            message = message_from_bytes(f"Content-Type: {content_type}\r\n\r\n".encode() + body)
+            for part in message.get_payload():
+                name = part.get_param("name", header="content-disposition")
+                payload = part.get_payload(decode=True) or b""
+                if part.get_filename():
+                    files[name] = payload
+                else:
+                    fields[name] = payload.decode()
+        elif body:
+            if content_type.startswith("application/json"):
+                fields = {k: v if isinstance(v, str) else json.dumps(v) for k, v in json.loads(body).items()}
+            else:
+                fields = {k: v[0] for k, v in parse_qs(body.decode()).items()}
+        return fields, files
+
+    def _document(self, media, files):
+        """Документ из ответа: attach://name — загруженный файл, иначе — переданный file_id."""
+        if media.startswith("attach://"):
+            data = files.get(media[len("attach://"):], b"")
+            self.stats["uploaded_files"] += 1
+            self.stats["uploaded_bytes"] += len(data)
+            self._next_id += 1
+            file_id = f"fake-file-{self._next_id}"
+        else:
+            self.stats["reused_file_ids"] += 1
+            file_id = media
+        return {"file_id": file_id, "file_unique_id": f"u-{file_id}"}
+
+    def _message(self, chat_id, document=None, photo=None):
+        self.stats["messages"] += 1
+        message = {"message_id": self.stats["messages"], "date": int(time.time()),
+                   "chat": {"id": int(chat_id), "type": "private"}}
+        if photo is not None:
+            message["photo"] = [dict(photo, width=1280, height=1280)]
+        else:
+            message["document"] = document
+        return message
+
+    def handle(self, method, fields, files):
+        with self._lock:
+            self.stats["requests"] += 1
+            if method == "getMe":
+                return {"id": 1, "is_bot": True, "first_name": "FakeBot", "username": "fake_bot"}
+            if method not in ("sendDocument", "sendPhoto", "sendMediaGroup"):
+                return {}
+
+            self.stats["send_requests"] += 1
+            if self.flood_every and self.stats["send_requests"] % self.flood_every == 0:
+                self.stats["flood_429"] += 1
+                return None
+
+            chat_id = fields.get("chat_id", "0")
+            if method in ("sendDocument", "sendPhoto"):
+                field = "document" if method == "sendDocument" else "photo"
+                if field in files:
+                    document = self._document(f"attach://{field}", files)
+                else:
+                    document = self._document(fields[field], files)
+                if method == "sendPhoto":
+                    return self._message(chat_id, photo=document)
+                return self._message(chat_id, document)
+
+            return [self._message(chat_id, self._document(item["media"], files))
+                    for item in json.loads(fields["media"])]
+
+    def _handler(self):
+        api = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_POST(self):
+                body = self.rfile.read(int(self.headers.get("Content-Length") or 0))
+                fields, files = api._parse(self.headers.get("Content-Type", ""), body)
+                result = api.handle(self.path.rsplit("/", 1)[-1], fields, files)
+                if result is None:
+                    status, answer = 429, {"ok": False, "error_code": 429,
+                                           "description": f"Too Many Requests: retry after {api.retry_after}",
+                                           "parameters": {"retry_after": api.retry_after}}
+                else:
+                    status, answer = 200, {"ok": True, "result": result}
+                payload = json.dumps(answer).encode()
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(payload)))
+                self.end_headers()
+                self.wfile.write(payload)
+
+            do_GET = do_POST
+
+            def log_message(self, *args):
+                pass
+
+        return Handler
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Заглушка Telegram Bot API (TELEGRAM_API_URL=http://host:port/bot)")
+    parser.add_argument("--port", type=int, default=8081)
+    parser.add_argument("--flood-every", type=int, default=0)
+    args = parser.parse_args()
+
+    api = FakeBotAPI(port=args.port, flood_every=args.flood_every)
+    print(f"Fake Bot API: {api.base_url}")
+    try:
+        api.server.serve_forever()
+    except KeyboardInterrupt:
+        print(json.dumps(api.stats, indent=2))
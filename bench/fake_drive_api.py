@@ -0,0 +1,156 @@
+# локальная заглушка Google Drive API v3 для проверки синхронизации фото без реального Drive
+import re
+import json
+import time
+import hashlib
+import argparse
+import threading
+from urllib.parse import urlparse, parse_qs
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+FOLDER_MIME_TYPE = "application/vnd.google-apps.folder"
+
+
+class FakeDriveAPI:
+    """
+    Отвечает на files.list (q="'<id>' in parents", постранично) и files.get?alt=media (с Range)
+    так же, как Drive API v3. Дерево папок задаётся через add_folder/add_file.
+    page_size — файлов на страницу (проверка nextPageToken), fail_every=N — каждый N-й запрос
+    содержимого получает 503 (проверка повторов), latency — задержка ответа в секундах.
+    Считает запросы списков и содержимого, отданные байты и ответы 503.
+    """
+    def __init__(self, host="127.0.0.1", port=0, page_size=100, fail_every=0, latency=0.0):
+        self.page_size = page_size
+        self.fail_every = fail_every
+        self.latency = latency
+        self.items = {}       # id → метаданные файла или папки
+        self.content = {}     # id → байты файла
+        self.children = {}    # id папки → [id]
+        self.stats = {"list_requests": 0, "media_requests": 0, "served_bytes": 0, "failed_503": 0}
+        self._lock = threading.Lock()
+        self._next_id = 0
+        self.server = ThreadingHTTPServer((host, port), self._handler())
+
+    @property
+    def base_url(self):
+        host, port = self.server.server_address[:2]
+        return f"http://{host}:{port}/drive/v3/"
+
+    def start(self):
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    # -- дерево папок
+
+    def _new_id(self):
+        self._next_id += 1
+        return f"fake{self._next_id:06d}xxxxxxxxxxxx"
+
+    def add_folder(self, name, parent=None):
+        folder_id = self._new_id()
+        self.items[folder_id] = {"id": folder_id, "name": name, "mimeType": FOLDER_MIME_TYPE}
+        self.children[folder_id] = []
+        if parent is not None:
+            self.children[parent].append(folder_id)
+        return folder_id
+
+    def add_file(self, name, data, parent, mime_type="image/jpeg"):
+        file_id = self._new_id()
+        self.items[file_id] = {"id": file_id, "name": name, "mimeType": mime_type}
+        self.children[parent].append(file_id)
+        self.update_file(file_id, data)
+        return file_id
+
+    def update_file(self, file_id, data):
+        """Меняет содержимое файла (новые md5Checksum и modifiedTime)."""
+        self.content[file_id] = data
+        self.items[file_id].update(md5Checksum=hashlib.md5(data).hexdigest(), size=str(len(data)),
+                                   modifiedTime=time.strftime("%Y-%m-%dT%H:%M:%S.", time.gmtime())
+                                   + f"{time.time_ns() % 10 ** 9:09d}Z")
+
+    # -- обработка запросов
+
+    def list_files(self, query):
+        self.stats["list_requests"] += 1
+        match = re.search(r"'([^']+)' in parents", query.get("q", [""])[0])
+        ids = self.children.get(match.group(1), []) if match else []
+        start = int(query.get("pageToken", ["0"])[0])
+        page_size = min(self.page_size, int(query.get("pageSize", [self.page_size])[0]))
+        answer = {"files": [self.items[i] for i in ids[start:start + page_size]]}
+        if start + page_size < len(ids):
+            answer["nextPageToken"] = str(start + page_size)
+        return answer
+
+    def media(self, file_id, range_header):
+        """Содержимое файла: (статус, байты, заголовки)."""
+        self.stats["media_requests"] += 1
+        if self.fail_every and self.stats["media_requests"] % self.fail_every == 0:
+            self.stats["failed_503"] += 1
+            return 503, b'{"error": {"code": 503, "message": "Backend Error"}}', {}
+        data = self.content.get(file_id)
+        if data is None:
+            return 404, b'{"error": {"code": 404, "message": "File not found"}}', {}
+        match = re.match(r"bytes=(\d+)-(\d*)", range_header or "")
+        if not match:
+            self.stats["served_bytes"] += len(data)
+            return 200, data, {}
+        start = int(match.group(1))
+        end = min(int(match.group(2)) if match.group(2) else len(data) - 1, len(data) - 1)
+        chunk = data[start:end + 1]
+        self.stats["served_bytes"] += len(chunk)
+        return 206, chunk, {"Content-Range": f"bytes {start}-{end}/{len(data)}"}
+
+    def _handler(self):
+        api = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                url = urlparse(self.path)
+                query = parse_qs(url.query)
+                if api.latency:
+                    time.sleep(api.latency)
+                with api._lock:
+                    if url.path == "/drive/v3/files":
+                        status, payload, headers = 200, json.dumps(api.list_files(query)).encode(), {}
+                        headers["Content-Type"] = "application/json"
+                    elif url.path.startswith("/drive/v3/files/") and query.get("alt") == ["media"]:
+                        file_id = url.path.rsplit("/", 1)[-1]
+                        status, payload, headers = api.media(file_id, self.headers.get("Range"))
+                    else:
+                        status, payload, headers = 404, b"{}", {}
+                self.send_response(status)
+                for key, value in headers.items():
+                    self.send_header(key, value)
+                self.send_header("Content-Length", str(len(payload)))
+                self.end_headers()
+                self.wfile.write(payload)
+
+            def log_message(self, *args):
+                pass
+
+        return Handler
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Заглушка Google Drive API (DRIVE_API_URL=http://host:port/drive/v3/)")
+    parser.add_argument("--port", type=int, default=8082)
+    parser.add_argument("--folders", type=int, default=4)
+    parser.add_argument("--photos", type=int, default=50, help="фото в каждой папке")
+    parser.add_argument("--size-kb", type=int, default=256)
+    args = parser.parse_args()
+
+    api = FakeDriveAPI(port=args.port)
+    root = api.add_folder("root")
+    for f in range(args.folders):
+        folder = api.add_folder(f"folder_{f}", root)
+        for i in range(args.photos):
+            api.add_file(f"IMG_{i:04d}.jpg", bytes([f, i % 256]) * (args.size_kb * 512), folder)
+    print(f"Fake Drive API: {api.base_url}, папка: https://drive.google.com/drive/folders/{root}")
+    try:
+        api.server.serve_forever()
+    except KeyboardInterrupt:
+        print(json.dumps(api.stats, indent=2))
@@ -0,0 +1,46 @@
+# синтетические эмбеддинги лиц для бенчмарков (без моделей и фото)
+import numpy as np
+
+
+def normalize(x):
+    x = np.asarray(x, dtype=np.float32)
+    return x / np.linalg.norm(x, axis=1, keepdims=True)
+
+
+def make_identities(n_identities, dim=512, seed=0):
+    """Случайные нормализованные «центры» личностей; в 512-d они почти ортогональны, как у ArcFace."""
+    rng = np.random.default_rng(seed)
+    return normalize(rng.standard_normal((n_identities, dim), dtype=np.float32))
+
+
+def sample_faces(identities, n_faces, noise=0.028, seed=1):
+    """
+    Лица вокруг центров личностей: косинус двух лиц одного человека ≈ 0.7 (выше порога 0.6),
+    как у реальных ArcFace-эмбеддингов одного человека на разных фото.
+    Возвращает (эмбеддинги, номер личности для каждого лица).
+    """
+    rng = np.random.default_rng(seed)
+    labels = rng.integers(0, len(identities), size=n_faces)
+    faces = identities[labels] + noise * rng.standard_normal((n_faces, identities.shape[1]), dtype=np.float32)
+    return normalize(faces), labels
+
+
+def sample_event(n_faces, faces_per_identity=25, max_faces_per_photo=4, zipf=0.8, noise=0.028, seed=0):
+    """
+    Синтетическое «мероприятие» на n_faces лиц, похожее на реальное:
+    - размеры кластеров неравномерны (закон Ципфа): несколько человек на сотнях фото, много — на единицах;
+    - на одном фото от 1 до max_faces_per_photo лиц.
+    Возвращает (эмбеддинги n_faces×512, номер личности для каждого лица, photo_id для каждого лица).
+    """
+    rng = np.random.default_rng(seed)
+    n_identities = max(1, n_faces // faces_per_identity)
+    identities = make_identities(n_identities, seed=seed)
+
+    weights = 1.0 / np.arange(1, n_identities + 1) ** zipf
+    labels = rng.choice(n_identities, size=n_faces, p=weights / weights.sum())
+    faces = normalize(identities[labels] + noise * rng.standard_normal((n_faces, identities.shape[1]), dtype=np.float32))
+
+    per_photo = rng.integers(1, max_faces_per_photo + 1, size=n_faces)
+    photo_of_face = np.repeat(np.arange(n_faces), per_photo)[:n_faces]
+    photo_ids = [f"IMG_{p:07d}" for p in photo_of_face.tolist()]
+    return faces, labels, photo_ids
@@ -0,0 +1,93 @@
+import os
+import json
+import time
+import asyncio
+import logging
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+logger = logging.getLogger(__name__)
+
+HEALTH_ENV = "PHOTOFINDER_HEALTH_PORT"   # порт HTTP-проверок /livez и /readyz (не задан — сервер не запускается)
+HEARTBEAT_INTERVAL = 5       # секунд между отметками event loop
+HEARTBEAT_TIMEOUT = 30       # отметка старше — event loop завис, процесс считается неживым
+
+
+class HealthState:
+    """
+    Состояние процесса бота для проверок оркестратора.
+    Живость (liveness) — процесс не упал при запуске и event loop отвечает: её не нужно ждать,
+    пока грузятся модели. Готовность (readiness) — модели и база загружены и прогреты, запросы обслуживаются быстро.
+    """
+    def __init__(self):
+        self.started = time.monotonic()
+        self.heartbeat = self.started
+        self.ready_after = None     # секунд от старта процесса до готовности
+        self.error = None           # ошибка запуска: процесс больше не считается живым
+        self.details = {}
+
+    def set_ready(self, **details):
+        self.ready_after = time.monotonic() - self.started
+        self.details = details
+
+    def set_failed(self, error):
+        self.error = str(error)
+
+    def alive(self):
+        return self.error is None and time.monotonic() - self.heartbeat < HEARTBEAT_TIMEOUT
+
+    def ready(self):
+        return self.alive() and self.ready_after is not None
+
+    async def beat(self):
+        """Фоновая задача event loop: отметки живости раз в HEARTBEAT_INTERVAL секунд."""
+        while True:
+            self.heartbeat = time.monotonic()
+            await asyncio.sleep(HEARTBEAT_INTERVAL)
+
+    def report(self):
+        return {
+            "alive": self.alive(),
+            "ready": self.ready(),
+            "uptime_s": round(time.monotonic() - self.started, 3),
+            "ready_after_s": round(self.ready_after, 3) if self.ready_after is not None else None,
+            "error": self.error,
+            **self.details,
+        }
+
+
+class HealthServer:
+    """HTTP-проверки: /livez — 200, пока процесс жив; /readyz — 200 только после загрузки и прогрева моделей."""
+    def __init__(self, state, port, host="0.0.0.0"):
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                path = self.path.split("?")[0]
+                if path == "/livez":
+                    ok = state.alive()
+                elif path == "/readyz":
+                    ok = state.ready()
+                else:
+                    self.send_error(404)
+                    return
+                payload = json.dumps(state.report()).encode()
+                self.send_response(200 if ok else 503)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(payload)))
+                self.end_headers()
+                self.wfile.write(payload)
+
+            def log_message(self, *args):
+                pass
+
+        self.server = ThreadingHTTPServer((host, port), Handler)
+        threading.Thread(target=self.server.serve_forever, name="health-http", daemon=True).start()
+        logger.info(f"🩺 Проверки состояния: http://{host}:{port}/livez и /readyz")
+
+    @classmethod
+    def from_env(cls, state):
+        port = os.getenv(HEALTH_ENV)
+        return cls(state, int(port)) if port else None
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
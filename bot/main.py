@@ -8,7 +8,15 @@ from telegram.ext import Application, CommandHandler, MessageHandler, filters, C
 
 # Добавляем путь к корню проекта для импорта
 sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
-from ml_worker.search import vectorize_face
+# модули ml_worker импортируют друг друга по короткому имени (import metrics) — бот использует тот же путь,
+# чтобы реестр метрик был один на процесс
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'ml_worker'))
+# ml_worker.search и ml_worker.derivatives (insightface, onnxruntime, faiss, cv2) импортируются при загрузке
+# моделей в фоне (load_search_engine), чтобы процесс сразу отвечал на проверки живости и принимал обновления
+import metrics
+from search_queue import SearchQueue
+from photo_sender import FileIdCache, PhotoSender
+from health import HealthState, HealthServer
 
 load_dotenv()
 
@@ -19,7 +27,10 @@ logging.basicConfig(
 logger = logging.getLogger(__name__)
 
 BOT_TOKEN = os.getenv("BOT_TOKEN")
-TEMP_DIR = "data/photos/temporary"   # путь к временному хранилищу фоток, отправляемых пользователями
+# адрес Bot API (можно указать локальный сервер Bot API или тестовую заглушку)
+TELEGRAM_API_URL = os.getenv("TELEGRAM_API_URL", "https://api.telegram.org/bot")
+TELEGRAM_FILE_URL = os.getenv("TELEGRAM_FILE_URL", "https://api.telegram.org/file/bot")
+ARCHIVE_MIN_PHOTOS = 20   # с какого размера альбома вместо отдельных файлов отправляются превью и ZIP-архив
 
 def get_main_keyboard():
     """Создает основную клавиатуру с двумя кнопками"""
@@ -32,6 +43,12 @@ def get_main_keyboard():
 
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Обработчик команды /start"""
+    # Ссылка t.me/<бот>?start=<мероприятие>: дальше поиск идёт только по базе этого мероприятия
+    # (без ссылки — по всем мероприятиям). Повторный /start без параметра мероприятие не сбрасывает.
+    if context.args:
+        context.user_data["event"] = context.args[0]
+        logger.info(f"Пользователь {update.effective_user.id} пришёл по ссылке мероприятия {context.args[0]}")
+
     welcome_text = (
         "Привет!👋\n\n"
         "Я помогу найти ваши фото с мероприятия. Загрузите свое портретное фото — я найду все остальные."
@@ -49,26 +66,44 @@ async def handle_photo(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user = update.effective_user
     logger.info(f"Пользователь {user.first_name} отправил фото")
 
-    # Получаем файл фото
     photo = update.message.photo[-1]  # Берем фото наибольшего размера
-    file = await context.bot.get_file(photo.file_id)
-
-    # сохранить фото
-    file_path = os.path.join(TEMP_DIR, f"{photo.file_id}.jpg")
-    await file.download_to_drive(file_path)
 
     # Отправляем сообщение о поиске
     sent_message = await update.message.reply_text(
         "Подождите секундочку, ищу все ваши фотографии на посещенном мероприятии"
     )
 
-    # Поиск фото по лицу
-    search_result = vectorize_face(file_path)
-    
-    if search_result and search_result.get("user_folder"):
-        # Используем найденную папку пользователя
-        user_folder = search_result["user_folder"]
-        await send_photos_from_folder(update, context, user_folder, sent_message)
+    # Бот только запущен и ещё загружает модели — запрос дождётся готовности
+    ready = context.bot_data["ready"]
+    if not ready.is_set():
+        await sent_message.edit_text("Бот только что запустился и загружает модели, фото будет обработано через минуту")
+        await ready.wait()
+
+    # То же фото уже искали по текущей версии базы — отвечаем из кэша, без скачивания и моделей
+    event = context.user_data.get("event")
+    hit, search_result = context.bot_data["search_engine"].cached_result(photo.file_unique_id, event=event)
+    if not hit:
+        # Скачиваем фото в память (без временного файла)
+        with metrics.timer("telegram_download"):
+            file = await context.bot.get_file(photo.file_id)
+            image_bytes = bytes(await file.download_as_bytearray())
+
+        # Поиск фото по лицу: модели работают вне event loop, запросы собираются в пакеты
+        search_queue = context.bot_data["search_queue"]
+        if search_queue.full():
+            await update.message.reply_text(
+                f"Сейчас много запросов, вы в очереди (перед вами {search_queue.qsize()}). Результат придёт автоматически."
+            )
+        with metrics.timer("search_request"):
+            search_result = await search_queue.search(image_bytes, key=photo.file_unique_id, event=event)
+
+    if search_result and len(search_result.get("matches", [])) > 1:
+        # На фото найдено несколько человек — предлагаем выбрать альбом
+        await offer_albums(update, context, search_result["matches"], sent_message)
+    elif search_result and search_result.get("user_photos"):
+        # Отправляем альбом найденного пользователя
+        await send_user_photos(update, context, search_result["user_photos"], sent_message,
+                               user_id=search_result["user_id"], event=search_result["event"])
     else:
         # Если поиск не дал результатов, сообщаем об этом
         error_msg = "К сожалению, не удалось найти ваши фотографии. Попробуйте загрузить другое фото."
@@ -80,38 +115,60 @@ async def handle_photo(update: Update, context: ContextTypes.DEFAULT_TYPE):
             await update.message.reply_text(error_msg, reply_markup=reply_markup)
 
 
-async def send_photos_from_folder(update: Update, context: ContextTypes.DEFAULT_TYPE, folder_path: str,
-                                  sent_message=None):
-    """Отправляет несколько фото из указанной папки в виде файлов (для сохранения качества)"""
-    try:
-        # Проверяем, существует ли папка
-        if not os.path.exists(folder_path):
-            error_msg = (
-                f"Ошибка: папка {folder_path} не найдена. "
-            )
-            reply_markup = get_main_keyboard()
-            if sent_message:
-                await sent_message.edit_text(error_msg)
-                await update.message.reply_text("Попробуйте снова.", reply_markup=reply_markup)
-            else:
-                await update.message.reply_text(error_msg, reply_markup=reply_markup)
-            return
+async def offer_albums(update: Update, context: ContextTypes.DEFAULT_TYPE, matches: list, sent_message=None):
+    """Несколько найденных пользователей (групповое фото): кнопки с альбомами, результат одного поиска"""
+    # user_id уникален только внутри мероприятия, поэтому кнопки ссылаются на номер совпадения
+    context.user_data["albums"] = {str(n): (m["event"], m["user_id"], m["user_photos"])
+                                   for n, m in enumerate(matches, 1)}
+
+    buttons = [
+        [InlineKeyboardButton(f"Человек {n} — {len(m['user_photos'])} фото", callback_data=f"album:{n}")]
+        for n, m in enumerate(matches, 1)
+    ]
+    buttons.append([InlineKeyboardButton("Все альбомы", callback_data="album:all")])
+    text = f"На фото нашлось несколько человек ({len(matches)}). Чьи фотографии прислать?"
+    if sent_message:
+        await sent_message.edit_text(text, reply_markup=InlineKeyboardMarkup(buttons))
+    else:
+        await update.message.reply_text(text, reply_markup=InlineKeyboardMarkup(buttons))
+
+
+async def send_album_archive(context: ContextTypes.DEFAULT_TYPE, chat_id: int, user_id: str, photo_files: list,
+                             event=None):
+    """Большой альбом: превью-сетка (готовит воркер) и ZIP-архив (собирается при первом запросе и кэшируется)"""
+    # модули уже загружены вместе с поиском (load_search_engine), импорт здесь ничего не стоит
+    from ml_worker.derivatives import album_fingerprint, preview_path, archive_paths
+    from ml_worker.events import shard_paths
+
+    photo_sender = context.bot_data["photo_sender"]
+    derivatives_dir = shard_paths(event)["derivatives_dir"]     # производные лежат в папке мероприятия
+
+    fingerprint = await asyncio.to_thread(album_fingerprint, photo_files)
+    preview = preview_path(user_id, fingerprint, derivatives_dir)
+    if os.path.exists(preview):
+        await photo_sender.send_photo(context.bot, chat_id, preview,
+                                      caption=f"Найдено {len(photo_files)} фото, все они — в архиве ниже")
+
+    archives = await asyncio.to_thread(archive_paths, user_id, photo_files, derivatives_dir)
+    sent_parts = await photo_sender.send_album(context.bot, chat_id, archives)
+    return len(photo_files) if archives and sent_parts == len(archives) else 0
 
-        # Получаем список всех фото файлов
-        photo_extensions = ('.jpg', '.jpeg', '.png', '.gif', '.bmp', '.webp')
-        photo_files = [
-            f for f in os.listdir(folder_path)
-            if f.lower().endswith(photo_extensions) and os.path.isfile(os.path.join(folder_path, f))
-        ]
+
+async def send_user_photos(update: Update, context: ContextTypes.DEFAULT_TYPE, photo_paths: list,
+                           sent_message=None, user_id=None, event=None):
+    """Отправляет фото из альбома пользователя в виде файлов (для сохранения качества)"""
+    try:
+        # Альбом уже собран по метаданным кластера — оставляем только существующие файлы
+        photo_files = [path for path in photo_paths if os.path.isfile(path)]
 
         if not photo_files:
-            error_msg = "В папке не найдено фото файлов."
+            error_msg = "Не найдено фото файлов."
             reply_markup = get_main_keyboard()
             if sent_message:
                 await sent_message.edit_text(error_msg)
-                await update.message.reply_text("Попробуйте снова.", reply_markup=reply_markup)
+                await update.effective_message.reply_text("Попробуйте снова.", reply_markup=reply_markup)
             else:
-                await update.message.reply_text(error_msg, reply_markup=reply_markup)
+                await update.effective_message.reply_text(error_msg, reply_markup=reply_markup)
             return
 
         # Удаляем сообщение "Подождите секундочку..."
@@ -121,28 +178,18 @@ async def send_photos_from_folder(update: Update, context: ContextTypes.DEFAULT_
             except:
                 pass
 
-        # Функция для отправки одного фото
-        async def send_single_photo(photo_file):
-            photo_path = os.path.join(folder_path, photo_file)
-            try:
-                with open(photo_path, 'rb') as photo:
-                    await update.message.reply_document(
-                        document=photo,
-                        filename=photo_file
-                    )
-                logger.info(f"Отправлено фото как файл: {photo_file}")
-                return True
-            except Exception as e:
-                logger.error(f"Ошибка при отправке фото {photo_file}: {e}")
-                return False
-
-        # Отправляем все фото параллельно
-        tasks = [send_single_photo(photo_file) for photo_file in photo_files]
-        results = await asyncio.gather(*tasks, return_exceptions=True)
-        successful_count = sum(1 for r in results if r is True)
+        # Большой альбом — превью и архив, иначе медиагруппами: повторно — по file_id, с общим ограничением скорости
+        photo_sender = context.bot_data["photo_sender"]
+        chat_id = update.effective_chat.id
+        successful_count = 0
+        if user_id is not None and len(photo_files) >= ARCHIVE_MIN_PHOTOS:
+            successful_count = await send_album_archive(context, chat_id, user_id, photo_files, event)
+        if successful_count == 0:
+            successful_count = await photo_sender.send_album(context.bot, chat_id, photo_files)
+        logger.info(f"Отправлено {successful_count} из {len(photo_files)} фото пользователю {update.effective_user.id}")
 
         if successful_count > 0:
-            await update.message.reply_text(f"Отправлено {successful_count} фото!")
+            await update.effective_message.reply_text(f"Отправлено {successful_count} фото!")
             # Финальное сообщение от бота с кнопками
             final_keyboard = [
                 [KeyboardButton("Да")],
@@ -152,7 +199,7 @@ async def send_photos_from_folder(update: Update, context: ContextTypes.DEFAULT_
                 ]
             ]
             final_reply_markup = ReplyKeyboardMarkup(final_keyboard, resize_keyboard=True, one_time_keyboard=False)
-            await update.message.reply_text(
+            await update.effective_message.reply_text(
                 "Сбой? Хотите повторить?",
                 reply_markup=final_reply_markup
             )
@@ -164,11 +211,11 @@ async def send_photos_from_folder(update: Update, context: ContextTypes.DEFAULT_
         if sent_message:
             try:
                 await sent_message.edit_text(error_msg)
-                await update.message.reply_text("Попробуйте снова.", reply_markup=reply_markup)
+                await update.effective_message.reply_text("Попробуйте снова.", reply_markup=reply_markup)
             except:
-                await update.message.reply_text(error_msg, reply_markup=reply_markup)
+                await update.effective_message.reply_text(error_msg, reply_markup=reply_markup)
         else:
-            await update.message.reply_text(error_msg, reply_markup=reply_markup)
+            await update.effective_message.reply_text(error_msg, reply_markup=reply_markup)
 
 
 async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -236,6 +283,19 @@ async def handle_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
         )
         await query.message.reply_text(instructions, reply_markup=get_main_keyboard())
 
+    elif query.data.startswith("album:"):
+        # Альбомы из последнего поиска по групповому фото
+        albums = context.user_data.get("albums", {})
+        choice = query.data.split(":", 1)[1]
+        selected = list(albums) if choice == "all" else [choice] if choice in albums else []
+        if not selected:
+            await query.message.reply_text("Результат поиска устарел, пришлите фото ещё раз.",
+                                           reply_markup=get_main_keyboard())
+            return
+        for choice in selected:
+            event, user_id, photo_paths = albums[choice]
+            await send_user_photos(update, context, photo_paths, user_id=user_id, event=event)
+
     elif query.data == "help_questions":
         await query.message.reply_text(
             "Если у вас есть какой-то вопрос или предложение о сотрудничестве, напишите @imnomberone",
@@ -243,6 +303,34 @@ async def handle_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
         )
 
 
+def load_search_engine():
+    """Загрузка моделей и векторной базы с прогревом (в отдельном потоке, бот в это время уже работает)"""
+    from ml_worker.search import SearchEngine
+
+    search_engine = SearchEngine()
+    return search_engine, search_engine.warm_up()
+
+
+async def start_search(app: Application, health: HealthState):
+    """Фоновая загрузка поиска: после прогрева запускает очередь поиска и отмечает бота готовым"""
+    try:
+        search_engine, timings = await asyncio.to_thread(load_search_engine)
+    except Exception as e:
+        logger.error(f"Не удалось загрузить модели и базу: {e}", exc_info=True)
+        health.set_failed(e)
+        app.stop_running()
+        return
+
+    search_queue = SearchQueue(search_engine)
+    search_queue.start()
+    app.bot_data["search_engine"] = search_engine
+    app.bot_data["search_queue"] = search_queue
+    app.bot_data["ready"].set()
+    health.set_ready(warm_up={k: round(v, 3) for k, v in timings.items()},
+                     events=[event for event in search_engine.shards if event is not None])
+    logger.info(f"✅ Поиск готов через {health.ready_after:.1f} с после запуска (прогрев моделей {timings['models_s']:.2f} с)")
+
+
 def main():
     """Запуск бота"""
     # Проверка токена
@@ -253,13 +341,47 @@ def main():
         logger.info("=" * 60 + "\n")
         return
 
-    # Создаем папку для фото если не существует
-    if not os.path.exists(TEMP_DIR):
-        os.makedirs(TEMP_DIR, exist_ok=True)
-        logger.info(f"📁 Создана папка для временного хранения фото от пользователя: {TEMP_DIR}")
-
-    # Создаем приложение
-    application = Application.builder().token(BOT_TOKEN).build()
+    # Метрики: PHOTOFINDER_METRICS=http:<порт> или file:<путь>; kill -USR1 приостанавливает и возобновляет запись
+    metrics.configure()
+    metrics.install_toggle_signal()
+
+    # Живость отвечает сразу, готовность — после загрузки и прогрева моделей (PHOTOFINDER_HEALTH_PORT=<порт>)
+    health = HealthState()
+    health_server = HealthServer.from_env(health)
+    file_id_cache = FileIdCache()
+    photo_sender = PhotoSender(file_id_cache)
+    background_tasks = []
+
+    async def post_init(app):
+        # Модели и векторная база загружаются один раз на весь срок работы бота — в фоне
+        loop = asyncio.get_running_loop()
+        background_tasks.append(loop.create_task(health.beat()))
+        background_tasks.append(loop.create_task(start_search(app, health)))
+
+    async def post_shutdown(app):
+        for task in background_tasks:
+            task.cancel()
+        search_queue = app.bot_data.get("search_queue")
+        if search_queue is not None:
+            await search_queue.stop()
+        file_id_cache.close()
+        if health_server is not None:
+            health_server.close()
+        metrics.close()
+
+    # Создаем приложение (обновления обрабатываются параллельно, чтобы запросы попадали в общий пакет)
+    application = (
+        Application.builder()
+        .token(BOT_TOKEN)
+        .base_url(TELEGRAM_API_URL)
+        .base_file_url(TELEGRAM_FILE_URL)
+        .concurrent_updates(True)
+        .post_init(post_init)
+        .post_shutdown(post_shutdown)
+        .build()
+    )
+    application.bot_data["ready"] = asyncio.Event()
+    application.bot_data["photo_sender"] = photo_sender
 
     # Регистрируем обработчики (важен порядок!)
     # -- обработчик команды /start
@@ -274,7 +396,7 @@ def main():
 
     # Запускаем бота
     logger.info("\n" + "=" * 60)
-    logger.info("Бот запущен и готов к работе!")
+    logger.info("Бот запущен, модели загружаются в фоне")
     logger.info("Нажмите Ctrl+C для остановки")
     logger.info("=" * 60 + "\n")
     logger.info("Бот запущен...")
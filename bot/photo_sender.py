@@ -0,0 +1,208 @@
+import os
+import time
+import asyncio
+import sqlite3
+import logging
+from contextlib import ExitStack
+from telegram import InputMediaDocument
+from telegram.error import BadRequest, RetryAfter, TimedOut, NetworkError
+import metrics
+
+logger = logging.getLogger(__name__)
+
+FILE_ID_CACHE_PATH = "data/telegram/file_ids.sqlite"   # путь к фото → file_id уже загруженного документа
+MEDIA_GROUP_SIZE = 10        # максимум документов в одной медиагруппе Telegram
+SEND_RATE = 25.0             # сообщений в секунду на весь бот (лимит Telegram — около 30)
+SEND_BURST = 30              # ёмкость «ведра» токенов
+MAX_CONCURRENT_SENDS = 4     # сколько медиагрупп отправляется одновременно (для разных пользователей)
+MAX_RETRIES = 5              # повторов при RetryAfter и сетевых ошибках
+
+
+class FileIdCache:
+    """
+    Постоянный кэш file_id отправленных документов (SQLite).
+    Запись привязана к mtime и размеру файла: изменённое фото будет загружено заново.
+    """
+    def __init__(self, db_path=FILE_ID_CACHE_PATH):
+        os.makedirs(os.path.dirname(db_path) or ".", exist_ok=True)
+        self.conn = sqlite3.connect(db_path, check_same_thread=False)
+        self.conn.execute("""
+            CREATE TABLE IF NOT EXISTS file_ids (
+                path TEXT PRIMARY KEY,
+                mtime_ns INTEGER NOT NULL,
+                size INTEGER NOT NULL,
+                file_id TEXT NOT NULL
+            )
+        """)
+        self.conn.commit()
+
+    def close(self):
+        self.conn.close()
+
+    @staticmethod
+    def _stat(path):
+        st = os.stat(path)
+        return st.st_mtime_ns, st.st_size
+
+    def get(self, path):
+        try:
+            mtime_ns, size = self._stat(path)
+        except FileNotFoundError:
+            return None
+        row = self.conn.execute(
+            "SELECT file_id FROM file_ids WHERE path = ? AND mtime_ns = ? AND size = ?", (path, mtime_ns, size)
+        ).fetchone()
+        return row[0] if row else None
+
+    def put_many(self, items):
+        """items: [(path, file_id)]."""
+        rows = []
+        for path, file_id in items:
+            try:
+                rows.append((path, *self._stat(path), file_id))
+            except FileNotFoundError:
+                continue
+        with self.conn:
+            self.conn.executemany(
+                "INSERT OR REPLACE INTO file_ids (path, mtime_ns, size, file_id) VALUES (?, ?, ?, ?)", rows
+            )
+
+    def delete_many(self, paths):
+        """Забывает file_id фото (например, Telegram больше не принимает их)."""
+        with self.conn:
+            self.conn.executemany("DELETE FROM file_ids WHERE path = ?", [(path,) for path in paths])
+
+
+class TokenBucket:
+    """Ограничитель скорости: rate токенов в секунду, не больше capacity подряд."""
+    def __init__(self, rate=SEND_RATE, capacity=SEND_BURST):
+        self.rate = rate
+        self.capacity = capacity
+        self._tokens = float(capacity)
+        self._updated = time.monotonic()
+        self._lock = asyncio.Lock()
+
+    async def acquire(self, tokens=1):
+        tokens = min(tokens, self.capacity)
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                if self._tokens >= tokens:
+                    self._tokens -= tokens
+                    return
+                await asyncio.sleep((tokens - self._tokens) / self.rate)
+
+
+def _retry_seconds(error):
+    """RetryAfter.retry_after — число секунд или timedelta (в новых версиях python-telegram-bot)."""
+    retry_after = error.retry_after
+    return retry_after.total_seconds() if hasattr(retry_after, "total_seconds") else float(retry_after)
+
+
+class PhotoSender:
+    """
+    Отправка альбома пользователю документами (без пережатия):
+    - медиагруппами по MEDIA_GROUP_SIZE;
+    - уже загруженные фото отправляются по file_id из FileIdCache, без повторной загрузки байтов;
+    - общий TokenBucket и семафор ограничивают скорость и число одновременных отправок,
+      при RetryAfter отправка повторяется после указанной паузы;
+    - если Telegram отклоняет сохранённый file_id (BadRequest), он удаляется из кэша и фото загружаются заново.
+    """
+    def __init__(self, cache, rate=SEND_RATE, burst=SEND_BURST, max_concurrent=MAX_CONCURRENT_SENDS,
+                 max_retries=MAX_RETRIES):
+        self.cache = cache
+        self.bucket = TokenBucket(rate, burst)
+        self.max_retries = max_retries
+        self._semaphore = asyncio.Semaphore(max_concurrent)
+
+    async def send_album(self, bot, chat_id, photo_paths):
+        """Отправляет фото по порядку. Возвращает число доставленных фото."""
+        sent = 0
+        for start in range(0, len(photo_paths), MEDIA_GROUP_SIZE):
+            chunk = photo_paths[start:start + MEDIA_GROUP_SIZE]
+            try:
+                sent += await self._send_chunk(bot, chat_id, chunk)
+            except Exception as e:
+                logger.error(f"Ошибка при отправке {len(chunk)} фото в чат {chat_id}: {e}")
+        return sent
+
+    async def send_photo(self, bot, chat_id, path, caption=None):
+        """Отправляет одно фото со сжатием Telegram (превью альбома). Возвращает True при успехе."""
+        async def send():
+            with ExitStack() as files:
+                photo = self.cache.get(path) or files.enter_context(open(path, "rb"))
+                return await bot.send_photo(chat_id, photo, caption=caption)
+
+        try:
+            async with self._semaphore:
+                message = await self._with_retry(chat_id, 1, send, paths=[path])
+        except Exception as e:
+            logger.error(f"Ошибка при отправке {path} в чат {chat_id}: {e}")
+            return False
+        if message.photo:
+            self.cache.put_many([(path, message.photo[-1].file_id)])
+        return True
+
+    async def _with_retry(self, chat_id, tokens, send, paths=()):
+        """
+        Выполняет send() с ограничением скорости и повторами при RetryAfter и сетевых ошибках.
+        BadRequest при отправке фото paths с сохранёнными file_id (неверный или устаревший идентификатор)
+        удаляет их из кэша и повторяет send() один раз — уже с загрузкой файлов; остальные BadRequest не повторяются.
+        """
+        for attempt in range(self.max_retries + 1):
+            await self.bucket.acquire(tokens)
+            try:
+                return await send()
+            except BadRequest as e:
+                # -- «wrong file identifier», «file reference expired» и т. п.; остальные ошибки — не из-за кэша
+                stale = [path for path in paths if self.cache.get(path) is not None] if "file" in e.message.lower() else []
+                if not stale or attempt == self.max_retries:
+                    raise
+                self.cache.delete_many(stale)
+                metrics.inc("telegram_retries", reason="stale_file_id")
+                logger.info(f"♻️ Telegram не принял file_id ({e.message}), загружаем {len(stale)} фото в чат {chat_id} заново")
+            except RetryAfter as e:
+                if attempt == self.max_retries:
+                    raise
+                delay = _retry_seconds(e)
+                metrics.inc("telegram_retries", reason="retry_after")
+                logger.info(f"⏳ Telegram просит подождать {delay:.0f} с перед отправкой в чат {chat_id}")
+                await asyncio.sleep(delay)
+            except (TimedOut, NetworkError):
+                if attempt == self.max_retries:
+                    raise
+                metrics.inc("telegram_retries", reason="network")
+                await asyncio.sleep(2 ** attempt)
+
+    async def _send_chunk(self, bot, chat_id, chunk):
+        if metrics.enabled:
+            reused = sum(self.cache.get(path) is not None for path in chunk)
+            metrics.inc("telegram_files", reused, source="file_id")
+            metrics.inc("telegram_files", len(chunk) - reused, source="upload")
+        async with self._semaphore:
+            with metrics.timer("telegram_send"):
+                messages = await self._with_retry(chat_id, len(chunk), lambda: self._send_once(bot, chat_id, chunk),
+                                                  paths=chunk)
+
+        # -- запоминаем file_id загруженных документов для следующих отправок
+        self.cache.put_many(
+            (path, message.document.file_id)
+            for path, message in zip(chunk, messages) if message.document is not None
+        )
+        return len(messages)
+
+    async def _send_once(self, bot, chat_id, chunk):
+        with ExitStack() as files:
+            # -- file_id, если фото уже загружалось, иначе открытый файл
+            documents = [self.cache.get(path) or files.enter_context(open(path, "rb")) for path in chunk]
+
+            # -- медиагруппа должна содержать от 2 документов
+            if len(chunk) == 1:
+                return [await bot.send_document(chat_id, documents[0], filename=os.path.basename(chunk[0]))]
+            media = [
+                InputMediaDocument(document, filename=os.path.basename(path))
+                for path, document in zip(chunk, documents)
+            ]
+            return list(await bot.send_media_group(chat_id, media))
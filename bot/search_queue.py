@@ -0,0 +1,106 @@
+import asyncio
+import logging
+import functools
+from concurrent.futures import ThreadPoolExecutor
+import metrics
+
+logger = logging.getLogger(__name__)
+
+QUEUE_MAXSIZE = 64        # сколько запросов может ждать в очереди
+BATCH_MAX_SIZE = 8        # максимальный размер пакета для одного прогона моделей
+BATCH_WINDOW = 0.01       # сколько секунд ждём «попутные» запросы после первого
+
+
+class SearchQueue:
+    """
+    Очередь поиска по лицу вне event loop бота.
+    Запросы складываются в ограниченную asyncio-очередь; фоновая задача собирает
+    запросы, пришедшие в пределах BATCH_WINDOW, в один пакет и выполняет
+    search_engine.search_batch в отдельном потоке, не блокируя других пользователей.
+    """
+    def __init__(self, search_engine, maxsize=QUEUE_MAXSIZE, batch_max_size=BATCH_MAX_SIZE,
+                 batch_window=BATCH_WINDOW):
+        self.search_engine = search_engine
+        self.batch_max_size = batch_max_size
+        self.batch_window = batch_window
+
+        self._queue = asyncio.Queue(maxsize=maxsize)
+        # один поток: модели ONNX Runtime сами используют все ядра, параллельные прогоны только мешают
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="face-search")
+        self._task = None
+
+    def full(self):
+        """True, если новый запрос будет ждать освобождения места в очереди."""
+        return self._queue.full()
+
+    def qsize(self):
+        return self._queue.qsize()
+
+    def start(self):
+        """Запускает фоновую задачу сборки пакетов (вызывать внутри работающего event loop)."""
+        if self._task is None:
+            self._task = asyncio.get_running_loop().create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        self._executor.shutdown(wait=False)
+
+    async def search(self, image, key=None, event=None):
+        """
+        Ставит фото (путь или байты) в очередь и ждёт результат поиска.
+        key — ключ кэша результатов (file_unique_id фото в Telegram);
+        event — мероприятие пользователя (None — поиск по всем мероприятиям).
+        Если очередь заполнена, ожидает свободного места (backpressure).
+        """
+        future = asyncio.get_running_loop().create_future()
+        await self._queue.put((image, key, event, future))
+        metrics.set_gauge("queue_depth", self._queue.qsize(), queue="search")
+        return await future
+
+    async def _collect_batch(self):
+        """Ждёт первый запрос и добирает к нему попутные в пределах окна."""
+        batch = [await self._queue.get()]
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + self.batch_window
+
+        while len(batch) < self.batch_max_size:
+            timeout = deadline - loop.time()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(await asyncio.wait_for(self._queue.get(), timeout))
+            except asyncio.TimeoutError:
+                break
+
+        return batch
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = await self._collect_batch()
+            images = [image for image, _, _, _ in batch]
+            keys = [key for _, key, _, _ in batch]
+            events = [event for _, _, event, _ in batch]
+            logger.info(f"Поиск пакета из {len(batch)} фото (в очереди ещё {self._queue.qsize()})")
+            metrics.set_gauge("queue_depth", self._queue.qsize(), queue="search")
+            metrics.observe("search_batch_size", len(batch))
+
+            try:
+                results = await loop.run_in_executor(self._executor, functools.partial(
+                    self.search_engine.search_batch, images, keys, events=events))
+            except Exception as e:
+                logger.error(f"Ошибка пакетного поиска: {e}", exc_info=True)
+                for *_, future in batch:
+                    if not future.done():
+                        future.set_exception(e)
+                continue
+
+            for (*_, future), result in zip(batch, results):
+                if not future.done():
+                    future.set_result(result)
@@ -0,0 +1,107 @@
+# альбомы пользователей: список фото из метаданных кластеров и (опционально) папки-представления из ссылок
+import os
+import shutil
+import logging
+import metrics
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+RAW_DIR = "data/photos/raw_uploads"     # исходные фото
+USERS_DIR = "data/photos/users"         # папки-представления по пользователям
+PHOTO_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.gif', '.bmp', '.webp')
+LINK_MODES = ("hardlink", "symlink", "none")
+
+
+def photo_id_for(path):
+    """photo_id фото — имя файла без расширения (как у лиц из FaceDetector.analyze)."""
+    return os.path.splitext(os.path.basename(path))[0]
+
+
+def resolve_photo_path(photo_id, raw_dir=RAW_DIR):
+    """Ищет исходное фото по photo_id в raw_dir (для фото, чей путь не записан в метаданных)."""
+    for ext in PHOTO_EXTENSIONS:
+        path = os.path.join(raw_dir, f"{photo_id}{ext}")
+        if os.path.exists(path):
+            return path
+    return None
+
+
+def user_album(meta_store, user_id, raw_dir=RAW_DIR):
+    """
+    Пути к фото пользователя по метаданным кластера — без копий и без os.listdir.
+    Фото, которых уже нет на диске (например, legacy_*), пропускаются.
+    """
+    album = []
+    for photo_id, path in meta_store.photo_paths(user_id):
+        if path is None:
+            path = resolve_photo_path(photo_id, raw_dir)
+        if path is not None:
+            album.append(path)
+        elif not photo_id.startswith("legacy_"):
+            logger.error(f"Фото {photo_id} не найдено в {raw_dir}")
+    return album
+
+
+def _link(src, dst, mode):
+    """Жёсткая ссылка (при ошибке, например между разными дисками, — символическая)."""
+    if mode == "hardlink":
+        try:
+            os.link(src, dst)
+            return
+        except OSError:
+            pass
+    os.symlink(os.path.abspath(src), dst)
+
+
+def _prune_user_folders(meta_store, users_dir):
+    """Удаляет папки user_XXXXX, чьих user_id нет в метаданных."""
+    folders = {}
+    for name in os.listdir(users_dir):
+        suffix = name[len("user_"):]
+        if name.startswith("user_") and suffix.isdigit():
+            folders[int(suffix)] = os.path.join(users_dir, name)
+    existing = meta_store.counts(folders)
+    removed = [path for user_id, path in folders.items() if user_id not in existing]
+    for path in removed:
+        shutil.rmtree(path, ignore_errors=True)
+    if removed:
+        logger.info(f"Удалены папки {len(removed)} пользователей, которых больше нет в базе")
+
+
+@metrics.timed("user_folders")
+def sync_user_folders(meta_store, user_ids, users_dir=USERS_DIR, raw_dir=RAW_DIR, mode="hardlink"):
+    """
+    Обновляет папки users/user_XXXXX только для пользователей user_ids: вместо копий — ссылки на исходные фото,
+    поэтому место на диске почти не расходуется. Лишние файлы удаляются, старые копии заменяются ссылками.
+    Папки пользователей, которых больше нет в метаданных (слитые или опустевшие кластеры), удаляются целиком.
+    """
+    if mode == "none":
+        return
+    os.makedirs(users_dir, exist_ok=True)
+    _prune_user_folders(meta_store, users_dir)
+    existing = meta_store.counts(user_ids)
+
+    linked = 0
+    for user_id in user_ids:
+        if int(user_id) not in existing:
+            continue            # кластер удалён — его папку уже убрал _prune_user_folders
+        user_id = f"{int(user_id):05d}"
+        user_folder = os.path.join(users_dir, f"user_{user_id}")
+        os.makedirs(user_folder, exist_ok=True)
+
+        wanted = {os.path.basename(path): path for path in user_album(meta_store, user_id, raw_dir)}
+        for fname in os.listdir(user_folder):
+            dst = os.path.join(user_folder, fname)
+            src = wanted.get(fname)
+            if src is not None and os.path.exists(dst) and os.path.samefile(src, dst):
+                del wanted[fname]       # ссылка уже на месте
+            else:
+                os.remove(dst)          # фото ушло из кластера, битая ссылка или старая копия
+
+        for fname, src in wanted.items():
+            _link(src, os.path.join(user_folder, fname), mode)
+            linked += 1
+
+    metrics.inc("user_folder_links", linked)
+    logger.info(f"Папки {len(user_ids)} пользователей обновлены в {users_dir} (новых ссылок: {linked})")
@@ -0,0 +1,255 @@
+# кластеризация лиц: граф k ближайших соседей (точный или IVF, насыщенные строки добираются range_search) + компоненты связности
+import logging
+import numpy as np
+import faiss
+from scipy.sparse import coo_matrix
+from scipy.sparse.csgraph import connected_components
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+QUERY_BATCH = 16384    # лиц в одном вызове search
+RANGE_BATCH = 1024     # лиц в одном вызове range_search для насыщенных строк (у крупных кластеров ответы большие)
+MAX_DEGREE = 64        # сколько самых похожих соседей лица остаётся в графе (ограничивает память)
+EXACT_GRAPH_MAX = 2000     # до стольких лиц соседи ищутся точно (IndexFlatIP), дальше — по IVF
+GRAPH_NPROBE = 8       # ячеек IVF (из √n), просматриваемых при поиске соседей
+CW_ITERATIONS = 10     # итераций Chinese Whispers
+
+
+def _ann_index(emb_mat, nprobe=GRAPH_NPROBE):
+    """
+    IVF-Flat по лицам для поиска соседей в больших наборах: каждый запрос сравнивается не со всеми лицами,
+    а с ~nprobe/nlist из них. Обучается на каждом m-м лице (~40 лиц на ячейку).
+    """
+    n, dim = emb_mat.shape
+    nlist = int(np.sqrt(n))
+    train = np.ascontiguousarray(emb_mat[::max(1, n // (nlist * 40))], dtype=np.float32)
+
+    index = faiss.IndexIVFFlat(faiss.IndexFlatIP(dim), dim, nlist, faiss.METRIC_INNER_PRODUCT)
+    index.cp.niter = 10
+    index.train(train)
+    for start in range(0, n, QUERY_BATCH):
+        index.add(np.ascontiguousarray(emb_mat[start:start + QUERY_BATCH], dtype=np.float32))
+    index.nprobe = nprobe
+    return index
+
+
+def similarity_graph(emb_mat, threshold, max_degree=MAX_DEGREE, batch_size=QUERY_BATCH):
+    """
+    Разреженный граф сходства: рёбра (i, j, sim) с sim >= threshold и i < j, каждое по одному разу.
+    У каждого лица берутся max_degree самых похожих соседей среди всех лиц (k-NN), поэтому набор рёбер
+    не зависит от позиции лица на входе, а память растёт линейно с числом лиц.
+    До EXACT_GRAPH_MAX лиц соседи ищутся точно, в больших наборах — по IVF (_ann_index): O(n·√n) вместо O(n²).
+    Лицо, у которого все max_degree соседей выше порога (строка насыщена), могло потерять рёбра: для таких лиц
+    соседи выше порога добираются range_search по тому же индексу (_saturated_edges), поэтому ограничение
+    степени не разрывает кластеры.
+    """
+    n, dim = emb_mat.shape
+    if n > EXACT_GRAPH_MAX:
+        index = _ann_index(emb_mat)
+    else:
+        index = faiss.IndexFlatIP(dim)
+        index.add(np.ascontiguousarray(emb_mat, dtype=np.float32))
+    k = min(max_degree + 1, n)      # +1 — само лицо
+
+    src, dst, sims, saturated = [], [], [], []
+    for start in range(0, n, batch_size):
+        queries = np.ascontiguousarray(emb_mat[start:start + batch_size], dtype=np.float32)
+        D, I = index.search(queries, k)
+        rows = np.arange(start, start + len(queries), dtype=np.int64)[:, None]
+        other = (I >= 0) & (I != rows)
+        keep = other & (np.cumsum(other, axis=1) <= max_degree) & (D >= threshold)
+        src.append(np.broadcast_to(rows, I.shape)[keep])
+        dst.append(I[keep])
+        sims.append(D[keep])
+        saturated.append(rows[keep.sum(axis=1) >= max_degree, 0])
+
+    src, dst, sims = np.concatenate(src), np.concatenate(dst), np.concatenate(sims).astype(np.float32)
+    saturated = np.concatenate(saturated)
+    if len(saturated):
+        extra = _saturated_edges(index, emb_mat, saturated, src, dst, threshold)
+        logger.info(f"Граф сходства: у {len(saturated)} лиц больше {max_degree} соседей выше порога, "
+                    f"добавлено {len(extra[0])} рёбер между компонентами")
+        src, dst, sims = (np.concatenate([a, e]) for a, e in zip((src, dst, sims), extra))
+    # -- ребро могло прийти от обоих концов: оставляем одно (i < j) с наибольшим сходством
+    a, b = np.minimum(src, dst), np.maximum(src, dst)
+    order = np.lexsort((-sims, b, a))
+    a, b, sims = a[order], b[order], sims[order]
+    first = np.ones(len(a), dtype=bool)
+    first[1:] = (a[1:] != a[:-1]) | (b[1:] != b[:-1])
+    return a[first].astype(np.int32), b[first].astype(np.int32), sims[first]
+
+
+def _saturated_edges(index, emb_mat, rows, src, dst, threshold, batch_size=RANGE_BATCH):
+    """
+    Рёбра насыщенных лиц rows, которых нет в k-NN графе (src, dst): range_search выше порога по тому же индексу.
+    Остаются только рёбра между разными компонентами k-NN графа — только они меняют связность,
+    поэтому число рёбер не растёт квадратично с размером крупного кластера.
+    """
+    n = len(emb_mat)
+    _, comp = connected_components(coo_matrix((np.ones(len(src), dtype=np.int8), (src, dst)), shape=(n, n)),
+                                   directed=False)
+    extra_src, extra_dst, extra_sims = [], [], []
+    for start in range(0, len(rows), batch_size):
+        batch = rows[start:start + batch_size]
+        lims, D, I = index.range_search(np.ascontiguousarray(emb_mat[batch], dtype=np.float32), threshold)
+        owners = np.repeat(batch, np.diff(lims).astype(np.int64))
+        cross = (I >= 0) & (comp[I] != comp[owners])
+        extra_src.append(owners[cross])
+        extra_dst.append(I[cross])
+        extra_sims.append(D[cross])
+    return (np.concatenate(extra_src), np.concatenate(extra_dst).astype(np.int64),
+            np.concatenate(extra_sims).astype(np.float32))
+
+
+def _resolve_roots(parent):
+    """Корень каждого узла леса parent (векторно, удвоением шага)."""
+    parent = np.asarray(parent)
+    while True:
+        grand = parent[parent]
+        if np.array_equal(grand, parent):
+            return parent
+        parent = grand
+
+
+def constrained_components(n, src, dst, sims, photo_idx):
+    """
+    Компоненты связности без объединения двух лиц с одного фото.
+    Сначала — обычные компоненты (scipy, векторно). Компонента, где все лица с разных фото, окончательна.
+    Только внутри компонент с лицами одного фото рёбра проходятся union-find по убыванию сходства
+    (равные — по (min(i, j), max(i, j))), и слияние, дающее два лица одного фото, пропускается.
+    Сходства хранятся в float32, поэтому порядок рёбер определяется самими сходствами, а не округлением.
+    """
+    n_comp, comp = connected_components(coo_matrix((np.ones(len(src), dtype=np.int8), (src, dst)), shape=(n, n)),
+                                        directed=False)
+    n_photos = int(photo_idx.max()) + 1
+    distinct = np.bincount(np.unique(comp.astype(np.int64) * n_photos + photo_idx) // n_photos, minlength=n_comp)
+    conflicted = np.bincount(comp, minlength=n_comp) != distinct
+    if not conflicted.any():
+        return comp
+
+    # -- union-find только по рёбрам компонент с конфликтами
+    edges = np.flatnonzero(conflicted[comp[src]])
+    edges = edges[np.lexsort((dst[edges], src[edges], -sims[edges]))]
+    parent = list(range(n))
+    photos = {}     # корень → множество фото в компоненте (создаётся при первом слиянии)
+
+    def find(x):
+        root = x
+        while parent[root] != root:
+            root = parent[root]
+        while parent[x] != root:          # сжатие путей
+            parent[x], x = root, parent[x]
+        return root
+
+    for i, j in zip(src[edges].tolist(), dst[edges].tolist()):
+        ra, rb = find(i), find(j)
+        if ra == rb:
+            continue
+        pa = photos.get(ra) or {photo_idx[ra]}
+        pb = photos.get(rb) or {photo_idx[rb]}
+        if len(pa) < len(pb):
+            ra, rb, pa, pb = rb, ra, pb, pa
+        if not pa.isdisjoint(pb):
+            continue                       # в компонентах есть лица с одного фото
+        parent[rb] = ra
+        pa |= pb
+        photos[ra] = pa
+        photos.pop(rb, None)
+
+    roots = _resolve_roots(parent)
+    return np.where(conflicted[comp], n_comp + roots, comp)
+
+
+def chinese_whispers(n, src, dst, sims, labels, iterations=CW_ITERATIONS, seed=0):
+    """
+    Уточнение кластеров Chinese Whispers: лицо переходит в метку с наибольшим суммарным весом
+    рёбер среди соседей. Стартует с компонент связности. Веса по меткам считаются векторно для всех лиц сразу,
+    а применяются к случайной (seed) половине лиц за итерацию: одновременная смена меток у всех лиц
+    зацикливается на парах соседей, меняющихся метками. Останавливается, когда ни одна метка не меняется.
+    """
+    _, labels = np.unique(labels, return_inverse=True)
+    rows = np.concatenate([src, dst]).astype(np.int64)
+    cols = np.concatenate([dst, src]).astype(np.int64)
+    weights = np.concatenate([sims, sims]).astype(np.float64)
+
+    rng = np.random.default_rng(seed)
+    for _ in range(iterations):
+        # -- суммарный вес каждой метки у соседей каждого лица
+        keys, inverse = np.unique(rows * n + labels[cols], return_inverse=True)
+        totals = np.bincount(inverse, weights=weights)
+        key_rows, key_labels = keys // n, keys % n
+        # -- лучшая метка лица: наибольший вес, при равенстве — меньшая метка
+        order = np.lexsort((key_labels, -totals, key_rows))
+        key_rows, key_labels = key_rows[order], key_labels[order]
+        first = np.ones(len(key_rows), dtype=bool)
+        first[1:] = key_rows[1:] != key_rows[:-1]
+        nodes, best = key_rows[first], key_labels[first]
+
+        moving = labels[nodes] != best
+        if not moving.any():
+            break
+        active = rng.random(len(nodes)) < 0.5
+        labels[nodes[moving & active]] = best[moving & active]
+    return labels
+
+
+def split_same_photo(labels, photo_idx, emb_mat):
+    """
+    Если в кластере несколько лиц с одного фото, остаётся самое похожее на центр кластера,
+    остальные выделяются в отдельные кластеры.
+    """
+    labels = labels.copy()
+    next_label = labels.max() + 1
+    order = np.lexsort((photo_idx, labels))
+    sorted_labels, sorted_photos = labels[order], photo_idx[order]
+    dup = np.flatnonzero((sorted_labels[1:] == sorted_labels[:-1]) & (sorted_photos[1:] == sorted_photos[:-1]))
+    for label in np.unique(sorted_labels[dup]):
+        members = np.flatnonzero(labels == label)
+        centre = emb_mat[members].mean(axis=0)
+        score = emb_mat[members] @ centre
+        seen = set()
+        for m in members[np.argsort(-score)]:
+            if photo_idx[m] in seen:
+                labels[m] = next_label
+                next_label += 1
+            else:
+                seen.add(photo_idx[m])
+    return labels
+
+
+def cluster_faces(emb_mat, photo_ids, threshold, refine=None, max_degree=MAX_DEGREE):
+    """
+    Кластеризация нормализованных эмбеддингов:
+    граф сходства (k ближайших соседей выше порога) → компоненты связности с запретом «два лица с одного фото»
+    → (опционально) уточнение refine="chinese_whispers".
+    Возвращает метки 0..k-1, пронумерованные по первому появлению лица.
+    Разбиение не зависит от порядка лиц на входе: внутри лица упорядочиваются по байтам эмбеддинга,
+    поэтому FAISS (в т. ч. округление в BLAS и ячейки IVF) и union-find видят одни и те же данные.
+    """
+    n = len(emb_mat)
+    if n == 0:
+        return np.empty(0, dtype=np.int64)
+
+    emb_mat = np.ascontiguousarray(emb_mat, dtype=np.float32)
+    canonical = np.argsort(emb_mat.view(np.dtype((np.void, emb_mat.shape[1] * 4))).ravel(), kind="stable")
+    emb_mat = emb_mat[canonical]
+    _, photo_idx = np.unique(np.asarray(photo_ids, dtype=object).astype(str), return_inverse=True)
+    photo_idx = photo_idx[canonical]
+
+    src, dst, sims = similarity_graph(emb_mat, threshold, max_degree=max_degree)
+    logger.info(f"Граф сходства: {n} лиц, {len(src)} рёбер (порог {threshold})")
+
+    labels = constrained_components(n, src, dst, sims, photo_idx)
+    if refine == "chinese_whispers":
+        labels = chinese_whispers(n, src, dst, sims, labels)
+        labels = split_same_photo(labels, photo_idx, emb_mat)
+    elif refine is not None:
+        raise ValueError(f"Неизвестный режим уточнения кластеров: {refine}")
+
+    labels[canonical] = labels.copy()      # обратно в порядок лиц на входе
+    # перенумеровываем метки по первому появлению (user_id идут в порядке лиц)
+    _, first, inverse = np.unique(labels, return_index=True, return_inverse=True)
+    rank = np.empty(len(first), dtype=np.int64)
+    rank[np.argsort(first)] = np.arange(len(first))
+    return rank[inverse]
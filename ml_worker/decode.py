@@ -0,0 +1,195 @@
+# декодирование фото для детекции: уменьшенное JPEG-декодирование и предзагрузка в фоне
+import os
+import io
+import struct
+import logging
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import cv2
+import metrics
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+DETECTION_MIN_SIDE = 1600   # длинная сторона уменьшенного изображения не меньше этого (детектор всё равно сжимает до 640)
+PREFETCH = 4                # сколько следующих фото декодируется заранее
+DECODE_THREADS = 2          # потоков декодирования (cv2 отпускает GIL)
+
+# флаги DCT-масштабирования libjpeg: картинка сразу декодируется в 1/2, 1/4 или 1/8 размера
+REDUCED_FLAGS = {
+    8: cv2.IMREAD_REDUCED_COLOR_8,
+    4: cv2.IMREAD_REDUCED_COLOR_4,
+    2: cv2.IMREAD_REDUCED_COLOR_2,
+}
+
+# маркеры SOF, в которых лежат размеры JPEG
+_SOF_MARKERS = {0xC0, 0xC1, 0xC2, 0xC3, 0xC5, 0xC6, 0xC7, 0xC9, 0xCA, 0xCB, 0xCD, 0xCE, 0xCF}
+
+
+def jpeg_size(path):
+    """
+    Читает (width, height) из заголовка JPEG без декодирования. Для не-JPEG возвращает None.
+    """
+    try:
+        with open(path, "rb") as f:
+            return _read_jpeg_size(f)
+    except (OSError, struct.error):
+        return None
+
+
+def _read_jpeg_size(f):
+    if f.read(2) != b"\xff\xd8":
+        return None
+    while True:
+        byte = f.read(1)
+        while byte and byte != b"\xff":
+            byte = f.read(1)
+        code = f.read(1)
+        while code == b"\xff":     # байты-заполнители
+            code = f.read(1)
+        if not code:
+            return None
+        code = code[0]
+        if code == 0x01 or 0xD0 <= code <= 0xD8:   # маркеры без длины
+            continue
+        seg_len = struct.unpack(">H", f.read(2))[0]
+        if code in _SOF_MARKERS:
+            height, width = struct.unpack(">xHH", f.read(5))
+            return width, height
+        f.seek(seg_len - 2, os.SEEK_CUR)
+
+
+def choose_reduction(size, min_side=DETECTION_MIN_SIDE):
+    """
+    Максимальный коэффициент уменьшения (8, 4, 2 или 1), при котором длинная сторона >= min_side.
+    """
+    if size is None:
+        return 1
+    long_side = max(size)
+    for factor in (8, 4, 2):
+        if long_side // factor >= min_side:
+            return factor
+    return 1
+
+
+def detail_reduction(scale, face_size, min_face_size):
+    """
+    Коэффициент уменьшения (меньше scale), при котором лицо размером face_size пикселей в фото,
+    уменьшенном в scale раз, занимает не меньше min_face_size. 1 — нужен оригинал.
+    """
+    for factor in (4, 2):
+        if factor < scale and face_size * scale / factor >= min_face_size:
+            return factor
+    return 1
+
+
+class DecodedImage:
+    """
+    Фото, декодированное для детекции.
+    image — уменьшенное в scale раз изображение; reduced(factor) декодирует фото заново в меньшем
+    уменьшении (нужно для распознавания мелких лиц, чтобы не терять точность эмбеддингов),
+    full() лениво декодирует оригинал.
+    Ориентация из EXIF применяется OpenCV при любом варианте декодирования.
+    data — закодированное фото в памяти, если оно не читалось с диска (path=None).
+    """
+    def __init__(self, path, image, scale=1, data=None):
+        self.path = path
+        self.image = image
+        self.scale = scale
+        self.data = data
+        self._full = image if scale == 1 else None
+
+    def full(self):
+        if self._full is None:
+            if self.data is not None:
+                self._full = cv2.imdecode(self.data, cv2.IMREAD_COLOR)
+            else:
+                self._full = cv2.imread(self.path, cv2.IMREAD_COLOR)
+        return self._full
+
+    def reduced(self, factor):
+        """
+        Фото, уменьшенное в factor раз (DCT-масштабирование). Не кэшируется: нужно только на время
+        выравнивания мелких лиц, а полный размер не держится в памяти.
+        """
+        if factor == self.scale:
+            return self.image
+        if factor == 1:
+            return self.full()
+        flags = REDUCED_FLAGS[factor]
+        with metrics.timer("decode_detail"):
+            if self.data is not None:
+                return cv2.imdecode(self.data, flags)
+            return cv2.imread(self.path, flags)
+
+
+def decode_image(path, min_side=DETECTION_MIN_SIDE):
+    """
+    Декодирует фото в уменьшенном разрешении, достаточном для детекции.
+    Для JPEG используется DCT-масштабирование (IMREAD_REDUCED_*), остальные форматы читаются целиком.
+    Возвращает DecodedImage или None, если файл не читается.
+    """
+    with metrics.timer("decode"):
+        factor = choose_reduction(jpeg_size(path), min_side) if path.lower().endswith(('.jpg', '.jpeg')) else 1
+        flags = REDUCED_FLAGS.get(factor, cv2.IMREAD_COLOR)
+        img = cv2.imread(path, flags)
+    if img is None:
+        logger.error(f"Не удалось прочитать {path}")
+        return None
+    return DecodedImage(path, img, scale=factor)
+
+
+def decode_bytes(data, min_side=DETECTION_MIN_SIDE):
+    """
+    То же, что decode_image, но для фото в памяти (например, скачанного из Telegram) — без временного файла.
+    Возвращает DecodedImage (path=None) или None, если данные не декодируются.
+    """
+    buf = np.frombuffer(data, dtype=np.uint8)
+    with metrics.timer("decode"):
+        try:
+            factor = choose_reduction(_read_jpeg_size(io.BytesIO(buf)), min_side)
+        except struct.error:
+            factor = 1
+        img = cv2.imdecode(buf, REDUCED_FLAGS.get(factor, cv2.IMREAD_COLOR))
+    if img is None:
+        logger.error(f"Не удалось декодировать изображение из памяти ({len(buf)} байт)")
+        return None
+    return DecodedImage(None, img, scale=factor, data=buf)
+
+
+class ImagePrefetcher:
+    """
+    Итератор по фото, который декодирует следующие prefetch файлов в фоновых потоках,
+    пока основной поток занят инференсом. Порядок совпадает с порядком paths.
+    Выдаёт пары (path, DecodedImage или None).
+    paths может быть и ленивым итератором (например, очередью только что скачанных файлов).
+    """
+    def __init__(self, paths, prefetch=PREFETCH, threads=DECODE_THREADS, min_side=DETECTION_MIN_SIDE):
+        self.paths = paths
+        self.prefetch = max(1, prefetch)
+        self.threads = threads
+        self.min_side = min_side
+
+    def __iter__(self):
+        with ThreadPoolExecutor(max_workers=self.threads, thread_name_prefix="decode") as executor:
+            pending = deque()
+            paths = iter(self.paths)
+
+            def submit_next():
+                path = next(paths, None)
+                if path is not None:
+                    pending.append((path, executor.submit(decode_image, path, self.min_side)))
+
+            for _ in range(self.prefetch):
+                submit_next()
+
+            while pending:
+                path, future = pending.popleft()
+                submit_next()
+                try:
+                    decoded = future.result()
+                except Exception as e:
+                    logger.error(f"Ошибка декодирования {path}: {e}")
+                    decoded = None
+                yield path, decoded
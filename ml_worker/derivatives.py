@@ -0,0 +1,248 @@
+# производные для выдачи альбома: превью-сетка и ZIP-архивы пользователя с кэшированием
+import os
+import glob
+import json
+import hashlib
+import logging
+import zipfile
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import cv2
+from decode import decode_image
+import metrics
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+DERIVATIVES_DIR = "data/photos/derivatives"   # превью и архивы по пользователям
+THUMB_SIZE = 256              # сторона квадратной миниатюры в превью
+GRID_COLUMNS = 6
+PREVIEW_MAX_PHOTOS = 36       # сколько фото попадает в превью-сетку
+PREVIEW_QUALITY = 80          # качество JPEG превью
+ARCHIVE_PART_MAX = 45 * 2 ** 20   # размер части архива (лимит Bot API на документ — 50 МБ)
+DERIVATIVE_THREADS = 4        # потоков сборки превью (cv2 отпускает GIL)
+
+
+def album_fingerprint(photo_paths):
+    """Отпечаток альбома: пути, размеры и mtime фото. Меняется только вместе с составом кластера или файлами."""
+    h = hashlib.sha1()
+    for path in photo_paths:
+        try:
+            st = os.stat(path)
+            h.update(f"{path}\0{st.st_size}\0{st.st_mtime_ns}\n".encode())
+        except FileNotFoundError:
+            h.update(f"{path}\0missing\n".encode())
+    return h.hexdigest()[:16]
+
+
+def user_dir(user_id, derivatives_dir=DERIVATIVES_DIR):
+    return os.path.join(derivatives_dir, f"user_{int(user_id):05d}")
+
+
+def preview_path(user_id, fingerprint, derivatives_dir=DERIVATIVES_DIR):
+    return os.path.join(user_dir(user_id, derivatives_dir), f"preview_{fingerprint}.jpg")
+
+
+def _tmp_path(path, suffix=".tmp"):
+    """Уникальный временный файл рядом с path: параллельные потоки и процессы не пишут в один и тот же файл."""
+    with tempfile.NamedTemporaryFile(dir=os.path.dirname(path) or ".", prefix=os.path.basename(path) + ".",
+                                     suffix=suffix, delete=False) as f:
+        return f.name
+
+
+def _write_jpeg(out_path, img):
+    """JPEG через временный файл и os.replace: читатель видит либо старый файл, либо новый целиком."""
+    tmp_path = _tmp_path(out_path, suffix=".tmp.jpg")
+    try:
+        if not cv2.imwrite(tmp_path, img, [cv2.IMWRITE_JPEG_QUALITY, PREVIEW_QUALITY]):
+            raise OSError(f"cv2.imwrite не записал {tmp_path}")
+        os.replace(tmp_path, out_path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+
+def _arcnames(paths):
+    """
+    Имена файлов внутри архива: basename, а для одноимённых фото из разных папок — с номером (a_2.jpg).
+    Уникальны по всему альбому, чтобы части можно было распаковать в одну папку.
+    """
+    names, used = {}, set()
+    for path in paths:
+        name = os.path.basename(path)
+        stem, ext = os.path.splitext(name)
+        n = 1
+        while name.lower() in used:
+            n += 1
+            name = f"{stem}_{n}{ext}"
+        used.add(name.lower())
+        names[path] = name
+    return names
+
+
+def _write_zip(out_path, paths, arcnames):
+    """Часть архива через временный файл: при ошибке недописанный .tmp удаляется."""
+    tmp_path = _tmp_path(out_path)
+    try:
+        # -- JPEG уже сжат, поэтому файлы кладутся без сжатия (ZIP_STORED)
+        with zipfile.ZipFile(tmp_path, "w", compression=zipfile.ZIP_STORED) as zf:
+            for path in paths:
+                zf.write(path, arcname=arcnames[path])
+        os.replace(tmp_path, out_path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+
+def _thumbnail(path, thumbs_dir):
+    """
+    Квадратная миниатюра фото; кэшируется в thumbs/ и пересобирается, только если исходник новее.
+    Имя — хэш полного пути: a.jpg и a.png или одноимённые фото из разных папок не затирают друг друга.
+    """
+    thumb_name = hashlib.sha1(os.path.abspath(path).encode()).hexdigest()[:20] + ".jpg"
+    thumb_path = os.path.join(thumbs_dir, thumb_name)
+    try:
+        if os.path.getmtime(thumb_path) >= os.path.getmtime(path):
+            thumb = cv2.imread(thumb_path, cv2.IMREAD_COLOR)
+            if thumb is not None:
+                return thumb
+    except FileNotFoundError:
+        pass
+
+    decoded = decode_image(path, min_side=THUMB_SIZE * 2)    # для JPEG — сразу уменьшенное декодирование
+    if decoded is None:
+        return None
+    img = decoded.image
+    h, w = img.shape[:2]
+    side = min(h, w)
+    top, left = (h - side) // 2, (w - side) // 2
+    thumb = cv2.resize(img[top:top + side, left:left + side], (THUMB_SIZE, THUMB_SIZE), interpolation=cv2.INTER_AREA)
+    _write_jpeg(thumb_path, thumb)
+    return thumb
+
+
+def build_preview(user_id, photo_paths, derivatives_dir=DERIVATIVES_DIR):
+    """
+    Превью-сетка первых PREVIEW_MAX_PHOTOS фото пользователя одним JPEG.
+    Если превью для текущего отпечатка альбома уже есть — ничего не делает. Возвращает путь к превью.
+    """
+    fingerprint = album_fingerprint(photo_paths)
+    out_path = preview_path(user_id, fingerprint, derivatives_dir)
+    if os.path.exists(out_path):
+        return out_path
+
+    thumbs_dir = os.path.join(derivatives_dir, "thumbs")
+    os.makedirs(thumbs_dir, exist_ok=True)
+    thumbs = [t for t in (_thumbnail(p, thumbs_dir) for p in photo_paths[:PREVIEW_MAX_PHOTOS]) if t is not None]
+    if not thumbs:
+        return None
+
+    columns = min(GRID_COLUMNS, len(thumbs))
+    rows = (len(thumbs) + columns - 1) // columns
+    grid = np.full((rows * THUMB_SIZE, columns * THUMB_SIZE, 3), 255, dtype=np.uint8)
+    for i, thumb in enumerate(thumbs):
+        r, c = divmod(i, columns)
+        grid[r * THUMB_SIZE:(r + 1) * THUMB_SIZE, c * THUMB_SIZE:(c + 1) * THUMB_SIZE] = thumb
+
+    folder = user_dir(user_id, derivatives_dir)
+    os.makedirs(folder, exist_ok=True)
+    _write_jpeg(out_path, grid)
+    _remove_stale(folder, fingerprint)
+    return out_path
+
+
+def _remove_stale(folder, fingerprint):
+    """Удаляет превью и архивы прежних версий альбома."""
+    for path in glob.glob(os.path.join(folder, "*")):
+        name = os.path.basename(path)
+        if fingerprint not in name and ".tmp" not in name:      # временные файлы соседних сборок не трогаем
+            try:
+                os.remove(path)
+            except OSError as e:
+                logger.error(f"Не удалось удалить устаревший файл {path}: {e}")
+
+
+@metrics.timed("previews")
+def build_previews(meta_store, user_ids, album_fn, derivatives_dir=DERIVATIVES_DIR, threads=DERIVATIVE_THREADS):
+    """
+    Параллельно собирает превью для пользователей user_ids (обычно — изменённых в этом запуске).
+    album_fn(meta_store, user_id) → пути к фото пользователя. Миниатюры прошлых запусков переиспользуются.
+    """
+    albums = {int(u): album_fn(meta_store, u) for u in user_ids}
+
+    def build(item):
+        user_id, photo_paths = item
+        try:
+            return build_preview(user_id, photo_paths, derivatives_dir) is not None
+        except Exception as e:
+            logger.error(f"Ошибка при сборке превью пользователя {user_id}: {e}", exc_info=True)
+            return False
+
+    with ThreadPoolExecutor(max_workers=threads, thread_name_prefix="preview") as executor:
+        built = sum(executor.map(build, albums.items()))
+    logger.info(f"🖼 Превью обновлены для {built} из {len(albums)} пользователей")
+
+
+@metrics.timed("archive")
+def archive_paths(user_id, photo_paths, derivatives_dir=DERIVATIVES_DIR):
+    """
+    ZIP-архивы альбома (частями до ARCHIVE_PART_MAX). Собираются лениво при первом запросе
+    и переиспользуются, пока альбом не изменится. Возвращает пути к частям.
+    """
+    fingerprint = album_fingerprint(photo_paths)
+    folder = user_dir(user_id, derivatives_dir)
+    # -- список частей пишется последним: по нему видно, что архив собран целиком
+    index_path = os.path.join(folder, f"album_{fingerprint}.json")
+    try:
+        with open(index_path, "r", encoding="utf-8") as f:
+            existing = [os.path.join(folder, name) for name in json.load(f)]
+        if all(os.path.exists(path) for path in existing):
+            return existing
+    except (FileNotFoundError, ValueError):
+        pass
+
+    os.makedirs(folder, exist_ok=True)
+
+    # -- раскладываем фото по частям с учётом размера
+    parts, current, current_size = [], [], 0
+    for path in photo_paths:
+        if not os.path.exists(path):
+            continue
+        size = os.path.getsize(path)
+        if current and current_size + size > ARCHIVE_PART_MAX:
+            parts.append(current)
+            current, current_size = [], 0
+        current.append(path)
+        current_size += size
+    if current:
+        parts.append(current)
+
+    arcnames = _arcnames(path for part in parts for path in part)
+    result = []
+    for i, part in enumerate(parts, 1):
+        out_path = os.path.join(folder, f"album_{fingerprint}_part{i:03d}.zip")
+        _write_zip(out_path, part, arcnames)
+        result.append(out_path)
+
+    tmp_path = _tmp_path(index_path)
+    try:
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump([os.path.basename(path) for path in result], f)
+        os.replace(tmp_path, index_path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+    logger.info(f"🗜 Архив альбома пользователя {int(user_id):05d}: {len(photo_paths)} фото, частей: {len(result)}")
+    return result
+
+
+def prune_users(user_ids, derivatives_dir=DERIVATIVES_DIR):
+    """Удаляет производные пользователей, которых больше нет (после перекластеризации)."""
+    keep = {os.path.basename(user_dir(u, derivatives_dir)) for u in user_ids}
+    for folder in glob.glob(os.path.join(derivatives_dir, "user_*")):
+        if os.path.basename(folder) not in keep:
+            for path in glob.glob(os.path.join(folder, "*")):
+                os.remove(path)
+            os.rmdir(folder)
@@ -1,82 +1,367 @@
 import os
+import glob
+import time
+import hashlib
+import platform
 import cv2
 import numpy as np
 import traceback
 import logging
-from insightface.app import FaceAnalysis
-from insightface.utils import face_align
+from decode import DecodedImage, decode_image, detail_reduction
+from quality import QualityGate, load_quality_config
+from model_profile import profile_models
+import metrics
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+REC_BATCH_SIZE = 32   # максимальный батч выровненных лиц для модели распознавания
+REC_MIN_FACE_SIZE = 112   # лица меньше этого (в уменьшенном фото) распознаются по фото, декодированному крупнее
+
+# модули buffalo_l, которые нужны пайплайну (genderage и landmark_2d_106 не используются)
+FULL_MODULES = ["detection", "landmark_3d_68", "recognition"]   # pose считается по landmark_3d_68
+DETECTION_MODULES = ["detection"]
+MODEL_PACK = "buffalo_l"
+MODEL_ROOT = "~/.insightface"     # где insightface хранит (и при первом запуске скачивает) модели
+
+# оптимизированные графы ONNX Runtime: строятся при первом запуске и переиспользуются при следующих
+ORT_CACHE_ENV = "PHOTOFINDER_ORT_CACHE"   # папка кэша или off
+ORT_CACHE_DIR = "data/models/ort_cache"
+WARMUP_SIZE = 640                 # сторона пустого кадра для прогревочного прогона
+
+
+def _ort_cache_path(model_file, providers, cache_dir):
+    """
+    Путь к оптимизированной копии модели. Ключ — файл модели (размер, mtime), версия ONNX Runtime,
+    провайдеры и архитектура: после обновления чего-либо из этого граф строится заново.
+    """
+    import onnxruntime
+
+    stat = os.stat(model_file)
+    key = "|".join([os.path.abspath(model_file), str(stat.st_size), str(stat.st_mtime_ns),
+                    onnxruntime.__version__, ",".join(providers), platform.machine()])
+    name = os.path.splitext(os.path.basename(model_file))[0]
+    return os.path.join(cache_dir, f"{name}.{hashlib.sha1(key.encode()).hexdigest()[:12]}.onnx")
+
+
+def create_session(model_file, providers, intra_op_threads=None, cache_dir=None):
+    """
+    ONNX-сессия модели с кэшем оптимизированного графа.
+    Первый запуск сохраняет граф после оптимизаций уровня EXTENDED (слияние операций, свёртка констант)
+    через SessionOptions.optimized_model_filepath; следующие загружают уже оптимизированную копию.
+    Уровень ALL не сохраняется: его раскладки (NCHWc) зависят от процессора, они применяются при загрузке.
+    cache_dir — папка кэша (по умолчанию PHOTOFINDER_ORT_CACHE или ORT_CACHE_DIR), "off" — без кэша.
+    """
+    import onnxruntime
+
+    def session(path, level, save_path=None):
+        sess_options = onnxruntime.SessionOptions()
+        sess_options.graph_optimization_level = level
+        if intra_op_threads is not None:
+            sess_options.intra_op_num_threads = intra_op_threads
+            sess_options.inter_op_num_threads = 1
+        if save_path is not None:
+            sess_options.optimized_model_filepath = save_path
+        return onnxruntime.InferenceSession(path, sess_options=sess_options, providers=providers)
+
+    levels = onnxruntime.GraphOptimizationLevel
+    cache_dir = os.getenv(ORT_CACHE_ENV, ORT_CACHE_DIR) if cache_dir is None else cache_dir
+    if not cache_dir or cache_dir == "off":
+        return session(model_file, levels.ORT_ENABLE_ALL)
+
+    cached = _ort_cache_path(model_file, providers, cache_dir)
+    if os.path.exists(cached):
+        try:
+            return session(cached, levels.ORT_ENABLE_ALL)
+        except Exception as e:
+            # -- повреждённый или несовместимый файл: строим граф заново
+            logger.warning(f"Кэш оптимизированной модели {cached} не загрузился ({e}), пересоздаю")
+
+    # -- граф пишется во временный файл: процессы пула, стартующие одновременно, не видят его недописанным
+    os.makedirs(cache_dir, exist_ok=True)
+    tmp_path = f"{cached}.{os.getpid()}.tmp"
+    try:
+        session(model_file, levels.ORT_ENABLE_EXTENDED, save_path=tmp_path)
+        os.replace(tmp_path, cached)
+    except Exception as e:
+        logger.warning(f"Не удалось сохранить оптимизированный граф {model_file}: {e}")
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        return session(model_file, levels.ORT_ENABLE_ALL)
+    logger.info(f"🗃️ Оптимизированный граф {os.path.basename(model_file)} сохранён: {cached}")
+    return session(cached, levels.ORT_ENABLE_ALL)
+
+
+def load_models(allowed_modules, providers, intra_op_threads=None, name=MODEL_PACK, root=MODEL_ROOT,
+                replacements=None):
+    """
+    Модели пакета insightface (как FaceAnalysis), но сессии создаются один раз — сразу с нужными
+    провайдерами, потоками и кэшем графа (create_session). FaceAnalysis создаёт сессию каждой модели
+    с провайдерами по умолчанию, а prepare(ctx_id=-1) пересоздаёт её для CPU — граф оптимизируется дважды.
+    replacements — {имя файла пакета: путь к другой версии модели} (квантованные модели профиля int8):
+    сессия создаётся по замене, а нормализация входа по-прежнему определяется по исходному файлу.
+    Возвращает {taskname: модель}.
+    """
+    import onnxruntime
+    from insightface.utils import ensure_available
+    from insightface.model_zoo.model_zoo import RetinaFace, Landmark, ArcFaceONNX
+
+    onnxruntime.set_default_logger_severity(3)
+    models = {}
+    for model_file in sorted(glob.glob(os.path.join(ensure_available("models", name, root=root), "*.onnx"))):
+        session = create_session((replacements or {}).get(os.path.basename(model_file), model_file),
+                                 providers, intra_op_threads)
+        # -- та же маршрутизация по входам и выходам, что в insightface.model_zoo.ModelRouter
+        inputs = session.get_inputs()
+        input_shape = inputs[0].shape
+        if len(session.get_outputs()) >= 5:
+            model = RetinaFace(model_file=model_file, session=session)
+        elif input_shape[2] == 192 and input_shape[3] == 192:
+            model = Landmark(model_file=model_file, session=session)
+        elif len(inputs) == 1 and input_shape[2] == input_shape[3] and input_shape[2] >= 112 and input_shape[2] % 16 == 0:
+            model = ArcFaceONNX(model_file=model_file, session=session)
+        else:
+            continue    # genderage и прочие модели пакета пайплайну не нужны
+        if model.taskname in allowed_modules and model.taskname not in models:
+            models[model.taskname] = model
+    if "detection" not in models:
+        raise RuntimeError(f"В пакете моделей {name} нет детектора лиц")
+    return models
+
+
 class FaceDetector:
-    def __init__(self, device="cpu", yaw_threshold=30):
+    def __init__(self, device="cpu", yaw_threshold=None, detection_only=False, intra_op_threads=None,
+                 quality_config=None, profile=None, model_files=None):
         """
         RetinaFace (из insightface) для детекции лиц.
         Работает на CPU, если device="cpu".
+        detection_only=True загружает только детектор (без pose и эмбеддингов).
+        intra_op_threads — число потоков ONNX Runtime на одну модель
+        (по умолчанию ORT занимает все ядра; при нескольких процессах-воркерах нужно делить ядра).
+        quality_config — пороги фильтра качества (quality.py, по умолчанию — load_quality_config());
+        лица, не прошедшие фильтр, не распознаются и не возвращаются. yaw_threshold переопределяет max_yaw.
+        profile — профиль моделей (model_profile.py): "fp32" или "int8", по умолчанию PHOTOFINDER_MODEL_PROFILE;
+        int8 включается только после пройденной проверки точности, иначе загружаются fp32-модели.
+        model_files — явные замены файлов моделей вместо профиля (проверка точности сравнивает непроверенные модели).
         """
-        ctx_id = 0 if device == "cuda" else -1
-        self.app = FaceAnalysis(name="buffalo_l")
-        self.app.prepare(ctx_id=ctx_id)
-        self.yaw_threshold = yaw_threshold
-        logger.info(f"FaceDetector initialized (device={device})")
+        started = time.perf_counter()
+        allowed_modules = DETECTION_MODULES if detection_only else FULL_MODULES
+        providers = ["CUDAExecutionProvider", "CPUExecutionProvider"] if device == "cuda" else ["CPUExecutionProvider"]
+        if model_files is None:
+            model_files = profile_models(profile)
+        self.profile = "int8" if model_files else "fp32"
+        self.models = load_models(allowed_modules, providers, intra_op_threads, replacements=model_files)
+        self.det_model = self.models["detection"]
+        for taskname, model in self.models.items():
+            # -- ctx_id=0: сессии уже созданы с нужными провайдерами (с -1 insightface пересоздал бы их для CPU)
+            if taskname == "detection":
+                model.prepare(0, input_size=(640, 640), det_thresh=0.5)
+            else:
+                model.prepare(0)
+        quality_config = dict(load_quality_config() if quality_config is None else quality_config)
+        if yaw_threshold is not None:
+            quality_config["max_yaw"] = yaw_threshold
+        self.quality = QualityGate(quality_config)
+        self.detection_only = detection_only
+        logger.info(f"FaceDetector initialized (device={device}, profile={self.profile}, modules={allowed_modules}, "
+                    f"threads={intra_op_threads}, {time.perf_counter() - started:.2f} с)")
 
-    def is_detect(self, input_path, output_path=None):
+    def warm_up(self):
         """
-        Находит лица на фото, возвращает true/false.
+        Прогревочный прогон всех моделей на пустом кадре: первый вызов ONNX Runtime выделяет память
+        и готовит ядра, поэтому без прогрева его задержку получил бы первый запрос пользователя.
+        Фильтр качества не участвует, статистика отказов не меняется. Возвращает время прогрева в секундах.
         """
-        img = cv2.imread(input_path)
-        if img is None:
-            logger.info(f"Не удалось прочитать {input_path}")
-            return False
+        from insightface.app.common import Face
 
-        faces = self.app.get(img)
+        started = time.perf_counter()
+        img = np.zeros((WARMUP_SIZE, WARMUP_SIZE, 3), dtype=np.uint8)
+        self.det_model.detect(img, max_num=0, metric="default")
+        face = Face(bbox=np.array([160.0, 160.0, 480.0, 480.0], dtype=np.float32), det_score=1.0)
+        for taskname, model in self.models.items():
+            if taskname == "recognition":
+                model.get_feat([np.zeros((model.input_size[1], model.input_size[0], 3), dtype=np.uint8)])
+            elif taskname != "detection":
+                model.get(img, face)
+        elapsed = time.perf_counter() - started
+        logger.info(f"🔥 Модели прогреты за {elapsed:.2f} с")
+        return elapsed
 
-        if output_path is not None:
-            # рисуем рамки вокруг лиц
-            for i, face in enumerate(faces):
-                x1, y1, x2, y2 = face.bbox.astype(int)
-                cv2.rectangle(img, (x1, y1), (x2, y2), (0, 255, 0), 2)
-                cv2.putText(
-                    img,
-                    f"face {i+1}",
-                    (x1, y1 - 10),
-                    cv2.FONT_HERSHEY_SIMPLEX,
-                    0.6,
-                    (0, 255, 0),
-                    2,
-                )
+    def analyze(self, image, photo_id=None, annotate=False, output_path=None):
+        """
+        Однопроходный анализ фото: изображение декодируется один раз, модели прогоняются один раз.
+        image — путь к файлу, DecodedImage (уменьшенное фото из decode.py) или BGR-изображение.
+        bbox всегда возвращаются в координатах исходного фото.
+        Возвращает (faces_info, annotated_img):
+        faces_info — список словарей с photo_id, bbox, pose, det_score, embedding;
+        annotated_img — копия фото с рамками лиц, если annotate=True или задан output_path, иначе None.
+        Нечитаемый файл — ValueError, а не фото без лиц: воркер считает его ошибкой и попробует снова.
+        """
+        if isinstance(image, str):
+            path, image = image, decode_image(image)
+            if image is None:
+                raise ValueError(f"Не удалось прочитать {path}")
+        if isinstance(image, DecodedImage):
+            if photo_id is None:
+                photo_id = os.path.splitext(os.path.basename(image.path))[0]
+        else:
+            image = DecodedImage(None, image)
+
+        faces = self._get_faces_batch([image])[0]
+        faces_info = [self._face_info(photo_id, face) for face in faces]
+        logger.info(f"📸 {photo_id} → найдено {len(faces_info)} лиц")
 
+        annotated_img = None
+        if annotate or output_path is not None:
+            annotated_img = self._draw_faces(image.full().copy(), faces)
+
+        if output_path is not None:
             # сохраняем изображение с рамками
             os.makedirs(os.path.dirname(output_path), exist_ok=True)
-            cv2.imwrite(output_path, img)
+            cv2.imwrite(output_path, annotated_img)
             logger.info(f"💾 Фото с обнаруженными лицами сохранено: {output_path}")
 
-        return True
+        return faces_info, annotated_img
+
+    def analyze_batch(self, inputs):
+        """
+        Пакетная версия analyze: возвращает список faces_info для каждого фото.
+        inputs — пути к файлам или DecodedImage (например, из decode_bytes).
+        Распознавание выполняется одним батчем по всем найденным лицам.
+        """
+        images = [decode_image(item) if isinstance(item, str) else item for item in inputs]
+
+        results = []
+        for image, faces in zip(images, self._get_faces_batch(images)):
+            photo_id = os.path.splitext(os.path.basename(image.path))[0] if image is not None and image.path else None
+            results.append([self._face_info(photo_id, face) for face in faces])
+
+        logger.info(f"📸 Пакет из {len(inputs)} фото → найдено {sum(len(r) for r in results)} лиц")
+
+        return results
+
+    def is_detect(self, input_path, output_path=None):
+        """
+        Находит лица на фото, возвращает true/false.
+        """
+        faces_info, _ = self.analyze(input_path, output_path=output_path)
+        return len(faces_info) > 0
 
     def align_detected(self, input_path):
         """
         Получение вектора загружаемого пользователем фото.
         """
-        img = cv2.imread(input_path)
-        if img is None:
-            logger.error(f"Не удалось прочитать {input_path}")
-            return []  # return False
+        faces_info, _ = self.analyze(input_path)
+        return faces_info
 
-        faces = self.app.get(img)
-        logger.info(f"📸 {os.path.basename(input_path)} → найдено {len(faces)} лиц")
+    def align_detected_batch(self, input_paths):
+        """
+        Пакетная версия align_detected.
+        """
+        return self.analyze_batch(input_paths)
 
-        aligned_faces_info = []
+    @staticmethod
+    def _face_info(photo_id, face):
+        return {
+            "photo_id": photo_id,
+            "bbox": face.bbox.tolist(),
+            "pose": tuple(face.pose) if face.pose is not None else (0,0,0),
+            "det_score": float(face.det_score),
+            "embedding": face.embedding
+        }
 
+    @staticmethod
+    def _draw_faces(img, faces):
+        # рисуем рамки вокруг лиц
         for i, face in enumerate(faces):
+            x1, y1, x2, y2 = face.bbox.astype(int)
+            cv2.rectangle(img, (x1, y1), (x2, y2), (0, 255, 0), 2)
+            cv2.putText(
+                img,
+                f"face {i+1}",
+                (x1, y1 - 10),
+                cv2.FONT_HERSHEY_SIMPLEX,
+                0.6,
+                (0, 255, 0),
+                2,
+            )
+        return img
+
+    def _get_faces_batch(self, images):
+        """
+        То же, что FaceAnalysis.get, но для нескольких изображений сразу:
+        детекция и landmarks — по каждому изображению, распознавание — одним батчем
+        по всем найденным лицам.
+        images — список DecodedImage (или None для нечитаемых файлов). Детекция идёт по уменьшенному фото,
+        мелкие лица вырезаются для распознавания из фото, декодированного заново в меньшем уменьшении:
+        его выбирает самое мелкое лицо, так что оригинал декодируется, только когда без него не обойтись.
+        Перед распознаванием лица проходят фильтр качества (self.quality): отклонённые отбрасываются
+        сразу, на них не тратятся ни landmarks (при низком det_score и малом размере), ни распознавание.
+        """
+        from insightface.app.common import Face
+        from insightface.utils import face_align
+
+        rec_model = self.models.get("recognition")
+        faces_per_img = []
+        crops, owners = [], []
+
+        for image in images:
+            faces = []
+            if image is not None:
+                img = image.image
+                with metrics.timer("detect"):
+                    bboxes, kpss = self.det_model.detect(img, max_num=0, metric="default")
+                candidates = []
+                for i in range(bboxes.shape[0]):
+                    face = Face(bbox=bboxes[i, 0:4], kps=kpss[i] if kpss is not None else None, det_score=bboxes[i, 4])
+                    if self.quality.check_detection(face, image.scale):
+                        continue
+                    with metrics.timer("landmarks"):
+                        for taskname, model in self.models.items():
+                            if taskname in ("detection", "recognition"):
+                                continue
+                            model.get(img, face)
+                    if self.quality.check_pose(face):
+                        continue
+                    candidates.append(face)
+
+                # -- мелкие лица: одно повторное декодирование на фото, в уменьшении по самому мелкому лицу
+                detail, detail_scale = None, 1
+                if rec_model is not None and image.scale > 1:
+                    sizes = [min(f.bbox[2] - f.bbox[0], f.bbox[3] - f.bbox[1]) for f in candidates]
+                    small = [size for size in sizes if size < REC_MIN_FACE_SIZE]
+                    if small:
+                        factor = detail_reduction(image.scale, min(small), REC_MIN_FACE_SIZE)
+                        detail = image.reduced(factor)
+                        detail_scale = image.scale / factor
 
-            aligned_faces_info.append({
-                "photo_id": os.path.splitext(os.path.basename(input_path))[0],
-                "bbox": face.bbox.tolist(),
-                "pose": tuple(face.pose) if face.pose is not None else (0,0,0),
-                "embedding": face.embedding
-            })
+                for face in candidates:
+                    if rec_model is not None:
+                        crop_img, crop_kps = img, face.kps
+                        x1, y1, x2, y2 = face.bbox
+                        if detail is not None and min(x2 - x1, y2 - y1) < REC_MIN_FACE_SIZE:
+                            crop_img, crop_kps = detail, face.kps * detail_scale
+                        with metrics.timer("align"):
+                            crop = face_align.norm_crop(crop_img, landmark=crop_kps, image_size=rec_model.input_size[0])
+                            rejected = self.quality.check_sharpness(crop)
+                        if rejected:
+                            continue
+                        crops.append(crop)
+                        owners.append(face)
+                    self.quality.accept()
+                    # -- координаты в масштабе исходного фото
+                    if image.scale > 1:
+                        face.bbox = face.bbox * image.scale
+                        face.kps = face.kps * image.scale if face.kps is not None else None
+                    faces.append(face)
+                metrics.observe("faces_per_photo", len(faces))
+            faces_per_img.append(faces)
 
-        logger.info(f"Всего найденных лиц: {len(aligned_faces_info)} в {os.path.basename(input_path)}")
+        # -- один (или несколько при большом числе лиц) вызов модели распознавания
+        for start in range(0, len(crops), REC_BATCH_SIZE):
+            with metrics.timer("recognize"):
+                feats = rec_model.get_feat(crops[start:start + REC_BATCH_SIZE])
+            for face, feat in zip(owners[start:start + REC_BATCH_SIZE], feats):
+                face.embedding = feat.flatten()
 
-        return aligned_faces_info
+        return faces_per_img
@@ -1,13 +1,37 @@
 import faiss
 import numpy as np
-import json
 import os
-from collections import defaultdict
 import logging
+from clustering import cluster_faces
+from metadata_store import open_metadata_store
+import metrics
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+def new_cluster_index(dim=512):
+    """
+    Индекс кластеров: ID в FAISS совпадает с int(user_id), поэтому центроид
+    можно заменить на месте (remove_ids + add_with_ids) без пересборки всего индекса.
+    """
+    return faiss.IndexIDMap2(faiss.IndexFlatIP(dim))
+
+def load_cluster_index(faiss_path, meta_store):
+    """
+    Читает индекс кластеров. Старые индексы без ID (позиция = порядок user_id в метаданных)
+    переводятся в IndexIDMap2 с ID = int(user_id).
+    """
+    index = faiss.read_index(faiss_path)
+    if isinstance(index, (faiss.IndexIDMap, faiss.IndexIDMap2)):
+        return index
+
+    id_index = new_cluster_index(index.d)
+    if index.ntotal > 0:
+        meta = meta_store.all()
+        ids = np.array([int(m["user_id"]) for m in meta[:index.ntotal]], dtype=np.int64)
+        id_index.add_with_ids(index.reconstruct_n(0, index.ntotal), ids)
+    return id_index
+
 class FaceEmbeddingDatabaseFAISS:
     def __init__(self, embedding_dim=512, threshold=0.6):
         self.threshold = threshold
@@ -15,6 +39,21 @@ class FaceEmbeddingDatabaseFAISS:
 
         self.index = faiss.IndexFlatIP(embedding_dim)  # создаём FAISS-индекс для промежуточных векторов
         self.meta = []  # список метаданных (словарей)
+        self.face_user_ids = []  # user_id (int) каждого лица после cluster_embeddings
+
+    @classmethod
+    def from_store(cls, store, threshold=0.6, batch_size=65536):
+        """
+        Загружает все неудалённые лица из FaceEmbeddingStore (номера — в store.live()) без повторного прогона нейросетей.
+        """
+        db = cls(embedding_dim=store.dim, threshold=threshold)
+        embs = store.embeddings()
+        live = store.live()
+        for start in range(0, len(live), batch_size):
+            db.index.add(np.ascontiguousarray(embs[live[start:start + batch_size]], dtype=np.float32))
+        db.meta = store.face_meta(live)
+        logger.info(f"Из хранилища загружено {db.index.ntotal} лиц")
+        return db
 
     def add_from_aligned_info(self, aligned_faces_info):
         """
@@ -27,63 +66,48 @@ class FaceEmbeddingDatabaseFAISS:
             self.meta.append({
                 "photo_id": face_info["photo_id"],
                 "bbox": face_info["bbox"],
-                "pose": face_info["pose"]
+                "pose": face_info["pose"],
+                "det_score": face_info.get("det_score")
             })
         logger.info(f"⬈ Сохранено {len(aligned_faces_info)} лиц в векторном представлении")
 
-    def cluster_embeddings(self):
+    @metrics.timed("cluster")
+    def cluster_embeddings(self, refine=None):
         """
-        Быстрая кластеризация через FAISS:
-        - для каждого вектора ищем соседей по косинусному сходству
-        - объединяем, если similarity >= threshold
+        Кластеризация через граф сходства (см. clustering.cluster_faces):
+        - граф k ближайших соседей выше порога threshold (точный поиск в малых наборах, IVF — в больших)
+        - компоненты связности (scipy), union-find — только там, где встречаются лица с одного фото;
+          результат не зависит от порядка лиц
         - не связываем лица с одного фото
+        - refine="chinese_whispers" — дополнительное уточнение кластеров
         """
         n = self.index.ntotal  # количество векторов в FAISS
-        cluster_labels = [-1] * n
-        cluster_id = 0
-
-        # Для каждого лица ищем ближайших соседей
-        emb_mat = np.array([self.index.reconstruct(i) for i in range(n)], dtype=np.float32)
-        k = min(100, n)  # ограничим число соседей для ускорения
-
-        for i in range(n):
-            if cluster_labels[i] != -1:
-                continue
-
-            cluster_labels[i] = cluster_id
-            emb = emb_mat[i].reshape(1, -1)
-
-            # ищем ближайших соседей по FAISS
-            sims, idxs = self.index.search(emb, k)
-            sims = sims[0]
-            idxs = idxs[0]
-
-            for sim, j in zip(sims, idxs):
-                if j == -1 or j == i:
-                    continue
-                if sim < self.threshold:
-                    continue
-                if self.meta[i]["photo_id"] == self.meta[j]["photo_id"]:
-                    continue
-                cluster_labels[j] = cluster_id
-
-            cluster_id += 1
-
-        # сгруппируем по ID
-        clusters = defaultdict(list)
-        for idx, c_id in enumerate(cluster_labels):
-            clusters[c_id].append(idx)
-
-        # усредненные векторы
-        averaged_vectors = []
+        if n == 0:
+            self.face_user_ids = []
+            return [], []
+
+        # все векторы одним вызовом
+        emb_mat = self.index.reconstruct_n(0, n)
+        photo_ids = [m["photo_id"] for m in self.meta]
+        labels = cluster_faces(emb_mat, photo_ids, self.threshold, refine=refine)
+
+        # усредненные векторы: суммы по кластерам пакетами (память не растёт с n)
+        n_clusters = int(labels.max()) + 1
+        sums = np.zeros((n_clusters, emb_mat.shape[1]), dtype=np.float64)
+        for start in range(0, n, 65536):
+            np.add.at(sums, labels[start:start + 65536], emb_mat[start:start + 65536])
+        counts = np.bincount(labels, minlength=n_clusters)
+        averaged = (sums / np.linalg.norm(sums, axis=1, keepdims=True)).astype(np.float32)
+
+        # сгруппируем по ID (лица внутри кластера — в исходном порядке)
+        order = np.argsort(labels, kind="stable")
+        bounds = np.cumsum(counts)[:-1]
+
+        averaged_vectors = list(averaged)
         cluster_metadata = []
+        self.face_user_ids = (labels + 1).tolist()
 
-        for rank, (c_id, indices) in enumerate(clusters.items(), start=1):
-            cluster_vecs = [emb_mat[i] for i in indices]
-            avg_vec = np.mean(cluster_vecs, axis=0)
-            avg_vec /= np.linalg.norm(avg_vec)
-            averaged_vectors.append(avg_vec)
-
+        for rank, indices in enumerate(np.split(order, bounds), start=1):
             cluster_metadata.append({
                 "user_id": f"{rank:05d}",  # '00001', '00002', ...
                 "photo_ids": [self.meta[i]["photo_id"] for i in indices],    # ["img_001", "img_002"]
@@ -92,26 +116,29 @@ class FaceEmbeddingDatabaseFAISS:
 
         return averaged_vectors, cluster_metadata
 
-    def save_database(self, save_dir):
+    def save_database(self, save_dir, refine=None):
         """
-        Сохраняет усреднённые лица в FAISS и метаданные в JSON.
+        Сохраняет усреднённые лица в FAISS и метаданные в SQLite (metadata.sqlite).
         """
         os.makedirs(save_dir, exist_ok=True)
 
         # кластеризация и усреднение
-        avg_vecs, meta = self.cluster_embeddings()
+        avg_vecs, meta = self.cluster_embeddings(refine=refine)
 
-        # создаём FAISS-индекс под усреднённые вектора
+        # создаём FAISS-индекс под усреднённые вектора (ID = user_id)
         dim = avg_vecs[0].shape[0]
-        index = faiss.IndexFlatIP(dim)
-        index.add(np.array(avg_vecs, dtype=np.float32))
+        index = new_cluster_index(dim)
+        ids = np.array([int(m["user_id"]) for m in meta], dtype=np.int64)
+        index.add_with_ids(np.array(avg_vecs, dtype=np.float32), ids)
 
         # сохраняем FAISS индекс
         faiss.write_index(index, os.path.join(save_dir, "faiss_index.idx"))
 
         # сохраняем метаданные (photo_ids, cluster_id и т.п.)
-        with open(os.path.join(save_dir, "metadata.json"), "w", encoding="utf-8") as f:
-            json.dump(meta, f, ensure_ascii=False, indent=2)
+        meta_store = open_metadata_store(save_dir)
+        with meta_store.transaction():
+            meta_store.replace_all(meta)
+        meta_store.close()
 
         # выводим статистику
         logger.info(f"Сохранено {len(avg_vecs)} усреднённых лиц в векторную БД ({save_dir})")
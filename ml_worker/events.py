@@ -0,0 +1,140 @@
+# шарды по мероприятиям: у каждого мероприятия своя векторная база, метаданные, фото и производные
+import os
+import re
+import time
+import shutil
+import argparse
+import logging
+from albums import RAW_DIR, USERS_DIR, LINK_MODES
+from derivatives import DERIVATIVES_DIR
+from snapshot import current_snapshot
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+EVENTS_DIR = "data/events"           # data/events/<мероприятие>/{vectors, photos/...}
+VECTOR_DIR = "data/vectors"          # общая база (без мероприятия): в поиске — шард с именем None
+# имя мероприятия совпадает с параметром deep-link: t.me/<бот>?start=<мероприятие>
+EVENT_NAME = re.compile(r"[A-Za-z0-9_-]{1,64}")
+DRIVE_MANIFEST = "drive_manifest.sqlite"    # манифест синхронизации с Google Drive (scr/load_photos.py) рядом с фото
+
+
+def validate_event(event):
+    """Имя мероприятия — 1–64 символа A-Z, a-z, 0-9, _ и - (как параметр /start в Telegram)."""
+    if not isinstance(event, str) or not EVENT_NAME.fullmatch(event):
+        raise ValueError(f"Недопустимое имя мероприятия: {event!r} (допустимы A-Z, a-z, 0-9, _ и -, до 64 символов)")
+    return event
+
+
+def event_root(event, events_dir=EVENTS_DIR):
+    return os.path.join(events_dir, validate_event(event))
+
+
+def shard_paths(event=None, events_dir=EVENTS_DIR):
+    """
+    Папки шарда: vector_dir (индекс, снимки, метаданные, эмбеддинги лиц, манифест обработки),
+    raw_dir, users_dir, derivatives_dir и drive_manifest (синхронизация с Google Drive).
+    event=None — общая база data/vectors и data/photos, как до появления мероприятий.
+    """
+    if event is None:
+        return {"vector_dir": VECTOR_DIR, "raw_dir": RAW_DIR, "users_dir": USERS_DIR,
+                "derivatives_dir": DERIVATIVES_DIR, "drive_manifest": os.path.join(os.path.dirname(RAW_DIR), DRIVE_MANIFEST)}
+    root = event_root(event, events_dir)
+    photos = os.path.join(root, "photos")
+    return {
+        "vector_dir": os.path.join(root, "vectors"),
+        "raw_dir": os.path.join(photos, "raw_uploads"),
+        "users_dir": os.path.join(photos, "users"),
+        "derivatives_dir": os.path.join(photos, "derivatives"),
+        "drive_manifest": os.path.join(photos, DRIVE_MANIFEST),
+    }
+
+
+def list_events(events_dir=EVENTS_DIR):
+    """Имена созданных мероприятий (папки с допустимым именем; удаляемые скрыты точкой в начале имени)."""
+    if not os.path.isdir(events_dir):
+        return []
+    return sorted(name for name in os.listdir(events_dir)
+                  if EVENT_NAME.fullmatch(name) and os.path.isdir(os.path.join(events_dir, name, "vectors")))
+
+
+def create_event(event, events_dir=EVENTS_DIR):
+    """Создаёт пустой шард мероприятия. Бот начнёт искать по нему после первой публикации снимка."""
+    paths = shard_paths(event, events_dir)
+    existed = os.path.isdir(paths["vector_dir"])
+    for key in ("vector_dir", "raw_dir", "users_dir", "derivatives_dir"):
+        os.makedirs(paths[key], exist_ok=True)
+    logger.info(f"{'Мероприятие уже есть' if existed else '🆕 Создано мероприятие'}: {event_root(event, events_dir)}")
+    return paths
+
+
+def rebuild_event(event, workers=1, recluster=False, refine=None, user_folders="hardlink", events_dir=EVENTS_DIR):
+    """
+    Пересобирает базу одного мероприятия: заново по всем его фото или (recluster=True) из сохранённых
+    эмбеддингов лиц без нейросетей. Другие мероприятия не затрагиваются.
+    """
+    from worker import run_worker     # воркер загружает модели; для create/drop/list он не нужен
+
+    paths = shard_paths(event, events_dir)
+    if not os.path.isdir(paths["vector_dir"]):
+        raise FileNotFoundError(f"Мероприятие {event} не найдено в {events_dir}")
+    return run_worker(workers=workers, rebuild=not recluster, recluster=recluster, refine=refine,
+                      user_folders=user_folders, input_dir=paths["raw_dir"], users_dir=paths["users_dir"],
+                      vector_dir=paths["vector_dir"], derivatives_dir=paths["derivatives_dir"])
+
+
+def drop_event(event, events_dir=EVENTS_DIR):
+    """
+    Удаляет мероприятие целиком: базу, фото и производные. Папка сначала атомарно переименовывается
+    в скрытую, поэтому бот перестаёт видеть шард сразу, а не посреди удаления файлов.
+    """
+    root = event_root(event, events_dir)
+    if not os.path.isdir(root):
+        raise FileNotFoundError(f"Мероприятие {event} не найдено в {events_dir}")
+    trash = os.path.join(events_dir, f".{event}.dropped-{int(time.time())}")
+    os.replace(root, trash)
+    try:
+        shutil.rmtree(trash)
+    except OSError as e:
+        # -- например, на Windows индекс ещё отображён в память ботом; папка уже скрыта от поиска
+        logger.error(f"Не удалось удалить {trash}: {e}")
+    logger.info(f"🗑 Мероприятие {event} удалено")
+
+
+def describe_events(events_dir=EVENTS_DIR):
+    """Мероприятия и текущие снимки их баз."""
+    rows = []
+    for event in list_events(events_dir):
+        snapshot_dir = current_snapshot(shard_paths(event, events_dir)["vector_dir"])
+        rows.append({"event": event, "snapshot": os.path.basename(snapshot_dir) if snapshot_dir else None})
+    return rows
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Мероприятия: создание, пересборка и удаление шардов базы")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    subparsers.add_parser("list", help="мероприятия и текущие снимки их баз")
+    for command, help_text in (("create", "создать пустое мероприятие"),
+                               ("rebuild", "пересобрать базу мероприятия"),
+                               ("drop", "удалить мероприятие с фото и базой")):
+        sub = subparsers.add_parser(command, help=help_text)
+        sub.add_argument("event", help="имя мероприятия (A-Z, a-z, 0-9, _ и -)")
+        if command == "rebuild":
+            sub.add_argument("--workers", type=int, default=1, help="число процессов для обработки фото")
+            sub.add_argument("--recluster", action="store_true",
+                             help="перекластеризовать сохранённые эмбеддинги лиц без обработки фото")
+            sub.add_argument("--refine", choices=["chinese_whispers"], help="уточнение кластеров при --recluster")
+            sub.add_argument("--user-folders", choices=LINK_MODES, default="hardlink",
+                             help="как собирать папки пользователей мероприятия")
+    args = parser.parse_args()
+
+    if args.command == "list":
+        for row in describe_events():
+            print(f"{row['event']}\t{row['snapshot'] or '(база ещё не собрана)'}")
+    elif args.command == "create":
+        create_event(args.event)
+    elif args.command == "rebuild":
+        rebuild_event(args.event, workers=args.workers, recluster=args.recluster, refine=args.refine,
+                      user_folders=args.user_folders)
+    else:
+        drop_event(args.event)
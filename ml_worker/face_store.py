@@ -0,0 +1,211 @@
+# постоянное хранилище эмбеддингов всех лиц (рядом с индексом кластеров)
+import os
+import json
+import logging
+import numpy as np
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+STORE_DIR = "data/vectors/faces"
+
+# запись о лице фиксированного размера: индекс фото, рамка, поза, уверенность детектора, кластер
+FACE_RECORD = np.dtype([
+    ("photo_idx", "<i4"),
+    ("bbox", "<f4", (4,)),
+    ("pose", "<f4", (3,)),
+    ("det_score", "<f4"),
+    ("cluster_id", "<i4"),      # int(user_id), -1 — ещё не распределено, REMOVED — лицо удалено
+])
+REMOVED = -2    # лицо фото, которое заменено новым содержимым или переименовано (хранилище только дописывается)
+
+
+class FaceEmbeddingStore:
+    """
+    Append-only хранилище эмбеддингов лиц с отображением в память.
+    - embeddings.bin — нормализованные эмбеддинги (float16 или float32) подряд, по строке на лицо;
+    - faces.bin — записи FACE_RECORD в том же порядке;
+    - photos.txt — photo_id по строке, photo_idx в записи — номер строки;
+    - store.json — размерность и тип эмбеддингов.
+    Позволяет перекластеризовать базу и пересчитать центроиды без повторного прогона нейросетей.
+    Лица заменённых и переименованных фото не стираются, а помечаются cluster_id = REMOVED.
+    """
+    def __init__(self, store_dir=STORE_DIR, dim=512, dtype="float16"):
+        self.store_dir = store_dir
+        os.makedirs(store_dir, exist_ok=True)
+
+        self.header_path = os.path.join(store_dir, "store.json")
+        self.emb_path = os.path.join(store_dir, "embeddings.bin")
+        self.faces_path = os.path.join(store_dir, "faces.bin")
+        self.photos_path = os.path.join(store_dir, "photos.txt")
+
+        if os.path.exists(self.header_path):
+            with open(self.header_path, "r", encoding="utf-8") as f:
+                header = json.load(f)
+            dim, dtype = header["dim"], header["dtype"]
+        else:
+            with open(self.header_path, "w", encoding="utf-8") as f:
+                json.dump({"dim": dim, "dtype": dtype}, f)
+
+        self.dim = dim
+        self.dtype = np.dtype(dtype)
+
+        self.photo_ids = []
+        if os.path.exists(self.photos_path):
+            with open(self.photos_path, "r", encoding="utf-8") as f:
+                self.photo_ids = f.read().splitlines()
+        self._photo_idx = {photo_id: i for i, photo_id in enumerate(self.photo_ids)}
+        self._new_photo_ids = []    # фото, ещё не дописанные в photos.txt
+
+        self._repair()
+
+    def _repair(self):
+        """
+        После прерванной записи длины файлов могут разойтись — обрезаем до последнего целого лица.
+        """
+        n_emb = self._file_rows(self.emb_path, self.dim * self.dtype.itemsize)
+        n_faces = self._file_rows(self.faces_path, FACE_RECORD.itemsize)
+        n = min(n_emb, n_faces)
+        for path, row_size in ((self.emb_path, self.dim * self.dtype.itemsize),
+                               (self.faces_path, FACE_RECORD.itemsize)):
+            if os.path.exists(path) and os.path.getsize(path) != n * row_size:
+                logger.error(f"Хранилище лиц: {path} обрезан до {n} записей")
+                with open(path, "r+b") as f:
+                    f.truncate(n * row_size)
+
+    @staticmethod
+    def _file_rows(path, row_size):
+        return os.path.getsize(path) // row_size if os.path.exists(path) else 0
+
+    def __len__(self):
+        return self._file_rows(self.faces_path, FACE_RECORD.itemsize)
+
+    def embeddings(self):
+        """Эмбеддинги всех лиц, отображённые в память (только чтение), shape (n, dim)."""
+        n = len(self)
+        if n == 0:
+            return np.empty((0, self.dim), dtype=self.dtype)
+        return np.memmap(self.emb_path, dtype=self.dtype, mode="r", shape=(n, self.dim))
+
+    def records(self, mode="r"):
+        """Записи FACE_RECORD всех лиц, отображённые в память."""
+        n = len(self)
+        if n == 0:
+            return np.empty(0, dtype=FACE_RECORD)
+        return np.memmap(self.faces_path, dtype=FACE_RECORD, mode=mode, shape=(n,))
+
+    def append(self, face_infos):
+        """
+        Дописывает лица (словари из FaceDetector.analyze; cluster берётся из "user_id", если он уже назначен).
+        Возвращает номера добавленных лиц в хранилище.
+        """
+        if not face_infos:
+            return np.empty(0, dtype=np.int64)
+
+        embs = np.array([f["embedding"] for f in face_infos], dtype=np.float32)
+        embs /= np.linalg.norm(embs, axis=1, keepdims=True)
+
+        records = np.zeros(len(face_infos), dtype=FACE_RECORD)
+        for i, face_info in enumerate(face_infos):
+            records["photo_idx"][i] = self._photo_index(face_info["photo_id"])
+            records["bbox"][i] = face_info["bbox"]
+            records["pose"][i] = face_info["pose"]
+            records["det_score"][i] = face_info.get("det_score") or 0.0
+            records["cluster_id"][i] = int(face_info["user_id"]) if face_info.get("user_id") else -1
+        return self._write(embs.astype(self.dtype), records)
+
+    def copy_faces(self, indices, photo_id):
+        """
+        Дописывает копии лиц indices (эмбеддинги, рамки, кластеры) как лица фото photo_id —
+        для копии или переименования уже обработанного фото. Возвращает номера добавленных лиц.
+        """
+        indices = np.asarray(indices, dtype=np.int64)
+        if len(indices) == 0:
+            return indices
+        embs = np.array(self.embeddings()[indices])
+        records = np.array(self.records()[indices])
+        records["photo_idx"] = self._photo_index(photo_id)
+        return self._write(embs, records)
+
+    def _photo_index(self, photo_id):
+        if photo_id not in self._photo_idx:
+            self._photo_idx[photo_id] = len(self.photo_ids)
+            self.photo_ids.append(photo_id)
+            self._new_photo_ids.append(photo_id)
+        return self._photo_idx[photo_id]
+
+    def _write(self, embs, records):
+        start = len(self)
+        # порядок важен: сначала фото и эмбеддинги, последними — записи (по ним считается число лиц)
+        if self._new_photo_ids:
+            with open(self.photos_path, "a", encoding="utf-8") as f:
+                f.write("".join(f"{photo_id}\n" for photo_id in self._new_photo_ids))
+            self._new_photo_ids = []
+        with open(self.emb_path, "ab") as f:
+            f.write(embs.tobytes())
+        with open(self.faces_path, "ab") as f:
+            f.write(records.tobytes())
+
+        logger.info(f"В хранилище лиц добавлено {len(records)} эмбеддингов (всего {start + len(records)})")
+        return np.arange(start, start + len(records))
+
+    def live(self):
+        """Номера неудалённых лиц (по ним пересобирается база)."""
+        return np.flatnonzero(self.records()["cluster_id"] != REMOVED)
+
+    def photo_faces(self, photo_ids):
+        """Номера неудалённых лиц фото photo_ids."""
+        photo_idx = [self._photo_idx[p] for p in photo_ids if p in self._photo_idx]
+        if not photo_idx:
+            return np.empty(0, dtype=np.int64)
+        records = self.records()
+        return np.flatnonzero(np.isin(records["photo_idx"], photo_idx) & (records["cluster_id"] != REMOVED))
+
+    def remove(self, indices):
+        """Помечает лица удалёнными: в пересборку они больше не попадут."""
+        if len(indices):
+            self.set_clusters(REMOVED, indices)
+
+    def truncate(self, n):
+        """Отбрасывает лица, дописанные после первых n (откат незафиксированного обновления базы)."""
+        for path, row_size in ((self.faces_path, FACE_RECORD.itemsize),
+                               (self.emb_path, self.dim * self.dtype.itemsize)):
+            if os.path.exists(path) and os.path.getsize(path) > n * row_size:
+                with open(path, "r+b") as f:
+                    f.truncate(n * row_size)
+
+    def set_clusters(self, cluster_ids, indices=None):
+        """
+        Обновляет кластеры лиц на месте (indices=None — для всех лиц по порядку).
+        """
+        records = self.records(mode="r+")
+        if len(records) == 0:
+            return
+        if indices is None:
+            records["cluster_id"] = cluster_ids
+        else:
+            records["cluster_id"][indices] = cluster_ids
+        records.flush()
+
+    def face_meta(self, indices=None):
+        """Метаданные лиц (indices=None — всех) в формате FaceEmbeddingDatabaseFAISS.meta."""
+        records = self.records()
+        if indices is not None:
+            records = records[indices]
+        return [
+            {
+                "photo_id": self.photo_ids[r["photo_idx"]],
+                "bbox": r["bbox"].tolist(),
+                "pose": tuple(r["pose"].tolist()),
+                "det_score": float(r["det_score"]),
+            }
+            for r in records
+        ]
+
+    def clear(self):
+        for path in (self.emb_path, self.faces_path, self.photos_path):
+            if os.path.exists(path):
+                os.remove(path)
+        self.photo_ids = []
+        self._photo_idx = {}
+        self._new_photo_ids = []
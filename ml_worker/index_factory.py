@@ -0,0 +1,215 @@
+# фабрика поисковых индексов FAISS: Flat, HNSW, IVF-Flat, IVF-PQ
+import os
+import json
+import logging
+import numpy as np
+import faiss
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+INDEX_CONFIG_PATH = "data/vectors/index_config.json"
+BACKENDS = ("flat", "hnsw", "ivf_flat", "ivf_pq")
+
+DEFAULT_INDEX_CONFIG = {
+    "backend": "flat",
+    "hnsw_m": 32,              # связей на вершину графа HNSW
+    "ef_construction": 200,
+    "ef_search": 64,           # ширина поиска HNSW (точность/скорость)
+    "nlist": 1024,             # число ячеек IVF (уменьшается, если векторов мало)
+    "nprobe": 16,              # сколько ячеек IVF просматривается при поиске
+    "pq_m": 64,                # число подвекторов PQ (делитель размерности)
+    "pq_nbits": 8,
+}
+
+MIN_POINTS_PER_CELL = 39       # меньше — FAISS обучает k-means ненадёжно
+IVF_RETRAIN_GROWTH = 4         # IVF переобучается, когда векторов хватает на столько раз больше ячеек, чем при обучении
+RERANK_K = 16                  # кандидатов IVF-PQ на запрос, пересчитываемых по точным центроидам
+
+
+def _base_index(index):
+    """Внутренний индекс без обёртки IDMap, приведённый к конкретному типу."""
+    if isinstance(index, (faiss.IndexIDMap, faiss.IndexIDMap2)):
+        return faiss.downcast_index(index.index)
+    return index
+
+
+def load_index_config(path=INDEX_CONFIG_PATH):
+    """
+    Общая конфигурация индекса для воркера и бота:
+    значения по умолчанию ← data/vectors/index_config.json ← переменная окружения PHOTOFINDER_INDEX_BACKEND.
+    """
+    config = dict(DEFAULT_INDEX_CONFIG)
+    if os.path.exists(path):
+        with open(path, "r", encoding="utf-8") as f:
+            config.update(json.load(f))
+    backend = os.getenv("PHOTOFINDER_INDEX_BACKEND")
+    if backend:
+        config["backend"] = backend
+    if config["backend"] not in BACKENDS:
+        raise ValueError(f"Неизвестный тип индекса: {config['backend']} (допустимо: {', '.join(BACKENDS)})")
+    return config
+
+
+def search_index_path(save_dir, config):
+    """Для flat поиск идёт прямо по индексу центроидов, для остальных — по отдельному файлу."""
+    if config["backend"] == "flat":
+        return os.path.join(save_dir, "faiss_index.idx")
+    return os.path.join(save_dir, f"search_index_{config['backend']}.idx")
+
+
+def centroid_arrays(centroid_index):
+    """(ids, vectors) из индекса центроидов IndexIDMap2(IndexFlatIP)."""
+    if centroid_index.ntotal == 0:
+        return np.empty(0, dtype=np.int64), np.empty((0, centroid_index.d), dtype=np.float32)
+    ids = faiss.vector_to_array(centroid_index.id_map).astype(np.int64)
+    vectors = centroid_index.index.reconstruct_n(0, centroid_index.ntotal)
+    return ids, vectors
+
+
+def make_index(config, dim, train_vectors=None):
+    """
+    Создаёт пустой индекс выбранного типа с поддержкой add_with_ids (обучает IVF на train_vectors).
+    Если векторов для обучения IVF/PQ слишком мало, возвращается точный Flat.
+    """
+    backend = config["backend"]
+    n_train = 0 if train_vectors is None else len(train_vectors)
+
+    if backend == "hnsw":
+        index = faiss.IndexHNSWFlat(dim, config["hnsw_m"], faiss.METRIC_INNER_PRODUCT)
+        index.hnsw.efConstruction = config["ef_construction"]
+        return faiss.IndexIDMap2(index)
+
+    if backend in ("ivf_flat", "ivf_pq"):
+        nlist = min(config["nlist"], n_train // MIN_POINTS_PER_CELL)
+        min_pq = 2 ** config["pq_nbits"] if backend == "ivf_pq" else 0
+        if nlist >= 1 and n_train >= min_pq:
+            quantizer = faiss.IndexFlatIP(dim)
+            if backend == "ivf_flat":
+                index = faiss.IndexIVFFlat(quantizer, dim, nlist, faiss.METRIC_INNER_PRODUCT)
+            else:
+                index = faiss.IndexIVFPQ(quantizer, dim, nlist, config["pq_m"], config["pq_nbits"],
+                                         faiss.METRIC_INNER_PRODUCT)
+            index.train(np.ascontiguousarray(train_vectors, dtype=np.float32))
+            return index
+        logger.info(f"Мало векторов для обучения {backend} ({n_train}), используется Flat")
+
+    return faiss.IndexIDMap2(faiss.IndexFlatIP(dim))
+
+
+def needs_rerank(index):
+    """
+    Сходство из индекса приблизительное (PQ сжимает векторы): сравнивать его с порогом нельзя.
+    На 512-d и pq_m=64 косинус 0.9 оценивается примерно в 0.70, а 0.7 — в 0.54.
+    """
+    return isinstance(_base_index(index), (faiss.IndexIVFPQ, faiss.IndexPQ))
+
+
+def search_centroids(search_index, centroid_index, queries, k):
+    """
+    k ближайших кластеров для каждого запроса: (similarities, user_ids), как index.search.
+    Для IVF-PQ берутся RERANK_K кандидатов, их сходство пересчитывается точно по центроидам
+    (IndexIDMap2(IndexFlatIP)) и кандидаты пересортировываются — порог сравнивается с настоящим косинусом.
+    Остальные индексы хранят векторы без сжатия, их сходство уже точное.
+    """
+    if centroid_index is None or search_index is centroid_index or not needs_rerank(search_index):
+        return search_index.search(queries, k)
+
+    sims, ids = search_index.search(queries, min(max(k, RERANK_K), search_index.ntotal))
+    found = ids >= 0
+    if found.any():
+        unique_ids, inverse = np.unique(ids[found], return_inverse=True)
+        vectors = centroid_index.reconstruct_batch(unique_ids)
+        rows = np.nonzero(found)[0]
+        sims = np.full(ids.shape, -np.inf, dtype=np.float32)
+        sims[found] = np.einsum("ij,ij->i", queries[rows], vectors[inverse])
+    order = np.argsort(-sims, axis=1, kind="stable")[:, :k]
+    sims = np.take_along_axis(sims, order, axis=1)
+    ids = np.take_along_axis(ids, order, axis=1)
+    ids[~np.isfinite(sims)] = -1
+    return sims, ids
+
+
+def apply_search_params(index, config):
+    """Выставляет efSearch / nprobe для уже построенного или прочитанного индекса."""
+    base = _base_index(index)
+    if isinstance(base, faiss.IndexHNSW):
+        base.hnsw.efSearch = config["ef_search"]
+    elif isinstance(base, faiss.IndexIVF):
+        base.nprobe = min(config["nprobe"], base.nlist)
+    return index
+
+
+def build_index(config, ids, vectors):
+    """Строит индекс выбранного типа по векторам и их ID (обучение — на этих же векторах)."""
+    dim = vectors.shape[1]
+    index = make_index(config, dim, train_vectors=vectors)
+    if len(ids) > 0:
+        index.add_with_ids(np.ascontiguousarray(vectors, dtype=np.float32), ids.astype(np.int64))
+    return apply_search_params(index, config)
+
+
+def build_search_index(config, centroid_index):
+    """Поисковый индекс по центроидам кластеров (для flat — сам индекс центроидов)."""
+    if config["backend"] == "flat":
+        return centroid_index
+    ids, vectors = centroid_arrays(centroid_index)
+    return build_index(config, ids, vectors)
+
+
+def load_search_index(save_dir, config, centroid_index):
+    """Читает поисковый индекс с диска или строит его по центроидам, если файла ещё нет."""
+    if config["backend"] == "flat":
+        return centroid_index
+    path = search_index_path(save_dir, config)
+    if os.path.exists(path):
+        return apply_search_params(faiss.read_index(path), config)
+    return build_search_index(config, centroid_index)
+
+
+def read_index_mmap(path):
+    """
+    Читает индекс только для поиска, отображая векторы в память (IO_FLAG_MMAP_IFC, в старых FAISS — IO_FLAG_MMAP):
+    несколько процессов бота делят одну копию в page cache. Если отображение не поддерживается — обычное чтение.
+    """
+    mmap_flag = getattr(faiss, "IO_FLAG_MMAP_IFC", faiss.IO_FLAG_MMAP)
+    try:
+        return faiss.read_index(path, mmap_flag | faiss.IO_FLAG_READ_ONLY)
+    except RuntimeError as e:
+        logger.error(f"Индекс {path} не удалось отобразить в память ({e}), читается целиком")
+        return faiss.read_index(path)
+
+
+def write_search_index(save_dir, config, search_index):
+    """Сохраняет поисковый индекс (для flat отдельного файла нет)."""
+    if config["backend"] != "flat":
+        faiss.write_index(search_index, search_index_path(save_dir, config))
+
+
+def update_search_index(search_index, centroid_index, changed_ids, config, removed_ids=()):
+    """
+    Переносит изменённые центроиды (changed_ids) в поисковый индекс и убирает удалённые (removed_ids).
+    IVF обновляется на месте (remove_ids + add_with_ids). HNSW удаления не поддерживает, а временный Flat
+    (когда векторов для обучения IVF было мало) стоит переобучить — такие индексы пересобираются.
+    IVF, обученный на малой базе (nlist = число векторов // MIN_POINTS_PER_CELL), тоже пересобирается,
+    когда база выросла настолько, что ячеек можно сделать в IVF_RETRAIN_GROWTH раз больше:
+    иначе ячейки разрастаются и каждый поиск просматривает всё большую долю базы.
+    Возвращает актуальный поисковый индекс.
+    """
+    if search_index is centroid_index or len(changed_ids) + len(removed_ids) == 0:
+        return search_index
+
+    base = _base_index(search_index)
+    if not isinstance(base, faiss.IndexIVF):
+        return build_search_index(config, centroid_index)
+
+    wanted_nlist = min(config["nlist"], centroid_index.ntotal // MIN_POINTS_PER_CELL)
+    if wanted_nlist >= IVF_RETRAIN_GROWTH * base.nlist:
+        logger.info(f"IVF обучен на {base.nlist} ячеек, а кластеров уже на {wanted_nlist}: поисковый индекс переобучается")
+        return build_search_index(config, centroid_index)
+
+    changed_ids = np.asarray(changed_ids, dtype=np.int64)
+    search_index.remove_ids(np.concatenate([changed_ids, np.asarray(removed_ids, dtype=np.int64)]))
+    if len(changed_ids):
+        search_index.add_with_ids(centroid_index.reconstruct_batch(changed_ids), changed_ids)
+    return search_index
@@ -0,0 +1,132 @@
+# манифест обработанных фото: воркер анализирует только новые и изменённые файлы
+import os
+import time
+import sqlite3
+import hashlib
+import logging
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+MANIFEST_PATH = "data/vectors/ingest_manifest.sqlite"
+HASH_CHUNK = 1 << 20
+
+
+def file_sha256(path):
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(HASH_CHUNK), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+class IngestManifest:
+    """
+    Постоянный манифест загрузки в SQLite: путь, sha256 содержимого, размер, mtime и число лиц.
+    Файл считается обработанным, если совпадают путь, размер и mtime (без чтения файла),
+    либо если фото с таким же содержимым уже обработано (переименование, повторная выгрузка).
+    sha256, посчитанные в filter_new, хранятся до mark_processed, поэтому каждый файл читается один раз.
+    """
+    def __init__(self, db_path=MANIFEST_PATH):
+        os.makedirs(os.path.dirname(db_path) or ".", exist_ok=True)
+        self.db_path = db_path
+        self.conn = sqlite3.connect(db_path)
+        self.conn.execute("""
+            CREATE TABLE IF NOT EXISTS files (
+                path TEXT PRIMARY KEY,
+                sha256 TEXT NOT NULL,
+                size INTEGER NOT NULL,
+                mtime_ns INTEGER NOT NULL,
+                faces INTEGER NOT NULL,
+                processed_at REAL NOT NULL
+            )
+        """)
+        self.conn.execute("CREATE INDEX IF NOT EXISTS files_sha256 ON files (sha256)")
+        self.conn.commit()
+        self._hashes = {}       # путь → (sha256, размер, mtime_ns) из filter_new, ещё не записанные в манифест
+
+    def close(self):
+        self.conn.close()
+
+    def filter_new(self, paths, log=True):
+        """
+        Разбирает пути на (new_paths, copies):
+        - new_paths — новые и изменённые файлы, их нужно проанализировать;
+        - copies — {путь: путь уже обработанного файла с тем же содержимым} (копия или переименование):
+          лица у них те же, поэтому commit_batch добавляет фото в кластеры исходного без нейросетей.
+        Файл, у которого изменился только mtime, сразу обновляется в манифесте.
+        log=False — без строки в логе (потоковая обработка проверяет файлы по одному).
+        """
+        new_paths, copies, touched = [], {}, []
+
+        for path in paths:
+            st = os.stat(path)
+            row = self.conn.execute("SELECT size, mtime_ns FROM files WHERE path = ?", (path,)).fetchone()
+            if row is not None and row == (st.st_size, st.st_mtime_ns):
+                continue
+
+            sha = file_sha256(path)
+            # -- то же содержимое: сначала сам файл (тогда изменился только mtime), затем другие обработанные
+            same = self.conn.execute(
+                "SELECT path, faces FROM files WHERE sha256 = ? ORDER BY path = ? DESC LIMIT 1", (sha, path)
+            ).fetchone()
+            if same is not None and same[0] == path:
+                touched.append((path, sha, st.st_size, st.st_mtime_ns, same[1], time.time()))
+                continue
+
+            self._hashes[path] = (sha, st.st_size, st.st_mtime_ns)
+            if same is not None:
+                copies[path] = same[0]
+            else:
+                new_paths.append(path)
+
+        if touched:
+            with self.conn:
+                self.conn.executemany("INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, ?, ?)", touched)
+
+        if log:
+            logger.info(f"Манифест: {len(new_paths)} новых/изменённых фото и {len(copies)} копий обработанных из {len(paths)}")
+        return new_paths, copies
+
+    def known_paths(self, paths):
+        """Пути из paths, уже записанные в манифест (обработанные раньше — возможно, с другим содержимым)."""
+        paths = list(paths)
+        known = set()
+        for start in range(0, len(paths), 900):
+            chunk = paths[start:start + 900]
+            rows = self.conn.execute(f"SELECT path FROM files WHERE path IN ({','.join('?' * len(chunk))})", chunk)
+            known.update(r[0] for r in rows)
+        return known
+
+    def _file_hash(self, path):
+        """(sha256, размер, mtime_ns) файла: из filter_new, если файл с тех пор не менялся, иначе — заново."""
+        st = os.stat(path)
+        cached = self._hashes.pop(path, None)
+        if cached is not None and cached[1:] == (st.st_size, st.st_mtime_ns):
+            return cached
+        return file_sha256(path), st.st_size, st.st_mtime_ns
+
+    def mark_processed(self, faces_by_path, copies=None):
+        """
+        Записывает обработанные фото одной транзакцией. faces_by_path: {путь: число лиц},
+        copies — {путь: исходный путь} из filter_new (число лиц берётся у исходного фото).
+        Вызывается только после успешного обновления векторной базы.
+        """
+        now = time.time()
+        rows = [(path, *self._file_hash(path), faces, now) for path, faces in faces_by_path.items()]
+        for path, source in (copies or {}).items():
+            row = self.conn.execute("SELECT faces FROM files WHERE path = ?", (source,)).fetchone()
+            rows.append((path, *self._file_hash(path), row[0] if row else 0, now))
+
+        with self.conn:
+            self.conn.executemany("INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, ?, ?)", rows)
+
+    def forget(self, paths):
+        """Удаляет записи о файлах (например, исходниках переименованных фото)."""
+        with self.conn:
+            self.conn.executemany("DELETE FROM files WHERE path = ?", ((path,) for path in paths))
+
+    def clear(self):
+        self._hashes.clear()
+        with self.conn:
+            self.conn.execute("DELETE FROM files")
@@ -0,0 +1,221 @@
+# метаданные кластеров в SQLite вместо монолитного metadata.json
+import os
+import json
+import sqlite3
+import argparse
+import logging
+from contextlib import contextmanager
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+METADATA_DB = "metadata.sqlite"
+LEGACY_METADATA_JSON = "metadata.json"
+
+
+class ClusterMetadataStore:
+    """
+    Метаданные кластеров (пользователей) в SQLite:
+    - clusters: user_id → count (user_id совпадает с ID вектора в FAISS);
+    - cluster_photos: фото пользователя и обратный индекс photo_id → пользователи;
+    - photos: photo_id → путь к исходному фото (альбомы пользователей собираются без обхода папок);
+    - state: служебные значения (номер последнего зафиксированного обновления базы, см. update.py).
+    Поиск по user_id и photo_id — по первичному ключу/индексу, запись — инкрементальная, в транзакциях.
+    Снаружи кластер выглядит как раньше: {"user_id": "00001", "photo_ids": [...], "count": n}.
+    """
+    def __init__(self, db_path, readonly=False):
+        self.db_path = db_path
+        if readonly:
+            self.conn = sqlite3.connect(f"file:{db_path}?mode=ro", uri=True, check_same_thread=False)
+            return
+
+        os.makedirs(os.path.dirname(db_path) or ".", exist_ok=True)
+        self.conn = sqlite3.connect(db_path, check_same_thread=False)
+        self.conn.executescript("""
+            CREATE TABLE IF NOT EXISTS clusters (
+                user_id INTEGER PRIMARY KEY,
+                count INTEGER NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS cluster_photos (
+                user_id INTEGER NOT NULL,
+                photo_id TEXT NOT NULL,
+                seq INTEGER NOT NULL,
+                PRIMARY KEY (user_id, photo_id)
+            ) WITHOUT ROWID;
+            CREATE INDEX IF NOT EXISTS cluster_photos_by_photo ON cluster_photos (photo_id);
+            CREATE TABLE IF NOT EXISTS photos (
+                photo_id TEXT PRIMARY KEY,
+                path TEXT NOT NULL
+            ) WITHOUT ROWID;
+            CREATE TABLE IF NOT EXISTS state (
+                key TEXT PRIMARY KEY,
+                value TEXT NOT NULL
+            ) WITHOUT ROWID;
+        """)
+        self.conn.commit()
+
+    def close(self):
+        self.conn.close()
+
+    @contextmanager
+    def transaction(self):
+        """Все изменения внутри блока фиксируются одной транзакцией (или откатываются при ошибке)."""
+        with self.conn:
+            yield self
+
+    # -- чтение
+
+    def __len__(self):
+        return self.conn.execute("SELECT COUNT(*) FROM clusters").fetchone()[0]
+
+    def max_user_id(self):
+        return self.conn.execute("SELECT COALESCE(MAX(user_id), 0) FROM clusters").fetchone()[0]
+
+    def get(self, user_id):
+        """Кластер по user_id (строка '00001' или число) или None."""
+        user_id = int(user_id)
+        row = self.conn.execute("SELECT count FROM clusters WHERE user_id = ?", (user_id,)).fetchone()
+        if row is None:
+            return None
+        return {"user_id": f"{user_id:05d}", "photo_ids": self.photo_ids(user_id), "count": row[0]}
+
+    def counts(self, user_ids):
+        """{user_id: count} для набора пользователей одним запросом."""
+        user_ids = [int(u) for u in user_ids]
+        result = {}
+        for start in range(0, len(user_ids), 900):      # ограничение SQLite на число параметров
+            chunk = user_ids[start:start + 900]
+            rows = self.conn.execute(
+                f"SELECT user_id, count FROM clusters WHERE user_id IN ({','.join('?' * len(chunk))})", chunk
+            )
+            result.update(rows)
+        return result
+
+    def photo_ids(self, user_id):
+        rows = self.conn.execute(
+            "SELECT photo_id FROM cluster_photos WHERE user_id = ? ORDER BY seq", (int(user_id),)
+        )
+        return [r[0] for r in rows]
+
+    def photo_paths(self, user_id):
+        """
+        Альбом пользователя: [(photo_id, путь или None)] в порядке добавления фото.
+        None — путь неизвестен (фото из базы, собранной до появления таблицы photos).
+        """
+        try:
+            rows = self.conn.execute(
+                "SELECT cp.photo_id, p.path FROM cluster_photos cp LEFT JOIN photos p ON p.photo_id = cp.photo_id "
+                "WHERE cp.user_id = ? ORDER BY cp.seq", (int(user_id),)
+            )
+            return rows.fetchall()
+        except sqlite3.OperationalError:
+            # -- снимок старой базы без таблицы photos
+            return [(photo_id, None) for photo_id in self.photo_ids(user_id)]
+
+    def get_state(self, key):
+        row = self.conn.execute("SELECT value FROM state WHERE key = ?", (key,)).fetchone()
+        return row[0] if row is not None else None
+
+    def users_for_photo(self, photo_id):
+        """Обратный индекс: user_id всех пользователей, найденных на фото."""
+        rows = self.conn.execute("SELECT user_id FROM cluster_photos WHERE photo_id = ? ORDER BY user_id", (photo_id,))
+        return [f"{r[0]:05d}" for r in rows]
+
+    def all(self):
+        """Все кластеры в порядке user_id (для выгрузки фото и миграций)."""
+        photos = {}
+        for user_id, photo_id in self.conn.execute("SELECT user_id, photo_id FROM cluster_photos ORDER BY user_id, seq"):
+            photos.setdefault(user_id, []).append(photo_id)
+        return [
+            {"user_id": f"{user_id:05d}", "photo_ids": photos.get(user_id, []), "count": count}
+            for user_id, count in self.conn.execute("SELECT user_id, count FROM clusters ORDER BY user_id")
+        ]
+
+    # -- запись (вызывать внутри transaction())
+
+    def add_cluster(self, user_id, photo_ids, count):
+        self.conn.execute("INSERT INTO clusters (user_id, count) VALUES (?, ?)", (int(user_id), count))
+        self.add_photos(user_id, photo_ids)
+
+    def set_state(self, key, value):
+        self.conn.execute("INSERT OR REPLACE INTO state (key, value) VALUES (?, ?)", (key, value))
+
+    def add_to_count(self, user_id, n):
+        self.conn.execute("UPDATE clusters SET count = count + ? WHERE user_id = ?", (int(n), int(user_id)))
+
+    def add_photos(self, user_id, photo_ids):
+        """Добавляет фото пользователю; уже привязанные фото пропускаются."""
+        user_id = int(user_id)
+        seq = self.conn.execute(
+            "SELECT COALESCE(MAX(seq), -1) + 1 FROM cluster_photos WHERE user_id = ?", (user_id,)
+        ).fetchone()[0]
+        self.conn.executemany(
+            "INSERT OR IGNORE INTO cluster_photos (user_id, photo_id, seq) VALUES (?, ?, ?)",
+            ((user_id, photo_id, seq + i) for i, photo_id in enumerate(photo_ids))
+        )
+
+    def set_photo_paths(self, paths):
+        """Запоминает пути к исходным фото: {photo_id: path}."""
+        self.conn.executemany("INSERT OR REPLACE INTO photos (photo_id, path) VALUES (?, ?)", paths.items())
+
+    def remove_photos(self, photo_ids):
+        """Убирает фото из кластеров и забывает их пути. Возвращает user_id (int) затронутых кластеров."""
+        photo_ids = list(photo_ids)
+        user_ids = set()
+        for start in range(0, len(photo_ids), 900):
+            chunk = photo_ids[start:start + 900]
+            marks = ",".join("?" * len(chunk))
+            user_ids.update(r[0] for r in self.conn.execute(
+                f"SELECT DISTINCT user_id FROM cluster_photos WHERE photo_id IN ({marks})", chunk))
+            self.conn.execute(f"DELETE FROM cluster_photos WHERE photo_id IN ({marks})", chunk)
+            self.conn.execute(f"DELETE FROM photos WHERE photo_id IN ({marks})", chunk)
+        return sorted(user_ids)
+
+    def remove_clusters(self, user_ids):
+        """Удаляет кластеры, у которых не осталось лиц."""
+        self.conn.executemany("DELETE FROM cluster_photos WHERE user_id = ?", ((int(u),) for u in user_ids))
+        self.conn.executemany("DELETE FROM clusters WHERE user_id = ?", ((int(u),) for u in user_ids))
+
+    def replace_all(self, clusters):
+        """Полностью заменяет метаданные кластеров (после пересборки; пути к фото сохраняются)."""
+        self.conn.execute("DELETE FROM cluster_photos")
+        self.conn.execute("DELETE FROM clusters")
+        for cluster in clusters:
+            self.add_cluster(cluster["user_id"], list(dict.fromkeys(cluster["photo_ids"])), cluster["count"])
+
+
+def open_metadata_store(save_dir, readonly=False):
+    """
+    Открывает metadata.sqlite в папке базы. Если есть только старый metadata.json — сначала мигрирует его.
+    """
+    db_path = os.path.join(save_dir, METADATA_DB)
+    json_path = os.path.join(save_dir, LEGACY_METADATA_JSON)
+    if not os.path.exists(db_path) and os.path.exists(json_path):
+        migrate_json(json_path, db_path)
+    return ClusterMetadataStore(db_path, readonly=readonly)
+
+
+def migrate_json(json_path, db_path):
+    """Однократная миграция metadata.json → metadata.sqlite (JSON переименовывается в .migrated)."""
+    with open(json_path, "r", encoding="utf-8") as f:
+        clusters = json.load(f)
+
+    store = ClusterMetadataStore(db_path)
+    with store.transaction():
+        store.replace_all(clusters)
+    store.close()
+
+    os.replace(json_path, json_path + ".migrated")
+    logger.info(f"Метаданные {len(clusters)} кластеров перенесены из {json_path} в {db_path}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Миграция metadata.json в SQLite")
+    parser.add_argument("save_dir", nargs="?", default="data/vectors")
+    args = parser.parse_args()
+
+    json_path = os.path.join(args.save_dir, LEGACY_METADATA_JSON)
+    if os.path.exists(json_path):
+        migrate_json(json_path, os.path.join(args.save_dir, METADATA_DB))
+    else:
+        logger.info(f"{json_path} не найден, мигрировать нечего")
@@ -0,0 +1,290 @@
+# метрики воркера и бота: гистограммы времени этапов, счётчики и глубины очередей в формате Prometheus
+import os
+import time
+import signal
+import bisect
+import functools
+import logging
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+METRICS_ENV = "PHOTOFINDER_METRICS"   # off | file:<путь> | http:<порт>
+PREFIX = "photofinder_"
+STAGE_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300)
+COUNT_BUCKETS = (0, 1, 2, 3, 5, 10, 20, 50, 100)
+FILE_EXPORT_INTERVAL = 15     # секунд между записями файла метрик
+
+# -- выключено по умолчанию: все функции ниже сразу возвращаются, timer() отдаёт общий пустой контекст
+enabled = False
+_toggled = False    # запись переключена сигналом, а в лог об этом ещё не написано (в обработчике сигнала лог нельзя)
+
+_lock = threading.Lock()
+_counters = {}      # (имя, метки) → значение
+_gauges = {}
+_histograms = {}    # (имя, метки) → [счётчики по корзинам, сумма, число]
+_buckets = {}       # имя гистограммы → границы корзин
+_exporter = None
+
+
+class _NoopTimer:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+_NOOP = _NoopTimer()
+
+
+class _Timer:
+    __slots__ = ("stage", "started")
+
+    def __init__(self, stage):
+        self.stage = stage
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        observe("stage_seconds", time.perf_counter() - self.started, STAGE_BUCKETS, stage=self.stage)
+        return False
+
+
+def _key(name, labels):
+    return name, tuple(sorted(labels.items()))
+
+
+def timer(stage):
+    """Контекст для замера этапа: with metrics.timer("detect"): ... → гистограмма stage_seconds{stage=...}."""
+    if _toggled:
+        _log_toggle()
+    return _Timer(stage) if enabled else _NOOP
+
+
+def timed(stage):
+    """Декоратор: время каждого вызова функции — в stage_seconds{stage=...}."""
+    def decorator(fn):
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            if not enabled:
+                return fn(*args, **kwargs)
+            with _Timer(stage):
+                return fn(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def inc(name, value=1, **labels):
+    if not enabled:
+        return
+    key = _key(name, labels)
+    with _lock:
+        _counters[key] = _counters.get(key, 0) + value
+
+
+def set_gauge(name, value, **labels):
+    if not enabled:
+        return
+    with _lock:
+        _gauges[_key(name, labels)] = value
+
+
+def observe(name, value, buckets=COUNT_BUCKETS, **labels):
+    if not enabled:
+        return
+    key = _key(name, labels)
+    with _lock:
+        hist = _histograms.get(key)
+        if hist is None:
+            _buckets.setdefault(name, tuple(buckets))
+            hist = _histograms[key] = [[0] * (len(_buckets[name]) + 1), 0.0, 0]
+        hist[0][bisect.bisect_left(_buckets[name], value)] += 1
+        hist[1] += value
+        hist[2] += 1
+
+
+def pop_state():
+    """
+    Забирает накопленные значения и обнуляет их (процесс пула передаёт их основному процессу, см. merge).
+    Глубины очередей (gauges) не передаются — они имеют смысл только в своём процессе.
+    """
+    global _counters, _histograms
+    with _lock:
+        state = {"counters": _counters, "histograms": _histograms, "buckets": dict(_buckets)}
+        _counters, _histograms = {}, {}
+    return state
+
+
+def merge(state):
+    """Добавляет значения из pop_state() другого процесса."""
+    if not enabled or not state:
+        return
+    with _lock:
+        for key, value in state["counters"].items():
+            _counters[key] = _counters.get(key, 0) + value
+        for name, buckets in state["buckets"].items():
+            _buckets.setdefault(name, buckets)
+        for key, (counts, total, n) in state["histograms"].items():
+            hist = _histograms.setdefault(key, [[0] * len(counts), 0.0, 0])
+            hist[0] = [a + b for a, b in zip(hist[0], counts)]
+            hist[1] += total
+            hist[2] += n
+
+
+def _labels(pairs, extra=()):
+    pairs = tuple(pairs) + tuple(extra)
+    if not pairs:
+        return ""
+    return "{" + ",".join(f'{k}="{v}"' for k, v in pairs) + "}"
+
+
+def render():
+    """Все метрики в текстовом формате Prometheus."""
+    lines = []
+    with _lock:
+        for kind, values in (("counter", _counters), ("gauge", _gauges)):
+            for name in sorted({name for name, _ in values}):
+                metric = PREFIX + name + ("_total" if kind == "counter" else "")
+                lines.append(f"# TYPE {metric} {kind}")
+                for (n, labels), value in sorted(values.items()):
+                    if n == name:
+                        lines.append(f"{metric}{_labels(labels)} {value}")
+        for name in sorted({name for name, _ in _histograms}):
+            metric = PREFIX + name
+            lines.append(f"# TYPE {metric} histogram")
+            for (n, labels), (counts, total, count) in sorted(_histograms.items()):
+                if n != name:
+                    continue
+                cumulative = 0
+                for bound, c in zip(_buckets[name] + ("+Inf",), counts):
+                    cumulative += c
+                    lines.append(f"{metric}_bucket{_labels(labels, [('le', bound)])} {cumulative}")
+                lines.append(f"{metric}_sum{_labels(labels)} {total}")
+                lines.append(f"{metric}_count{_labels(labels)} {count}")
+    return "\n".join(lines) + "\n"
+
+
+def write_file(path):
+    """Атомарная запись метрик в файл (для node_exporter textfile collector или просмотра)."""
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        f.write(render())
+    os.replace(tmp_path, path)
+
+
+class _FileExporter:
+    def __init__(self, path, interval=FILE_EXPORT_INTERVAL):
+        self.path = path
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, args=(interval,), name="metrics-file", daemon=True)
+        self._thread.start()
+
+    def _run(self, interval):
+        while not self._stop.wait(interval):
+            self.flush()
+
+    def flush(self):
+        try:
+            write_file(self.path)
+        except OSError as e:
+            logger.error(f"Не удалось записать метрики в {self.path}: {e}")
+
+    def close(self):
+        self._stop.set()
+        self.flush()
+
+
+class _HttpExporter:
+    def __init__(self, port, host="0.0.0.0"):
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split("?")[0] != "/metrics":
+                    self.send_error(404)
+                    return
+                payload = render().encode()
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+                self.send_header("Content-Length", str(len(payload)))
+                self.end_headers()
+                self.wfile.write(payload)
+
+            def log_message(self, *args):
+                pass
+
+        self.server = ThreadingHTTPServer((host, port), Handler)
+        threading.Thread(target=self.server.serve_forever, name="metrics-http", daemon=True).start()
+
+    def flush(self):
+        pass
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+def configure(spec=None):
+    """
+    Включает метрики и экспорт: "file:<путь>" — файл раз в FILE_EXPORT_INTERVAL секунд и при flush/close,
+    "http:<порт>" — страница /metrics для Prometheus, "off" или пусто — всё выключено.
+    По умолчанию spec берётся из переменной окружения PHOTOFINDER_METRICS.
+    """
+    global enabled, _exporter
+    if _toggled:
+        _log_toggle()
+    spec = (os.getenv(METRICS_ENV, "") if spec is None else spec).strip()
+    close()
+    if not spec or spec == "off":
+        enabled = False
+        return
+    kind, _, target = spec.partition(":")
+    if kind == "file":
+        _exporter = _FileExporter(target)
+    elif kind == "http":
+        _exporter = _HttpExporter(int(target))
+    else:
+        raise ValueError(f"Неизвестный режим метрик: {spec} (ожидается off, file:<путь> или http:<порт>)")
+    enabled = True
+    logger.info(f"📊 Метрики включены: {spec}")
+
+
+def record_only():
+    """Запись без экспорта — в процессах пула воркера (значения забирает основной процесс через pop_state)."""
+    global enabled
+    enabled = True
+
+
+def _toggle(*_):
+    """Обработчик сигнала: только переключает флаги. Лог пишется при следующем timer() или configure()."""
+    global enabled, _toggled
+    enabled = not enabled and _exporter is not None
+    _toggled = True
+
+
+def _log_toggle():
+    global _toggled
+    _toggled = False
+    logger.info(f"📊 Запись метрик {'включена' if enabled else 'приостановлена'} по сигналу")
+
+
+def install_toggle_signal(signum=getattr(signal, "SIGUSR1", None)):
+    """kill -USR1 <pid> включает/приостанавливает запись метрик работающего процесса."""
+    if signum is not None and threading.current_thread() is threading.main_thread():
+        signal.signal(signum, _toggle)
+
+
+def flush():
+    if _exporter is not None:
+        _exporter.flush()
+
+
+def close():
+    global _exporter
+    if _exporter is not None:
+        _exporter.close()
+        _exporter = None
@@ -0,0 +1,210 @@
+# проверка точности int8-профиля относительно fp32 на размеченной выборке: дрейф эмбеддингов и согласие кластеров
+import os
+import sys
+import json
+import time
+import argparse
+import logging
+import numpy as np
+from detector import FaceDetector
+from clustering import cluster_faces
+from albums import PHOTO_EXTENSIONS
+from update import THRESHOLD
+from search import SearchEngine
+from quantize import RecordingSession
+from model_profile import INT8_DIR, profile_models, read_profile_manifest, write_profile_manifest, current_fingerprints
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+DEFAULT_GATES = {
+    "min_mean_cosine": 0.98,        # средний косинус эмбеддингов int8 и fp32 одного и того же выровненного лица
+    "min_p1_cosine": 0.95,          # 1-й перцентиль косинуса (худшие лица)
+    "min_detection_recall": 0.97,   # доля лиц fp32, найденных int8-детектором (IoU ≥ IOU_MATCH)
+    "min_cluster_agreement": 0.95,  # ARI кластеров int8 относительно кластеров fp32
+    "max_label_ari_drop": 0.02,     # насколько ARI с разметкой может быть ниже, чем у fp32
+}
+MIN_SAMPLE_PHOTOS = 50              # на меньшей выборке перцентили и ARI слишком шумные
+IOU_MATCH = 0.5
+
+
+def load_sample(sample_dir):
+    """Размеченная выборка: sample_dir/<человек>/<фото>. Возвращает [(путь, метка)]."""
+    sample = []
+    for label in sorted(os.listdir(sample_dir)):
+        person_dir = os.path.join(sample_dir, label)
+        if not os.path.isdir(person_dir):
+            continue
+        sample.extend((os.path.join(person_dir, f), label)
+                      for f in sorted(os.listdir(person_dir)) if f.lower().endswith(PHOTO_EXTENSIONS))
+    return sample
+
+
+def iou(a, b):
+    x1, y1 = max(a[0], b[0]), max(a[1], b[1])
+    x2, y2 = min(a[2], b[2]), min(a[3], b[3])
+    inter = max(0.0, x2 - x1) * max(0.0, y2 - y1)
+    union = (a[2] - a[0]) * (a[3] - a[1]) + (b[2] - b[0]) * (b[3] - b[1]) - inter
+    return inter / union if union > 0 else 0.0
+
+
+def match_face(face, candidates):
+    """Номер лица из candidates с наибольшим IoU не меньше IOU_MATCH или None."""
+    overlaps = [iou(face["bbox"], c["bbox"]) for c in candidates]
+    if not overlaps or max(overlaps) < IOU_MATCH:
+        return None
+    return int(np.argmax(overlaps))
+
+
+def adjusted_rand_index(a, b):
+    """ARI двух разбиений (1.0 — совпадают, около 0 — не лучше случайного)."""
+    _, a = np.unique(np.asarray(a), return_inverse=True)
+    _, b = np.unique(np.asarray(b), return_inverse=True)
+    contingency = np.zeros((a.max() + 1, b.max() + 1), dtype=np.int64)
+    np.add.at(contingency, (a, b), 1)
+
+    def pairs(x):
+        x = np.asarray(x, dtype=np.int64)
+        return float((x * (x - 1) // 2).sum())
+
+    index = pairs(contingency)
+    rows, cols, total = pairs(contingency.sum(axis=1)), pairs(contingency.sum(axis=0)), pairs([len(a)])
+    expected = rows * cols / total if total else 0.0
+    max_index = (rows + cols) / 2
+    return 1.0 if max_index == expected else (index - expected) / (max_index - expected)
+
+
+def normalize(x):
+    x = np.asarray(x, dtype=np.float32).reshape(len(x), -1)
+    return x / np.linalg.norm(x, axis=1, keepdims=True)
+
+
+def evaluate(sample, fp32, int8, gates=DEFAULT_GATES):
+    """
+    Сравнивает детекторы fp32 и int8 на выборке [(путь, метка)]:
+    - дрейф распознавания: косинус эмбеддингов одних и тех же выровненных лиц (входы — из прогона fp32);
+    - детекция: доля лиц fp32, найденных int8, и косинус эмбеддингов главного лица сквозь весь пайплайн;
+    - кластеры: главные лица фото кластеризуются как в воркере, ARI int8 относительно fp32 и обоих — с разметкой.
+    Возвращает отчёт с метриками, порогами, списком нарушений и итогом passed.
+    """
+    paths = [path for path, _ in sample]
+
+    # -- 1. полный пайплайн fp32 (с записью входов распознавания) и int8
+    fp32_rec, int8_rec = fp32.models["recognition"], int8.models["recognition"]
+    recorder = fp32_rec.session = RecordingSession(fp32_rec.session)
+    started = time.perf_counter()
+    try:
+        fp32_faces = [fp32.align_detected(path) for path in paths]
+    finally:
+        fp32_rec.session = recorder.session
+    fp32_s = time.perf_counter() - started
+    started = time.perf_counter()
+    int8_faces = [int8.align_detected(path) for path in paths]
+    int8_s = time.perf_counter() - started
+
+    # -- 2. дрейф распознавания: одни и те же выровненные лица через обе модели
+    cosines = []
+    for feed in recorder.feeds:
+        ref = normalize(fp32_rec.session.run(fp32_rec.output_names, feed)[0])
+        test = normalize(int8_rec.session.run(int8_rec.output_names, feed)[0])
+        cosines.extend((ref * test).sum(axis=1).tolist())
+    cosines = np.asarray(cosines)
+
+    # -- 3. детекция и главное лицо каждого фото
+    total_faces = found_faces = 0
+    labels, ref_embs, test_embs = [], [], []
+    for (_, label), ref, test in zip(sample, fp32_faces, int8_faces):
+        total_faces += len(ref)
+        found_faces += sum(match_face(face, test) is not None for face in ref)
+        if not ref:
+            continue
+        main = ref[SearchEngine.dominant_face(ref)]
+        matched = match_face(main, test)
+        labels.append(label)
+        ref_embs.append(main["embedding"])
+        test_embs.append(test[matched]["embedding"] if matched is not None else None)
+
+    # -- 4. кластеры главных лиц; лицо, не найденное int8-детектором, считается отдельным кластером
+    ref_clusters = cluster_faces(normalize(ref_embs), list(range(len(labels))), THRESHOLD) if labels else np.empty(0)
+    found = [i for i, emb in enumerate(test_embs) if emb is not None]
+    test_clusters = np.arange(len(labels)) + len(labels)
+    if found:
+        test_clusters[found] = cluster_faces(normalize([test_embs[i] for i in found]), found, THRESHOLD)
+    e2e_cosines = [float((normalize([ref_embs[i]]) * normalize([test_embs[i]])).sum()) for i in found]
+
+    metrics = {
+        "photos": len(sample),
+        "labelled_faces": len(labels),
+        "recognition_runs": len(recorder.feeds),
+        "mean_cosine": round(float(cosines.mean()), 5) if len(cosines) else None,
+        "p1_cosine": round(float(np.percentile(cosines, 1)), 5) if len(cosines) else None,
+        "min_cosine": round(float(cosines.min()), 5) if len(cosines) else None,
+        "end_to_end_mean_cosine": round(float(np.mean(e2e_cosines)), 5) if e2e_cosines else None,
+        "detection_recall": round(found_faces / total_faces, 5) if total_faces else None,
+        "cluster_agreement": round(adjusted_rand_index(ref_clusters, test_clusters), 5) if labels else 0.0,
+        "label_ari_fp32": round(adjusted_rand_index(labels, ref_clusters), 5) if labels else 0.0,
+        "label_ari_int8": round(adjusted_rand_index(labels, test_clusters), 5) if labels else 0.0,
+        # -- справочно: время пайплайна на фото (fp32 заодно записывает входы, поэтому чуть медленнее)
+        "fp32_ms_per_photo": round(1000 * fp32_s / len(paths), 1),
+        "int8_ms_per_photo": round(1000 * int8_s / len(paths), 1),
+    }
+
+    failures = []
+    if len(sample) < MIN_SAMPLE_PHOTOS:
+        failures.append(f"выборка меньше {MIN_SAMPLE_PHOTOS} фото")
+    if metrics["mean_cosine"] is None or metrics["mean_cosine"] < gates["min_mean_cosine"]:
+        failures.append(f"mean_cosine {metrics['mean_cosine']} < {gates['min_mean_cosine']}")
+    if metrics["p1_cosine"] is None or metrics["p1_cosine"] < gates["min_p1_cosine"]:
+        failures.append(f"p1_cosine {metrics['p1_cosine']} < {gates['min_p1_cosine']}")
+    if metrics["detection_recall"] is None or metrics["detection_recall"] < gates["min_detection_recall"]:
+        failures.append(f"detection_recall {metrics['detection_recall']} < {gates['min_detection_recall']}")
+    if metrics["cluster_agreement"] < gates["min_cluster_agreement"]:
+        failures.append(f"cluster_agreement {metrics['cluster_agreement']} < {gates['min_cluster_agreement']}")
+    if metrics["label_ari_fp32"] - metrics["label_ari_int8"] > gates["max_label_ari_drop"]:
+        failures.append(f"label_ari_int8 {metrics['label_ari_int8']} хуже fp32 {metrics['label_ari_fp32']} "
+                        f"больше чем на {gates['max_label_ari_drop']}")
+
+    return {"passed": not failures, "metrics": metrics, "gates": dict(gates), "failures": failures}
+
+
+def check_profile(sample_dir, gates=DEFAULT_GATES, profile_dir=INT8_DIR):
+    """
+    Проверяет текущие квантованные модели профиля и записывает результат в его манифест.
+    Профиль int8 включается (model_profile.profile_models) только при passed и только для проверенных файлов.
+    """
+    manifest = read_profile_manifest(profile_dir)
+    if manifest is None:
+        raise RuntimeError("Профиль int8 не собран: сначала запустите python ml_worker/quantize.py")
+    sample = load_sample(sample_dir)
+    if not sample:
+        raise RuntimeError(f"В {sample_dir} нет размеченных фото (ожидается {sample_dir}/<человек>/<фото>)")
+
+    fingerprints = current_fingerprints(manifest, profile_dir)
+    fp32 = FaceDetector(device="cpu", model_files={})
+    int8 = FaceDetector(device="cpu", model_files=profile_models("int8", verified=False, profile_dir=profile_dir))
+    logger.info(f"🔬 Проверка точности int8 на {len(sample)} фото из {sample_dir}")
+    report = evaluate(sample, fp32, int8, gates)
+    report.update(evaluated=time.strftime("%Y-%m-%dT%H:%M:%S"), sample_dir=sample_dir, models=fingerprints)
+
+    manifest["accuracy"] = report
+    write_profile_manifest(manifest, profile_dir)
+    if report["passed"]:
+        logger.info("✅ Проверка пройдена, профиль int8 можно включать: PHOTOFINDER_MODEL_PROFILE=int8")
+    else:
+        logger.warning(f"❌ Проверка не пройдена, профиль int8 останется выключенным: {'; '.join(report['failures'])}")
+    return report
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Проверка точности int8-моделей относительно fp32")
+    parser.add_argument("sample_dir", help="размеченная выборка: папки по людям с их фото")
+    parser.add_argument("--gates", help="JSON с порогами вместо значений по умолчанию (можно частично)")
+    args = parser.parse_args()
+
+    gates = dict(DEFAULT_GATES)
+    if args.gates:
+        with open(args.gates, "r", encoding="utf-8") as f:
+            gates.update(json.load(f))
+    report = check_profile(args.sample_dir, gates)
+    print(json.dumps(report, indent=2, ensure_ascii=False))
+    sys.exit(0 if report["passed"] else 1)
@@ -0,0 +1,83 @@
+# профили моделей: fp32 (исходный buffalo_l) и int8 (квантованные детектор и распознавание для CPU)
+import os
+import json
+import logging
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+PROFILE_ENV = "PHOTOFINDER_MODEL_PROFILE"     # fp32 | int8
+PROFILES = ("fp32", "int8")
+INT8_DIR = "data/models/int8"                 # квантованные модели и их манифест (создаёт quantize.py)
+PROFILE_MANIFEST = "profile.json"
+
+
+def file_fingerprint(path):
+    """Размер и mtime файла: по ним видно, что модели не менялись после проверки точности."""
+    stat = os.stat(path)
+    return {"size": stat.st_size, "mtime_ns": stat.st_mtime_ns}
+
+
+def manifest_path(profile_dir=INT8_DIR):
+    return os.path.join(profile_dir, PROFILE_MANIFEST)
+
+
+def read_profile_manifest(profile_dir=INT8_DIR):
+    """Манифест int8-профиля или None, если квантованные модели ещё не собраны."""
+    try:
+        with open(manifest_path(profile_dir), "r", encoding="utf-8") as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return None
+
+
+def write_profile_manifest(manifest, profile_dir=INT8_DIR):
+    """Атомарная запись манифеста (читающий бот не увидит его недописанным)."""
+    os.makedirs(profile_dir, exist_ok=True)
+    path = manifest_path(profile_dir)
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(manifest, f, indent=2, ensure_ascii=False)
+    os.replace(tmp_path, path)
+
+
+def current_fingerprints(manifest, profile_dir=INT8_DIR):
+    """Отпечатки квантованных файлов из манифеста в их текущем виде на диске."""
+    return {source: file_fingerprint(os.path.join(profile_dir, entry["file"]))
+            for source, entry in manifest["models"].items()}
+
+
+def profile_models(profile=None, verified=True, profile_dir=INT8_DIR):
+    """
+    Замены файлов пакета моделей для профиля: {имя исходной модели: путь к квантованной}.
+    profile — "fp32" или "int8" (по умолчанию из PHOTOFINDER_MODEL_PROFILE, иначе fp32).
+    int8 включается, только если проверка точности (model_accuracy.py) прошла именно на этих файлах;
+    иначе — предупреждение и исходные fp32-модели ({}). verified=False не требует пройденной проверки (его использует сама проверка).
+    """
+    profile = profile or os.getenv(PROFILE_ENV, "fp32")
+    if profile not in PROFILES:
+        raise ValueError(f"Неизвестный профиль моделей: {profile} (ожидается {', '.join(PROFILES)})")
+    if profile == "fp32":
+        return {}
+
+    manifest = read_profile_manifest(profile_dir)
+    if manifest is None:
+        logger.warning(f"⚠️ Профиль int8 не собран ({manifest_path(profile_dir)} нет), используются fp32-модели")
+        return {}
+    try:
+        fingerprints = current_fingerprints(manifest, profile_dir)
+    except OSError as e:
+        logger.warning(f"⚠️ Квантованные модели недоступны ({e}), используются fp32-модели")
+        return {}
+
+    if verified:
+        accuracy = manifest.get("accuracy") or {}
+        if not accuracy.get("passed"):
+            reason = "не пройдена" if accuracy else "не запускалась"
+            logger.warning(f"⚠️ Проверка точности int8-моделей {reason} (ml_worker/model_accuracy.py), используются fp32-модели")
+            return {}
+        if accuracy.get("models") != fingerprints:
+            logger.warning("⚠️ Квантованные модели изменились после проверки точности, используются fp32-модели")
+            return {}
+
+    return {source: os.path.join(profile_dir, entry["file"]) for source, entry in manifest["models"].items()}
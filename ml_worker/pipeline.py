@@ -0,0 +1,134 @@
+# потоковая обработка: фото анализируются по мере скачивания с Google Drive, база обновляется пакетами
+import os
+import sys
+import time
+import queue
+import argparse
+import threading
+import logging
+
+# загрузчик лежит в scr/
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'scr'))
+import load_photos
+from worker import VECTOR_DIR, iter_faces, commit_batch
+from manifest import IngestManifest
+from face_store import FaceEmbeddingStore
+from albums import RAW_DIR, USERS_DIR, PHOTO_EXTENSIONS, LINK_MODES
+from derivatives import DERIVATIVES_DIR
+from events import shard_paths
+import metrics
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+DOWNLOAD_QUEUE = 64       # скачанных, но ещё не взятых в обработку фото (дальше загрузчик ждёт)
+COMMIT_EVERY = 200        # фото в одном пакете обновления базы
+COMMIT_INTERVAL = 300     # секунд: при медленном скачивании пакет фиксируется не реже
+
+
+def run_pipeline(folder_id, workers=1, user_folders="hardlink", download_threads=load_photos.DOWNLOAD_THREADS,
+                 commit_every=COMMIT_EVERY, commit_interval=COMMIT_INTERVAL,
+                 input_dir=RAW_DIR, users_dir=USERS_DIR, vector_dir=VECTOR_DIR, derivatives_dir=DERIVATIVES_DIR,
+                 drive_manifest=load_photos.SYNC_MANIFEST_PATH):
+    """
+    Скачивание и анализ одновременно: загрузчик (load_photos.sync_folder) в отдельном потоке кладёт пути
+    скачанных файлов в ограниченную очередь, а воркер (iter_faces) обрабатывает их по мере поступления.
+    Сначала обрабатываются фото, скачанные раньше, но ещё не попавшие в базу.
+    Каждый скачанный файл, как и при обычном запуске, проходит через IngestManifest.filter_new:
+    копии и переименования уже обработанных фото не анализируются, а фиксируются с ближайшим пакетом.
+    Результаты фиксируются в базе (update_db, снимок для бота, манифест) пакетами по commit_every фото
+    или раз в commit_interval секунд, поэтому бот видит новые альбомы, не дожидаясь конца скачивания,
+    а прерванный запуск теряет не больше одного пакета.
+    Папки и манифест синхронизации — общие или шарда мероприятия (events.shard_paths).
+    """
+    os.makedirs(vector_dir, exist_ok=True)
+    os.makedirs(users_dir, exist_ok=True)
+    store = FaceEmbeddingStore(os.path.join(vector_dir, "faces"))
+    manifest = IngestManifest(os.path.join(vector_dir, "ingest_manifest.sqlite"))
+
+    os.makedirs(input_dir, exist_ok=True)
+    pending, copies = manifest.filter_new([
+        os.path.join(input_dir, filename)
+        for filename in sorted(os.listdir(input_dir))
+        if filename.lower().endswith(PHOTO_EXTENSIONS)
+    ])
+
+    downloaded = queue.Queue(maxsize=DOWNLOAD_QUEUE)
+    sync_stats = {}
+
+    def download():
+        try:
+            sync_stats.update(load_photos.sync_folder(folder_id, input_dir, manifest_path=drive_manifest,
+                                                      download_threads=download_threads, on_file=downloaded.put))
+        except Exception as e:
+            logger.error(f"Ошибка синхронизации с Google Drive: {e}", exc_info=True)
+        finally:
+            downloaded.put(None)    # конец потока файлов
+
+    def paths():
+        # -- генератор читается в основном потоке (iter_faces), там же, где манифест пишет commit_batch
+        yield from pending
+        while True:
+            path = downloaded.get()
+            metrics.set_gauge("queue_depth", downloaded.qsize(), queue="download")
+            if path is None:
+                return
+            new_paths, found = manifest.filter_new([path], log=False)
+            copies.update(found)
+            yield from new_paths
+
+    downloader = threading.Thread(target=download, name="drive-sync", daemon=True)
+    downloader.start()
+
+    batch, photos, faces, batches = [], 0, 0, 0
+    last_commit = time.monotonic()
+    try:
+        for result in iter_faces(paths(), workers):
+            batch.append(result)
+            if len(batch) >= commit_every or time.monotonic() - last_commit >= commit_interval:
+                faces += commit_batch(batch, store, manifest, user_folders=user_folders, copies=copies,
+                                      input_dir=input_dir, users_dir=users_dir, vector_dir=vector_dir,
+                                      derivatives_dir=derivatives_dir)
+                copies.clear()  # копии уже обработанных фото фиксируются с ближайшим пакетом
+                photos, batches = photos + len(batch), batches + 1
+                logger.info(f"📦 Пакет {batches}: {len(batch)} фото зафиксировано в базе (всего {photos})")
+                batch, last_commit = [], time.monotonic()
+        if batch or copies:
+            faces += commit_batch(batch, store, manifest, user_folders=user_folders, copies=copies,
+                                  input_dir=input_dir, users_dir=users_dir, vector_dir=vector_dir,
+                                  derivatives_dir=derivatives_dir)
+            photos, batches = photos + len(batch), batches + 1
+    finally:
+        manifest.close()
+    downloader.join()
+
+    logger.info(f"✅ Потоковая обработка завершена: {photos} фото, {faces} лиц, пакетов: {batches}")
+    return {"photos": photos, "faces": faces, "batches": batches, "sync": sync_stats}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Скачивание фото с Google Drive и обработка по мере загрузки")
+    parser.add_argument("url", nargs="?", help="ссылка на папку Google Drive (если не указана — будет запрошена)")
+    parser.add_argument("--workers", type=int, default=1, help="число процессов для обработки фото")
+    parser.add_argument("--threads", type=int, default=load_photos.DOWNLOAD_THREADS, help="параллельных скачиваний")
+    parser.add_argument("--commit-every", type=int, default=COMMIT_EVERY, help="фото в одном пакете обновления базы")
+    parser.add_argument("--commit-interval", type=float, default=COMMIT_INTERVAL,
+                        help="секунд между обновлениями базы при медленном скачивании")
+    parser.add_argument("--user-folders", choices=LINK_MODES, default="hardlink",
+                        help="как собирать папки data/photos/users")
+    parser.add_argument("--event", help="мероприятие: фото и база в data/events/<мероприятие> (см. events.py)")
+    parser.add_argument("--metrics", default=os.getenv(metrics.METRICS_ENV, "off"),
+                        help="экспорт метрик: off, file:<путь> (формат Prometheus) или http:<порт>")
+    args = parser.parse_args()
+
+    metrics.configure(args.metrics)
+    metrics.install_toggle_signal()
+
+    paths = shard_paths(args.event)
+    admin_url = args.url or input("Вставьте ссылку на папку Google Drive: ")
+    run_pipeline(load_photos.extract_folder_id_from_url(admin_url), workers=args.workers,
+                 user_folders=args.user_folders, download_threads=args.threads,
+                 commit_every=args.commit_every, commit_interval=args.commit_interval,
+                 input_dir=paths["raw_dir"], users_dir=paths["users_dir"], vector_dir=paths["vector_dir"],
+                 derivatives_dir=paths["derivatives_dir"], drive_manifest=paths["drive_manifest"])
+    metrics.close()
@@ -0,0 +1,88 @@
+# фильтр качества лиц перед распознаванием: уверенность детектора, размер, поворот головы, размытие
+import os
+import json
+from collections import Counter
+import cv2
+import metrics
+
+QUALITY_CONFIG_PATH = "data/vectors/quality_config.json"
+
+DEFAULT_QUALITY_CONFIG = {
+    "min_det_score": 0.6,      # уверенность детектора
+    "min_face_size": 32,       # короткая сторона рамки лица в пикселях исходного фото
+    "max_yaw": 45,             # поворот головы влево-вправо, градусы
+    "max_pitch": 40,           # наклон вверх-вниз, градусы
+    "min_sharpness": 30.0,     # дисперсия лапласиана выровненного лица 112×112 (меньше — размыто)
+}
+
+REJECT_REASONS = ("det_score", "size", "pose", "blur")
+
+
+def load_quality_config(path=QUALITY_CONFIG_PATH):
+    """Пороги фильтра: значения по умолчанию ← data/vectors/quality_config.json (0 отключает проверку)."""
+    config = dict(DEFAULT_QUALITY_CONFIG)
+    if os.path.exists(path):
+        with open(path, "r", encoding="utf-8") as f:
+            config.update(json.load(f))
+    return config
+
+
+def sharpness(aligned_face):
+    """Резкость выровненного лица: дисперсия лапласиана по яркости."""
+    gray = cv2.cvtColor(aligned_face, cv2.COLOR_BGR2GRAY)
+    return float(cv2.Laplacian(gray, cv2.CV_64F).var())
+
+
+class QualityGate:
+    """
+    Решает, стоит ли распознавать лицо. Проверки идут от дешёвых к дорогим:
+    det_score и размер рамки → поза (по landmark_3d_68) → резкость выровненного лица.
+    Отклонённые лица не попадают ни в распознавание, ни в кластеризацию, ни в поиск.
+    Считает принятые и отклонённые по причинам лица (pop_stats — за период с прошлого вызова).
+    """
+    def __init__(self, config=None):
+        self.config = dict(DEFAULT_QUALITY_CONFIG, **(config or {}))
+        self.stats = Counter()
+
+    def check_detection(self, face, scale=1):
+        """Проверки до landmarks: уверенность детектора и размер. Возвращает причину отказа или None."""
+        if face.det_score < self.config["min_det_score"]:
+            return self._reject("det_score")
+        x1, y1, x2, y2 = face.bbox
+        if min(x2 - x1, y2 - y1) * scale < self.config["min_face_size"]:
+            return self._reject("size")
+        return None
+
+    def check_pose(self, face):
+        if getattr(face, "pose", None) is None:
+            return None         # landmark_3d_68 не загружен — поза неизвестна
+        pitch, yaw = abs(face.pose[0]), abs(face.pose[1])
+        if (self.config["max_yaw"] and yaw > self.config["max_yaw"]) or \
+                (self.config["max_pitch"] and pitch > self.config["max_pitch"]):
+            return self._reject("pose")
+        return None
+
+    def check_sharpness(self, aligned_face):
+        if self.config["min_sharpness"] and sharpness(aligned_face) < self.config["min_sharpness"]:
+            return self._reject("blur")
+        return None
+
+    def accept(self):
+        self.stats["accepted"] += 1
+        metrics.inc("faces_accepted")
+
+    def _reject(self, reason):
+        self.stats[reason] += 1
+        metrics.inc("faces_rejected", reason=reason)
+        return reason
+
+    def pop_stats(self):
+        stats, self.stats = self.stats, Counter()
+        return stats
+
+
+def format_stats(stats):
+    """Строка для лога: принято / отклонено по причинам."""
+    rejected = sum(stats[r] for r in REJECT_REASONS)
+    reasons = ", ".join(f"{r}: {stats[r]}" for r in REJECT_REASONS if stats[r])
+    return f"принято {stats['accepted']}, отклонено {rejected}" + (f" ({reasons})" if reasons else "")
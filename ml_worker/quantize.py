@@ -0,0 +1,143 @@
+# калибровка и int8-квантование детектора и модели распознавания buffalo_l для CPU (профиль int8)
+import os
+import time
+import random
+import argparse
+import tempfile
+import logging
+import numpy as np
+import onnxruntime
+from onnxruntime.quantization import (CalibrationDataReader, CalibrationMethod, QuantFormat, QuantType,
+                                      quant_pre_process, quantize_static)
+from detector import FaceDetector, MODEL_PACK
+from albums import RAW_DIR, PHOTO_EXTENSIONS
+from model_profile import INT8_DIR, write_profile_manifest
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+# landmark_3d_68 остаётся fp32: модель маленькая, а от её точности зависит поза в фильтре качества
+QUANTIZED_TASKS = ("detection", "recognition")
+CALIBRATION_PHOTOS = 100        # фото для калибровки (входы детектора — около 5 МБ на фото в памяти)
+CALIBRATION_METHODS = ("minmax", "percentile", "entropy")
+
+
+class RecordingSession:
+    """
+    ONNX-сессия, запоминающая входы каждого run. Калибровка видит ровно те тензоры, что модели получают
+    в пайплайне: уменьшенное фото в рамке детектора и выровненные лица после фильтра качества.
+    """
+    def __init__(self, session):
+        self.session = session
+        self.feeds = []
+
+    def run(self, output_names, input_feed, *args, **kwargs):
+        self.feeds.append({name: np.array(value, copy=True) for name, value in input_feed.items()})
+        return self.session.run(output_names, input_feed, *args, **kwargs)
+
+    def __getattr__(self, name):
+        return getattr(self.session, name)
+
+
+def record_inputs(detector, photo_paths, tasks=QUANTIZED_TASKS):
+    """
+    Прогоняет фото через детектор и возвращает {taskname: [входы моделей]}.
+    Сессии моделей на время прогона подменяются записывающими.
+    """
+    recorders = {task: RecordingSession(detector.models[task].session) for task in tasks if task in detector.models}
+    for task, recorder in recorders.items():
+        detector.models[task].session = recorder
+    try:
+        for path in photo_paths:
+            try:
+                detector.analyze(path)
+            except ValueError as e:
+                logger.error(f"Фото для калибровки пропущено: {e}")
+    finally:
+        for task, recorder in recorders.items():
+            detector.models[task].session = recorder.session
+    return {task: recorder.feeds for task, recorder in recorders.items()}
+
+
+def quantize_model(model_file, output_path, feeds, method="minmax", per_channel=True, reduce_range=False):
+    """
+    Статическое int8-квантование (QDQ: веса int8 по каналам, активации uint8) с калибровкой диапазонов
+    активаций на feeds. Перед квантованием граф упрощается (свёртка BatchNorm в Conv и т. п.).
+    reduce_range=True — 7-битные веса для процессоров без VNNI (без насыщения в U8S8-умножении).
+    """
+    class FeedReader(CalibrationDataReader):
+        def __init__(self):
+            self._feeds = iter(feeds)
+
+        def get_next(self):
+            return next(self._feeds, None)
+
+    calibrate_method = {"minmax": CalibrationMethod.MinMax, "percentile": CalibrationMethod.Percentile,
+                        "entropy": CalibrationMethod.Entropy}[method]
+    os.makedirs(os.path.dirname(output_path) or ".", exist_ok=True)
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        prepared = os.path.join(tmp_dir, "prepared.onnx")
+        quant_pre_process(model_file, prepared, skip_symbolic_shape=True)
+        tmp_path = f"{output_path}.{os.getpid()}.tmp"
+        quantize_static(prepared, tmp_path, FeedReader(), quant_format=QuantFormat.QDQ, per_channel=per_channel,
+                        reduce_range=reduce_range, activation_type=QuantType.QUInt8, weight_type=QuantType.QInt8,
+                        calibrate_method=calibrate_method)
+    os.replace(tmp_path, output_path)
+    logger.info(f"💾 {os.path.basename(model_file)} → {output_path} "
+                f"({os.path.getsize(model_file) / 2 ** 20:.1f} → {os.path.getsize(output_path) / 2 ** 20:.1f} МБ)")
+
+
+def calibrate(photos_dir=RAW_DIR, limit=CALIBRATION_PHOTOS, method="minmax", per_channel=True, reduce_range=False,
+              profile_dir=INT8_DIR, seed=0):
+    """
+    Собирает профиль int8: калибрует и квантует детектор и модель распознавания на фото мероприятия.
+    Новый манифест не содержит результата проверки точности, поэтому профиль включится только
+    после успешного model_accuracy.py.
+    """
+    if method not in CALIBRATION_METHODS:
+        raise ValueError(f"Неизвестный метод калибровки: {method} (ожидается {', '.join(CALIBRATION_METHODS)})")
+    paths = sorted(os.path.join(photos_dir, f) for f in os.listdir(photos_dir) if f.lower().endswith(PHOTO_EXTENSIONS))
+    if not paths:
+        raise RuntimeError(f"В {photos_dir} нет фото для калибровки")
+    random.Random(seed).shuffle(paths)
+    paths = paths[:limit]
+
+    detector = FaceDetector(device="cpu", model_files={})
+    logger.info(f"🎯 Калибровка на {len(paths)} фото из {photos_dir}")
+    feeds = record_inputs(detector, paths)
+    if not feeds.get("recognition"):
+        raise RuntimeError("На калибровочных фото не найдено ни одного лица, прошедшего фильтр качества")
+
+    models = {}
+    for task, task_feeds in feeds.items():
+        model_file = detector.models[task].model_file
+        name = os.path.splitext(os.path.basename(model_file))[0] + ".int8.onnx"
+        logger.info(f"⚙️ Квантование {task}: {len(task_feeds)} калибровочных прогонов, метод {method}")
+        quantize_model(model_file, os.path.join(profile_dir, name), task_feeds, method, per_channel, reduce_range)
+        models[os.path.basename(model_file)] = {"task": task, "file": name}
+
+    write_profile_manifest({
+        "pack": MODEL_PACK,
+        "created": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "onnxruntime": onnxruntime.__version__,
+        "calibration": {"photos": len(paths), "photos_dir": photos_dir, "method": method,
+                        "per_channel": per_channel, "reduce_range": reduce_range,
+                        "runs": {task: len(task_feeds) for task, task_feeds in feeds.items()}},
+        "models": models,
+    }, profile_dir)
+    logger.info("✅ Квантованные модели готовы. Профиль int8 включится после проверки точности: "
+                "python ml_worker/model_accuracy.py <папка с размеченной выборкой>")
+    return models
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Калибровка и int8-квантование моделей детекции и распознавания")
+    parser.add_argument("--photos-dir", default=RAW_DIR, help="фото для калибровки (лучше — с того же мероприятия)")
+    parser.add_argument("--limit", type=int, default=CALIBRATION_PHOTOS, help="сколько фото взять (случайная выборка)")
+    parser.add_argument("--method", choices=CALIBRATION_METHODS, default="minmax", help="метод калибровки диапазонов")
+    parser.add_argument("--per-tensor", action="store_true", help="один масштаб на весь тензор весов вместо масштаба на канал")
+    parser.add_argument("--reduce-range", action="store_true", help="7-битные веса (процессоры x86 без VNNI)")
+    args = parser.parse_args()
+
+    calibrate(args.photos_dir, args.limit, args.method, per_channel=not args.per_tensor,
+              reduce_range=args.reduce_range)
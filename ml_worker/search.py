@@ -1,114 +1,514 @@
 # принимает фото, извлекает embedding, ищет совпадения
 import os
-import json
-import faiss
+import sys
+import time
+import sqlite3
+import heapq
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 import numpy as np
-from ml_worker.detector import FaceDetector             # класс-детект
+
+# модули ml_worker импортируют друг друга напрямую (как при запуске worker.py)
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from detector import FaceDetector             # класс-детект
+from decode import decode_bytes
+from quality import REJECT_REASONS, format_stats
+import metrics
+from index_factory import load_index_config, apply_search_params, read_index_mmap, needs_rerank, search_centroids
+from metadata_store import ClusterMetadataStore, METADATA_DB
+from snapshot import current_snapshot, ensure_snapshot, read_manifest, CENTROID_INDEX
+from albums import RAW_DIR, PHOTO_EXTENSIONS, user_album
+from events import EVENTS_DIR, list_events, shard_paths
 import logging
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
-def vectorize_face(input_path):               # ./путь/img_334.jpg
-    detector = FaceDetector(device="cpu")
+VECTOR_DIR = "data/vectors"               # путь к FAISS базе
+TEMPORARY_DIR = "data/photos/temporary"   # путь к временному хранилищу фоток, отправляемых пользователями
+THRESHOLD = 0.6                           # порог косинусного сходства
+RESULT_CACHE_SIZE = 1024                  # результатов поиска в кэше (ключ — file_unique_id из Telegram)
+RESULT_CACHE_TTL = 600                    # секунд
+EMBEDDING_CACHE_SIZE = 4096               # эмбеддингов присланных фото в кэше
+EMBEDDING_CACHE_TTL = 3600
+TOP_K = 5                                 # ближайших кластеров на каждое лицо запроса
+MAX_MATCHES = 5                           # сколько альбомов возвращается на одно фото
+SHARD_SCAN_INTERVAL = 10                  # секунд между проверками созданных и удалённых мероприятий
+FANOUT_THREADS = 4                        # шардов, которые ищутся одновременно
+
+
+class TTLCache:
+    """
+    Потокобезопасный LRU-кэш с временем жизни записей.
+    get возвращает (True, значение) или (False, None) — значением может быть и None («не найдено»).
+    """
+    def __init__(self, maxsize, ttl):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            item = self._data.get(key)
+            if item is None:
+                return False, None
+            expires, value = item
+            if expires < time.monotonic():
+                del self._data[key]
+                return False, None
+            self._data.move_to_end(key)
+            return True, value
+
+    def put(self, key, value):
+        with self._lock:
+            self._data[key] = (time.monotonic() + self.ttl, value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+
+class IndexShard:
+    """
+    Одна векторная база: общая data/vectors (event=None) или база мероприятия из data/events.
+    Индекс и метаданные читаются из неизменяемого снимка, на который указывает <vector_dir>/CURRENT.
+    Когда воркер публикует новый снимок, перед следующим поиском загружается новая версия,
+    а до конца загрузки запросы обслуживает прежняя. Индекс отображается в память (mmap),
+    поэтому несколько процессов бота делят одну копию векторов.
+    """
+    def __init__(self, vector_dir, raw_dir=RAW_DIR, index_config=None, event=None):
+        self.event = event
+        self.vector_dir = vector_dir
+        self.raw_dir = raw_dir
+        self.index_config = index_config or load_index_config()
+        # (индекс, метаданные кластеров, имя снимка, точные центроиды для IVF-PQ или None) — заменяются одной ссылкой,
+        # метаданные только для чтения
+        self._loaded = None
+        self._lock = threading.Lock()
+
+    @property
+    def name(self):
+        return f"мероприятие {self.event}" if self.event is not None else "общая база"
+
+    @property
+    def version(self):
+        """Имя загруженного снимка (None — база ещё не загружена)."""
+        loaded = self._loaded
+        return loaded[2] if loaded is not None else None
+
+    @property
+    def index(self):
+        loaded = self._loaded
+        return loaded[0] if loaded is not None else None
 
-    vector_dir = "data/vectors"               # путь к FAISS базе
-    users_dir = "data/photos/users"           # путь к фоткам
-    temporary_dir = "data/photos/temporary"   # путь к временному хранилищу фоток, отправляемых пользователями
+    def reload_if_changed(self):
+        """
+        Переключается на текущий снимок, если воркер опубликовал новый.
+        Возвращает True, если база в памяти готова к поиску.
+        """
+        snapshot_dir = current_snapshot(self.vector_dir)
+        if snapshot_dir is None or snapshot_dir == self.version:
+            return self._loaded is not None
 
-    os.makedirs(temporary_dir, exist_ok=True)
+        with self._lock:
+            if snapshot_dir == self.version:
+                return self._loaded is not None
 
-    if input_path.lower().endswith(('.jpg', '.jpeg', '.png', '.gif', '.bmp', '.webp')):
-        # -- детекция лица
-        success = detector.is_detect(input_path)
+            try:
+                manifest = read_manifest(snapshot_dir)
+                meta_store = ClusterMetadataStore(os.path.join(snapshot_dir, METADATA_DB), readonly=True)
+                index = read_index_mmap(os.path.join(snapshot_dir, manifest["search_index"]))
+                # -- сходство IVF-PQ приблизительное: кандидаты пересчитываются по точным центроидам снимка
+                centroids = None
+                if needs_rerank(index):
+                    centroids = read_index_mmap(os.path.join(snapshot_dir, CENTROID_INDEX))
+            except (OSError, RuntimeError, sqlite3.Error) as e:
+                # -- снимок уже удалён или повреждён: продолжаем работать на прежней версии
+                logger.error(f"Не удалось загрузить снимок {snapshot_dir}: {e}")
+                return self._loaded is not None
+            apply_search_params(index, self.index_config)
 
-        if not success:
-            logger.error("Лицо не найдено на изображении")
+            n_meta = len(meta_store)
+            if n_meta != index.ntotal:
+                logger.error(f"Несоответствие в снимке {snapshot_dir}: индекс содержит {index.ntotal} векторов, а метаданных {n_meta}")
+                meta_store.close()
+                return self._loaded is not None
+
+            # -- запросы, начатые на прежней версии, дорабатывают со своими ссылками на индекс и метаданные
+            self._loaded = (index, meta_store, snapshot_dir, centroids)
+            logger.info(f"Загружен снимок базы {manifest['version']} ({self.name}): {index.ntotal} кластеров")
+
+        return True
+
+    def search(self, queries, top_k):
+        """
+        k ближайших кластеров шарда для каждого запроса: (similarities, user_ids, метаданные той же версии,
+        что индекс) или None, если база не загружена или пуста.
+        """
+        loaded = self._loaded
+        if loaded is None or loaded[0].ntotal == 0:
             return None
+        index, meta_store, _, centroids = loaded
+        sims, idxs = search_centroids(index, centroids, queries, k=min(top_k, index.ntotal))
+        return sims, idxs, meta_store
 
-        # -- выравнивание лица и получение эмбеддинга
-        aligned_face_info = detector.align_detected(input_path)
+    def list_user_photos(self, user_id, meta_store=None):
+        """
+        Возвращает список фото пользователя — альбом из метаданных кластера (пути к исходным фото).
+        """
+        return user_album(meta_store or self._loaded[1], user_id, self.raw_dir)
 
-        emb = np.array(aligned_face_info[0]["embedding"], dtype=np.float32)
-        emb /= np.linalg.norm(emb)   # нормализуем для cosine similarity
+    def close(self):
+        loaded, self._loaded = self._loaded, None
+        if loaded is not None:
+            loaded[1].close()
 
-        # -- удаление исходного фото
-        os.remove(input_path)
 
-        # -- загрузка FAISS индекса
-        faiss_index_path = os.path.join(vector_dir, "faiss_index.idx")
+class SearchEngine:
+    """
+    Долгоживущий поисковый движок по шардам: базам мероприятий (data/events/<мероприятие>)
+    и общей базе data/vectors, если она есть. Модели загружаются один раз при старте, запросы обслуживаются из памяти.
+    Эмбеддинги лиц присланного фото считаются один раз: если мероприятие известно, поиск идёт только в его шарде,
+    иначе — во всех шардах параллельно, и их top-k объединяются в общий.
+    Каждый шард переходит на новые снимки своей базы независимо (IndexShard), а созданные и удалённые
+    мероприятия подхватываются без перезапуска (не реже раза в SHARD_SCAN_INTERVAL секунд).
+    Результаты поиска и эмбеддинги кэшируются по ключу запроса (file_unique_id фото в Telegram);
+    результат запоминается вместе с версиями снимков и после публикации нового снимка не используется.
+    """
+    def __init__(self, vector_dir=VECTOR_DIR, raw_dir=RAW_DIR, threshold=THRESHOLD, device="cpu",
+                 top_k=TOP_K, max_matches=MAX_MATCHES, events_dir=EVENTS_DIR):
+        self.vector_dir = vector_dir
+        self.raw_dir = raw_dir
+        self.events_dir = events_dir
+        self.threshold = threshold
+        self.top_k = top_k
+        self.max_matches = max_matches
+
+        # параметры поиска (ef_search / nprobe) — из той же конфигурации, что у воркера
+        self.index_config = load_index_config()
+
+        # база, собранная до появления снимков, публикуется как первый снимок
+        ensure_snapshot(vector_dir, self.index_config)
+
+        # тот же фильтр качества лиц, что у воркера (data/vectors/quality_config.json)
+        self.detector = FaceDetector(device=device)
+
+        self.shards = {}              # мероприятие (None — общая база) → IndexShard; заменяется целиком
+        self._shards_lock = threading.Lock()
+        self._scanned = None          # время последней проверки списка мероприятий
+        # FAISS отпускает GIL на время поиска, поэтому шарды ищутся в потоках действительно параллельно
+        self._executor = ThreadPoolExecutor(max_workers=FANOUT_THREADS, thread_name_prefix="shard-search")
+
+        self.result_cache = TTLCache(RESULT_CACHE_SIZE, RESULT_CACHE_TTL)         # (мероприятие, ключ) → (снимки, результат)
+        self.embedding_cache = TTLCache(EMBEDDING_CACHE_SIZE, EMBEDDING_CACHE_TTL)  # ключ → лица фото (или [])
+
+        self.reload_if_changed()
+
+    def refresh_shards(self, force=True):
+        """
+        Подключает созданные мероприятия и отключает удалённые (events.py create / drop).
+        force=False — не чаще раза в SHARD_SCAN_INTERVAL секунд.
+        """
+        now = time.monotonic()
+        if not force and self._scanned is not None and now - self._scanned < SHARD_SCAN_INTERVAL:
+            return
+        with self._shards_lock:
+            self._scanned = now
+            events = list_events(self.events_dir)
+            shards = dict(self.shards)
+            if None not in shards and current_snapshot(self.vector_dir) is not None:
+                shards[None] = IndexShard(self.vector_dir, self.raw_dir, self.index_config)
+            for event in events:
+                if event not in shards:
+                    paths = shard_paths(event, self.events_dir)
+                    shards[event] = IndexShard(paths["vector_dir"], paths["raw_dir"], self.index_config, event)
+                    logger.info(f"🗂 Подключено мероприятие {event}")
+            for event in [e for e in shards if e is not None and e not in events]:
+                # -- запросы, уже взявшие шард, дорабатывают с ним; метаданные закроются вместе с объектом
+                del shards[event]
+                logger.info(f"🗂 Мероприятие {event} удалено из поиска")
+            self.shards = shards
 
-        if not os.path.exists(faiss_index_path):
+    def _scope(self, event=None):
+        """Шарды для поиска: только мероприятия event, если оно есть, иначе все."""
+        shards = self.shards
+        if event is not None and event in shards:
+            return [shards[event]]
+        return list(shards.values())
+
+    def reload_if_changed(self):
+        """
+        Переключает шарды на текущие снимки своих баз. Возвращает True, если готов хотя бы один шард.
+        Если хоть один шард загрузил новый снимок (или список шардов изменился), кэш результатов очищается:
+        записи прежних версий всё равно не используются, а место в кэше занимают.
+        """
+        before = {event: shard.version for event, shard in self.shards.items()}
+        self.refresh_shards(force=False)
+        shards = list(self.shards.items())
+        ready = [shard.reload_if_changed() for _, shard in shards]
+        if {event: shard.version for event, shard in shards} != before:
+            self.result_cache.clear()
+        return any(ready)
+
+    def warm_up(self):
+        """
+        Прогрев перед приёмом запросов: прогон моделей на пустом кадре и пробный поиск по индексу каждого шарда,
+        чтобы страницы отображённых в память индексов (для Flat — все векторы) оказались в кэше ОС.
+        Возвращает время этапов в секундах.
+        """
+        timings = {"models_s": self.detector.warm_up()}
+        started = time.perf_counter()
+        for shard in self.shards.values():
+            index = shard.index
+            if index is not None and index.ntotal > 0:
+                index.search(np.zeros((1, index.d), dtype=np.float32), min(self.top_k, index.ntotal))
+        timings["index_s"] = time.perf_counter() - started
+        return timings
+
+    def cached_result(self, key, dominant_only=False, event=None):
+        """
+        Результат из кэша для ключа запроса: (True, результат) или (False, None).
+        event — мероприятие, в котором искали (None — все). Записи, посчитанные по прежним снимкам баз, не используются.
+        """
+        if key is None:
+            return False, None
+        hit, entry = self.result_cache.get((event, key))
+        if not hit or entry[0] != tuple((s.event, current_snapshot(s.vector_dir)) for s in self._scope(event)):
+            metrics.inc("cache_requests", cache="result", result="miss")
+            return False, None
+        metrics.inc("cache_requests", cache="result", result="hit")
+        return True, self._view(entry[1], dominant_only)
+
+    def search(self, image, key=None, dominant_only=False, event=None):
+        """
+        Ищет пользователей по фото: эмбеддинги лиц → ближайшие кластеры в FAISS.
+        image — путь к файлу или байты закодированного фото; event — мероприятие (None — искать во всех).
+        """
+        return self.search_batch([image], [key], dominant_only=dominant_only, events=[event])[0]
+
+    @metrics.timed("search_batch")
+    def search_batch(self, images, keys=None, dominant_only=False, events=None):
+        """
+        Пакетный поиск: все фото проходят через модели одним пакетом, эмбеддинги всех лиц со всех фото
+        ищутся одним вызовом index.search с k=top_k в каждом нужном шарде.
+        images — пути к файлам или байты фото (декодируются в памяти через cv2.imdecode);
+        keys — ключи кэша (например, file_unique_id), для фото с известным ключом модели не запускаются повторно;
+        dominant_only — искать только по главному лицу (крупному и повёрнутому к камере);
+        events — мероприятие для каждого фото (None или неизвестное мероприятие — поиск во всех шардах).
+        Возвращает список результатов в порядке images (None — если не найдено).
+        Результат: поля лучшего совпадения (similarity, user_id, event, cluster_meta, user_photos)
+        и "matches" — все найденные пользователи по убыванию сходства.
+        """
+        keys = keys or [None] * len(images)
+        events = events or [None] * len(images)
+        full_results = [None] * len(images)
+        faces_per_image = [None] * len(images)    # лица фото, для которых поиск выполняется сейчас
+
+        # -- актуальные версии шардов (результаты из кэша, посчитанные по прежним снимкам, не используются)
+        if not self.reload_if_changed():
             logger.error("FAISS база не найдена")
-            return None
+            return full_results
+        scopes = {event: self._scope(event) for event in set(events)}
+        versions = {event: tuple((s.event, s.version) for s in shards) for event, shards in scopes.items()}
+        for event in scopes:
+            if event is not None and event not in self.shards:
+                logger.warning(f"Мероприятие {event} не найдено, поиск по всем мероприятиям")
+
+        # -- результаты и лица из кэша; остальные фото идут в модели
+        pending = []
+        for i, (image, key) in enumerate(zip(images, keys)):
+            hit, entry = self.result_cache.get((events[i], key)) if key is not None else (False, None)
+            if hit and entry[0] == versions[events[i]]:
+                metrics.inc("cache_requests", cache="result", result="hit")
+                full_results[i] = entry[1]
+                continue
+            hit, faces = self.embedding_cache.get(key) if key is not None else (False, None)
+            if key is not None:
+                metrics.inc("cache_requests", cache="embedding", result="hit" if hit else "miss")
+            if hit:
+                faces_per_image[i] = faces
+            elif isinstance(image, str) and not image.lower().endswith(PHOTO_EXTENSIONS):
+                continue
+            else:
+                pending.append(i)
+
+        # -- детекция, выравнивание и эмбеддинги всех лиц за один проход моделей
+        decoded = [images[i] if isinstance(images[i], str) else decode_bytes(images[i]) for i in pending]
+        faces_batch = self.detector.analyze_batch(decoded) if pending else []
+        quality_stats = self.detector.quality.pop_stats()
+        if any(quality_stats[r] for r in REJECT_REASONS):
+            logger.info(f"🧹 Фильтр качества лиц: {format_stats(quality_stats)}")
+        for i, aligned_faces_info in zip(pending, faces_batch):
+            faces = []
+            for face_info in aligned_faces_info:
+                emb = np.array(face_info["embedding"], dtype=np.float32)
+                emb /= np.linalg.norm(emb)   # нормализуем для cosine similarity
+                faces.append({"embedding": emb, "bbox": face_info["bbox"], "pose": face_info["pose"]})
+            if not faces:
+                logger.error(f"Лицо не найдено на изображении {images[i] if isinstance(images[i], str) else keys[i]}")
+            faces_per_image[i] = faces
+            if keys[i] is not None:
+                self.embedding_cache.put(keys[i], faces)
 
-        index = faiss.read_index(faiss_index_path)
+        # -- k ближайших кластеров для каждого лица: один вызов на шард для всех фото пакета с тем же мероприятием
+        candidates = {}     # номер фото → {(мероприятие, user_id): (шард, метаданные, {номер лица: similarity})}
+        for event, shards in scopes.items():
+            owners = [(i, f) for i, faces in enumerate(faces_per_image)
+                      if faces and events[i] == event for f in range(len(faces))]
+            if not owners:
+                continue
+            queries = np.stack([faces_per_image[i][f]["embedding"] for i, f in owners])
+            with metrics.timer("search_index"):
+                rows = self._search_shards(shards, queries)
+            for (i, f), row in zip(owners, rows):
+                found = candidates.setdefault(i, {})
+                for sim, shard, user_id, meta_store in row:
+                    if sim < self.threshold:
+                        continue
+                    # -- сходство запоминается по каждому лицу: dominant_only выбирает по главному лицу из того же результата
+                    per_face = found.setdefault((shard.event, user_id), (shard, meta_store, {}))[2]
+                    per_face[f] = max(sim, per_face.get(f, sim))
 
-        # -- проверка, что индекс не пуст
-        if index.ntotal == 0:
+        for i, faces in enumerate(faces_per_image):
+            if faces is None:
+                continue
+            if faces:
+                full_results[i] = self._make_result(faces, candidates.get(i, {}))
+            # -- запоминаем результаты (в том числе «не найдено») для повторных запросов с тем же фото
+            if keys[i] is not None:
+                self.result_cache.put((events[i], keys[i]), (versions[events[i]], full_results[i]))
+
+        return [self._view(result, dominant_only) for result in full_results]
+
+    def _search_shards(self, shards, queries):
+        """
+        Ищет запросы в шардах (в нескольких — параллельно) и объединяет ответы: для каждого запроса —
+        top_k кластеров с наибольшим сходством среди всех шардов, [(similarity, шард, user_id, метаданные)].
+        """
+        if len(shards) == 1:
+            found = [shards[0].search(queries, self.top_k)]
+        else:
+            found = list(self._executor.map(lambda shard: shard.search(queries, self.top_k), shards))
+        metrics.observe("search_shards", len(shards))
+
+        rows = [[] for _ in range(len(queries))]
+        for shard, result in zip(shards, found):
+            if result is None:
+                continue
+            sims, idxs, meta_store = result
+            for row, sim_row, idx_row in zip(rows, sims.tolist(), idxs.tolist()):
+                row.extend((sim, shard, user_id, meta_store) for sim, user_id in zip(sim_row, idx_row) if user_id >= 0)
+        if all(result is None for result in found):
             logger.error("FAISS индекс пуст")
-            return None
+        return [heapq.nlargest(self.top_k, row, key=lambda c: c[0]) for row in rows]
 
-        # -- загрузка метаданных
-        metadata_path = os.path.join(vector_dir, "metadata.json")
+    @staticmethod
+    def dominant_face(faces):
+        """
+        Номер главного лица на фото: площадь рамки с поправкой на поворот головы,
+        поэтому крупное фронтальное лицо выигрывает у крупного профиля.
+        """
+        def score(face):
+            x1, y1, x2, y2 = face["bbox"]
+            pitch, yaw = np.radians(face["pose"][0]), np.radians(face["pose"][1])
+            return (x2 - x1) * (y2 - y1) * max(0.0, np.cos(yaw)) * max(0.0, np.cos(pitch))
 
-        if not os.path.exists(metadata_path):
-            logger.error("Файл метаданных не найден")
-            return None
+        return int(np.argmax([score(face) for face in faces]))
 
-        with open(metadata_path, "r", encoding="utf-8") as f:
-            meta = json.load(f)
+    def _make_result(self, faces, candidates):
+        """
+        Собирает ответ для бота: найденные кластеры по убыванию сходства с альбомами пользователей.
+        candidates — {(мероприятие, user_id): (шард, метаданные, {номер лица: similarity})} выше порога.
+        similarity и face совпадения — по лучшему лицу, face_similarities — по всем совпавшим лицам.
+        user_id уникален только внутри мероприятия, поэтому в ответе вместе с ним — event.
+        """
+        ranked = []
+        for match_key, (shard, meta_store, per_face) in candidates.items():
+            face = max(per_face, key=per_face.get)
+            ranked.append((per_face[face], face, match_key, shard, meta_store, per_face))
+        ranked.sort(key=lambda item: -item[0])
 
-        # -- проверка синхронизации индекса и метаданных
-        if len(meta) != index.ntotal:
-            logger.error(f"Несоответствие: индекс содержит {index.ntotal} векторов, а метаданных {len(meta)}")
-            return None
+        matches = []
+        for sim, face, (event, user_id), shard, meta_store, per_face in ranked:
+            # -- проверка валидности индекса и метаданные кластера по user_id
+            cluster_meta = meta_store.get(user_id)
+            if cluster_meta is None:
+                logger.error(f"Невалидный индекс: {user_id} ({shard.name}, размер метаданных: {len(meta_store)})")
+                continue
 
-        # -- поиск ближайшего вектора
-        sims, idxs = index.search(emb.reshape(1, -1), k=1)
-        best_sim = float(sims[0][0])
-        best_idx = int(idxs[0][0])
+            user_photos = shard.list_user_photos(cluster_meta["user_id"], meta_store)
+            matches.append({
+                "similarity": sim,
+                "cluster_meta": cluster_meta,
+                "user_id": cluster_meta["user_id"],
+                "event": event,
+                "user_photos": user_photos,
+                "face": face,
+                "face_similarities": per_face,
+            })
+            logger.info(f"Найден кластер {cluster_meta['user_id']} ({shard.name}, лицо {face + 1}) "
+                        f"с similarity={sim:.4f}, {len(user_photos)} фото")
 
-        # -- проверка валидности индекса
-        if best_idx < 0 or best_idx >= len(meta):
-            logger.error(f"Невалидный индекс: {best_idx} (размер метаданных: {len(meta)})")
+        if not matches:
+            logger.error("Совпадений выше порога не найдено")
             return None
 
-        best_meta = meta[best_idx]
+        return {"matches": matches, "faces": len(faces), "dominant_face": self.dominant_face(faces)}
 
-        logger.info(f"Найден ближайший кластер с similarity={best_sim:.4f}")
-        logger.info(f"→ Метаданные: {best_meta}")
+    def close(self):
+        """Останавливает потоки поиска и закрывает метаданные шардов."""
+        self._executor.shutdown(wait=False)
+        for shard in self.shards.values():
+            shard.close()
 
-        # -- проверка порога
-        threshold = 0.6
-        if best_sim < threshold:
-            logger.error("Совпадений выше порога не найдено")
+    def _view(self, result, dominant_only=False):
+        """
+        Ответ в формате бота: поля лучшего совпадения + "matches" (не больше max_matches).
+        dominant_only — только совпадения главного лица, по убыванию его сходства (даже если лучше
+        с кластером совпало другое лицо фото).
+        """
+        if result is None:
             return None
+        matches = result["matches"]
+        if dominant_only:
+            dominant = result["dominant_face"]
+            matches = sorted((dict(m, similarity=m["face_similarities"][dominant], face=dominant)
+                              for m in matches if dominant in m["face_similarities"]),
+                             key=lambda m: -m["similarity"])
+        matches = matches[:self.max_matches]
+        if not matches:
+            return None
+        return dict(matches[0], matches=matches, faces=result["faces"], dominant_face=result["dominant_face"])
 
-        # -- получаем user_id из метаданных
-        user_id = best_meta["user_id"]
 
-        # -- путь к папке с фото пользователя
-        user_folder = os.path.join(users_dir, f"user_{user_id}")
+_default_engine = None
+_default_engine_lock = threading.Lock()
 
-        # -- список всех фото в папке
-        user_photos = []
-        if os.path.exists(user_folder):
-            for fname in os.listdir(user_folder):
-                if fname.lower().endswith(('.jpg', '.jpeg', '.png', '.gif', '.bmp', '.webp')):
-                    user_photos.append(os.path.join(user_folder, fname))
-        else:
-            logger.error(f"Папка {user_folder} не найдена")
 
-        # -- возвращаем результат
-        data = {
-            "similarity": best_sim,
-            "cluster_meta": best_meta,
-            "user_id": best_meta["user_id"],
-            "user_folder": user_folder,
-            "user_photos": user_photos
-        }
+def get_engine():
+    """
+    Общий на процесс экземпляр SearchEngine (создаётся при первом обращении).
+    """
+    global _default_engine
+    if _default_engine is None:
+        with _default_engine_lock:
+            if _default_engine is None:
+                _default_engine = SearchEngine()
+    return _default_engine
 
-        logger.info(f"Папка пользователя: {data['user_folder']}")
 
-        return data
+@metrics.timed("vectorize_face")
+def vectorize_face(input_path):               # ./путь/img_334.jpg
+    os.makedirs(TEMPORARY_DIR, exist_ok=True)
+
+    try:
+        return get_engine().search(input_path)
+    finally:
+        # -- удаление исходного фото
+        if os.path.exists(input_path):
+            os.remove(input_path)
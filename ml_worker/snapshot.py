@@ -0,0 +1,197 @@
+# неизменяемые версии базы (снимки) и атомарное переключение указателя CURRENT
+import os
+import json
+import time
+import shutil
+import sqlite3
+import argparse
+import logging
+from contextlib import contextmanager
+import faiss
+try:
+    import fcntl
+except ImportError:     # Windows: блокировки нет, публикует один воркер
+    fcntl = None
+from embedder import load_cluster_index
+from index_factory import load_index_config, search_index_path
+from metadata_store import METADATA_DB, open_metadata_store
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+SNAPSHOTS_DIR = "snapshots"         # папка снимков внутри data/vectors
+CURRENT_POINTER = "CURRENT"         # файл с именем текущего снимка
+SNAPSHOT_MANIFEST = "snapshot.json"
+CENTROID_INDEX = "faiss_index.idx"
+KEEP_SNAPSHOTS = 3                  # сколько последних снимков хранить (старые нужны ботам, не успевшим переключиться)
+SNAPSHOT_LOCK = ".snapshot.lock"    # межпроцессная блокировка публикации (воркер, events.py, ручной запуск)
+
+
+def snapshots_root(save_dir):
+    return os.path.join(save_dir, SNAPSHOTS_DIR)
+
+
+def current_snapshot(save_dir):
+    """Путь к текущему снимку или None, если снимков ещё нет."""
+    try:
+        with open(os.path.join(save_dir, CURRENT_POINTER), "r", encoding="utf-8") as f:
+            name = f.read().strip()
+    except FileNotFoundError:
+        return None
+    return os.path.join(snapshots_root(save_dir), name) if name else None
+
+
+def read_manifest(snapshot_dir):
+    with open(os.path.join(snapshot_dir, SNAPSHOT_MANIFEST), "r", encoding="utf-8") as f:
+        return json.load(f)
+
+
+def _snapshot_numbers(root):
+    numbers = []
+    if os.path.isdir(root):
+        for name in os.listdir(root):
+            if name.startswith("v") and name[1:].isdigit():
+                numbers.append(int(name[1:]))
+    return sorted(numbers)
+
+
+def _write_atomic(path, text):
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        f.write(text)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+
+@contextmanager
+def _snapshot_lock(save_dir):
+    """
+    Эксклюзивная блокировка save_dir/.snapshot.lock на время публикации: два процесса иначе выберут
+    один и тот же номер vNNNNNN и будут писать в одну временную папку. Снимается при закрытии файла.
+    """
+    os.makedirs(save_dir, exist_ok=True)
+    with open(os.path.join(save_dir, SNAPSHOT_LOCK), "a") as f:
+        if fcntl is not None:
+            fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+        yield
+
+
+def publish_snapshot(save_dir, config=None, centroid_index=None, search_index=None, keep=KEEP_SNAPSHOTS):
+    """
+    Публикует текущее состояние базы (индексы FAISS + metadata.sqlite) как новый неизменяемый снимок:
+    всё пишется во временную папку, она переименовывается в snapshots/vNNNNNN,
+    затем атомарно (os.replace) переключается указатель CURRENT.
+    Индексы, уже загруженные в память воркера, передаются напрямую, иначе копируются файлы из save_dir.
+    Возвращает путь к снимку.
+    """
+    with _snapshot_lock(save_dir):
+        return _publish(save_dir, config, centroid_index, search_index, keep)
+
+
+def _publish(save_dir, config, centroid_index, search_index, keep):
+    """Публикация снимка; вызывать под _snapshot_lock."""
+    config = config or load_index_config()
+    root = snapshots_root(save_dir)
+    os.makedirs(root, exist_ok=True)
+
+    numbers = _snapshot_numbers(root)
+    name = f"v{(numbers[-1] + 1 if numbers else 1):06d}"
+    tmp_dir = os.path.join(root, f".{name}.tmp")
+    shutil.rmtree(tmp_dir, ignore_errors=True)
+    os.makedirs(tmp_dir)
+
+    # -- индекс центроидов и поисковый индекс
+    centroid_path = os.path.join(tmp_dir, CENTROID_INDEX)
+    if centroid_index is not None:
+        faiss.write_index(centroid_index, centroid_path)
+    else:
+        shutil.copyfile(os.path.join(save_dir, CENTROID_INDEX), centroid_path)
+
+    search_name = os.path.basename(search_index_path(save_dir, config))
+    if search_name != CENTROID_INDEX:
+        if search_index is not None:
+            faiss.write_index(search_index, os.path.join(tmp_dir, search_name))
+        else:
+            shutil.copyfile(os.path.join(save_dir, search_name), os.path.join(tmp_dir, search_name))
+
+    # -- согласованная копия метаданных через backup API SQLite
+    src = sqlite3.connect(os.path.join(save_dir, METADATA_DB))
+    dst = sqlite3.connect(os.path.join(tmp_dir, METADATA_DB))
+    with dst:
+        src.backup(dst)
+    n_clusters = dst.execute("SELECT COUNT(*) FROM clusters").fetchone()[0]
+    dst.close()
+    src.close()
+
+    manifest = {
+        "version": name,
+        "created": time.time(),
+        "backend": config["backend"],
+        "search_index": search_name,
+        "clusters": n_clusters,
+    }
+    _write_atomic(os.path.join(tmp_dir, SNAPSHOT_MANIFEST), json.dumps(manifest, ensure_ascii=False, indent=2))
+
+    snapshot_dir = os.path.join(root, name)
+    os.replace(tmp_dir, snapshot_dir)
+    _write_atomic(os.path.join(save_dir, CURRENT_POINTER), name)
+    logger.info(f"📦 Опубликован снимок базы {name}: {n_clusters} кластеров")
+
+    prune_snapshots(save_dir, keep)
+    return snapshot_dir
+
+
+def prune_snapshots(save_dir, keep=KEEP_SNAPSHOTS):
+    """Удаляет старые снимки, оставляя keep последних (текущий не удаляется никогда)."""
+    root = snapshots_root(save_dir)
+    current = current_snapshot(save_dir)
+    for number in _snapshot_numbers(root)[:-keep]:
+        path = os.path.join(root, f"v{number:06d}")
+        if current and os.path.abspath(path) == os.path.abspath(current):
+            continue
+        try:
+            shutil.rmtree(path)
+        except OSError as e:
+            # -- например, на Windows файл ещё отображён в память ботом; удалим при следующей публикации
+            logger.error(f"Не удалось удалить старый снимок {path}: {e}")
+
+
+def ensure_snapshot(save_dir, config=None):
+    """
+    Для базы, созданной до появления снимков: публикует первый снимок из файлов в save_dir.
+    Возвращает путь к текущему снимку или None, если базы нет.
+    """
+    current = current_snapshot(save_dir)
+    if current is not None:
+        return current
+    if not os.path.exists(os.path.join(save_dir, CENTROID_INDEX)):
+        return None
+
+    with _snapshot_lock(save_dir):
+        # -- пока ждали блокировку, первый снимок мог опубликовать другой процесс
+        current = current_snapshot(save_dir)
+        if current is not None:
+            return current
+
+        config = config or load_index_config()
+        meta_store = open_metadata_store(save_dir)      # заодно мигрирует metadata.json
+        centroid_index = load_cluster_index(os.path.join(save_dir, CENTROID_INDEX), meta_store)
+        meta_store.close()
+
+        search_path = search_index_path(save_dir, config)
+        if search_path != os.path.join(save_dir, CENTROID_INDEX) and not os.path.exists(search_path):
+            config = dict(config, backend="flat")       # поисковый индекс ещё не построен — публикуем точный
+        return _publish(save_dir, config, centroid_index, None, KEEP_SNAPSHOTS)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Публикация снимка векторной базы")
+    parser.add_argument("save_dir", nargs="?", default="data/vectors")
+    parser.add_argument("--keep", type=int, default=KEEP_SNAPSHOTS)
+    args = parser.parse_args()
+
+    if current_snapshot(args.save_dir) is None:
+        ensure_snapshot(args.save_dir)
+    else:
+        publish_snapshot(args.save_dir, keep=args.keep)
@@ -1,8 +1,14 @@
 import os
 import json
+import uuid
 import numpy as np
 import faiss
-from embedder import FaceEmbeddingDatabaseFAISS  # твой класс для работы с FAISS
+from embedder import FaceEmbeddingDatabaseFAISS, new_cluster_index, load_cluster_index  # твой класс для работы с FAISS
+from index_factory import (load_index_config, load_search_index, build_search_index, update_search_index,
+                           write_search_index, search_centroids, search_index_path)
+from metadata_store import open_metadata_store
+from snapshot import publish_snapshot
+import metrics
 import logging
 
 logging.basicConfig(level=logging.INFO)
@@ -10,123 +16,311 @@ logger = logging.getLogger(__name__)
 
 # Параметры
 SAVE_DIR = "data/vectors"       # FAISS + metadata
-USERS_DIR = "data/photos/users" # куда сохраняем фото по пользователям
 THRESHOLD = 0.6                  # косинусная дистанция для совпадения
+UPDATE_JOURNAL = "update_journal.json"  # незавершённое обновление: индексы ещё не на месте, лица в хранилище не зафиксированы
+PENDING_SUFFIX = ".pending"             # индекс FAISS, записанный до фиксации метаданных
+UPDATE_BATCH_KEY = "update_batch"       # номер последнего зафиксированного обновления в metadata.sqlite (таблица state)
 
-def update_db(new_face_infos):
+
+def _write_journal(save_dir, journal):
+    path = os.path.join(save_dir, UPDATE_JOURNAL)
+    with open(path + ".tmp", "w", encoding="utf-8") as f:
+        json.dump(journal, f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(path + ".tmp", path)
+
+
+def _finish_update(save_dir, journal):
+    """Метаданные зафиксированы: индексы FAISS встают на место, журнал удаляется."""
+    for path in journal["files"]:
+        if os.path.exists(path + PENDING_SUFFIX):
+            os.replace(path + PENDING_SUFFIX, path)
+    os.remove(os.path.join(save_dir, UPDATE_JOURNAL))
+
+
+def recover_update(save_dir, meta_store, store=None):
+    """
+    Доводит до конца или откатывает обновление, прерванное падением процесса (журнал UPDATE_JOURNAL).
+    Лица в хранилище и индексы FAISS пишутся до фиксации метаданных, а номер обновления фиксируется
+    вместе с ними: если он записан — обновление завершается (индексы встают на место),
+    иначе лица, дописанные в хранилище, отбрасываются, удалённые — восстанавливаются.
+    """
+    path = os.path.join(save_dir, UPDATE_JOURNAL)
+    if not os.path.exists(path):
+        return
+    with open(path, "r", encoding="utf-8") as f:
+        journal = json.load(f)
+    if meta_store.get_state(UPDATE_BATCH_KEY) == journal["batch"]:
+        logger.warning("⚠️ Прошлое обновление базы прервано после фиксации метаданных — завершается")
+        _finish_update(save_dir, journal)
+        return
+
+    logger.warning("⚠️ Прошлое обновление базы прервано до фиксации метаданных — откатывается")
+    for file_path in journal["files"]:
+        if os.path.exists(file_path + PENDING_SUFFIX):
+            os.remove(file_path + PENDING_SUFFIX)
+    if store is not None:
+        store.truncate(journal["store_len"])
+        if journal["removed"]:
+            store.set_clusters(np.array(journal["removed_clusters"], dtype=np.int32),
+                               indices=np.array(journal["removed"], dtype=np.int64))
+    os.remove(path)
+
+def _apply_face_delta(store, removed, added, centroid_index, meta_store):
+    """
+    Вычитает лица хранилища removed и добавляет лица added из центроидов и счётчиков их кластеров
+    (одним пересчётом, поэтому порядок не важен); кластеры, у которых не осталось лиц, удаляются.
+    Возвращает (изменённые user_id, удалённые user_id).
+    """
+    indices = np.concatenate([removed, added]).astype(np.int64)
+    signs = np.concatenate([-np.ones(len(removed)), np.ones(len(added))]).astype(np.float32)
+    cluster_ids = np.asarray(store.records()["cluster_id"][indices]) if len(indices) else np.empty(0, np.int32)
+    valid = cluster_ids >= 0
+    if not valid.any():
+        return [], []
+    embs = np.asarray(store.embeddings()[indices[valid]], dtype=np.float32) * signs[valid, None]
+    ids, inverse = np.unique(cluster_ids[valid], return_inverse=True)
+    sums = np.zeros((len(ids), embs.shape[1]), dtype=np.float32)
+    np.add.at(sums, inverse, embs)
+    deltas = np.rint(np.bincount(inverse, weights=signs[valid], minlength=len(ids))).astype(np.int64)
+
+    counts = meta_store.counts(ids.tolist())
+    present = np.array([int(c) in counts for c in ids])     # кластеры из хранилища, которых уже нет в базе, пропускаем
+    ids, sums, deltas = ids[present].astype(np.int64), sums[present], deltas[present]
+    if len(ids) == 0:
+        return [], []
+    old_counts = np.array([counts[int(c)] for c in ids], dtype=np.float32)
+    keep = old_counts + deltas > 0
+
+    updated = centroid_index.reconstruct_batch(ids[keep]) * old_counts[keep, None] + sums[keep]
+    updated /= np.maximum(np.linalg.norm(updated, axis=1, keepdims=True), 1e-12)
+    centroid_index.remove_ids(ids)
+    centroid_index.add_with_ids(updated.astype(np.float32), ids[keep])
+    for c, delta in zip(ids[keep], deltas[keep]):
+        meta_store.add_to_count(c, int(delta))
+    meta_store.remove_clusters(ids[~keep].tolist())
+    return ids[keep].tolist(), ids[~keep].tolist()
+
+
+@metrics.timed("update_db")
+def update_db(new_face_infos, rebuild=False, store=None, save_dir=SAVE_DIR, replaced_photo_ids=(), copied_photos=None):
     """
     Добавляем новые фото в базу или обновляем существующих пользователей.
 
     new_face_infos: список словарей с ключами
         "embedding", "photo_id", "bbox", "pose", "path" (путь к фото)
+    rebuild: не загружать существующую базу, а собрать её заново из new_face_infos
+    store: FaceEmbeddingStore — если задан, эмбеддинги новых лиц дописываются в него вместе с user_id
+    save_dir: папка базы — общая data/vectors или шард мероприятия (events.shard_paths)
+    replaced_photo_ids: фото с новым содержимым (новые лица — в new_face_infos) или удалённые после
+        переименования — их прежние лица вычитаются из центроидов, кластер без лиц удаляется
+    copied_photos: {photo_id: (photo_id исходного фото, путь)} — копии и переименования уже обработанных фото:
+        лица исходного фото добавляются в его же кластеры как лица копии, без нейросетей
+    (лица прежних и исходных фото берутся из store)
+    Каждому лицу из new_face_infos проставляется "user_id" кластера, в который оно попало.
+
+    Все лица сопоставляются одним index.search, центроиды совпавших кластеров
+    пересчитываются векторно и заменяются в индексе на месте (ID в FAISS = user_id).
+    Сопоставление идёт по поисковому индексу из index_config.json (тот же, что у бота);
+    точные центроиды хранятся в faiss_index.idx.
+    Метаданные (metadata.sqlite) меняются инкрементально, одной транзакцией. Индексы FAISS и лица в store
+    пишутся до её фиксации под журналом UPDATE_JOURNAL (см. recover_update), поэтому после падения
+    центроиды и хранилище лиц не расходятся; фото, уже попавшие в хранилище, не учитываются дважды.
+    В конце публикуется новый снимок базы для бота (см. snapshot.publish_snapshot).
+    Возвращает user_id (int) кластеров, изменённых или удалённых в этом запуске.
     """
-    os.makedirs(SAVE_DIR, exist_ok=True)
-    os.makedirs(USERS_DIR, exist_ok=True)
+    copied_photos = copied_photos or {}
+    os.makedirs(save_dir, exist_ok=True)
 
     # 1. Загружаем существующую базу
-    db = FaceEmbeddingDatabaseFAISS(embedding_dim=512, threshold=THRESHOLD)
-    faiss_path = os.path.join(SAVE_DIR, "faiss_index.idx")
-    meta_path = os.path.join(SAVE_DIR, "metadata.json")
-    db.meta = []  # инициализируем пустым списком
-    if os.path.exists(faiss_path) and os.path.exists(meta_path):
-        db.index = faiss.read_index(faiss_path)
-        with open(meta_path, "r", encoding="utf-8") as f:
-            db.meta = json.load(f)
-        logger.info(f"Загружена существующая БД: {db.index.ntotal} кластеров из {SAVE_DIR}")
+    faiss_path = os.path.join(save_dir, "faiss_index.idx")
+    meta_store = open_metadata_store(save_dir)
+    recover_update(save_dir, meta_store, store)
+    if not rebuild and os.path.exists(faiss_path):
+        centroid_index = load_cluster_index(faiss_path, meta_store)
+        logger.info(f"Загружена существующая БД: {centroid_index.ntotal} кластеров из {save_dir}")
     else:
         # Создаём новый пустой индекс
-        db.index = faiss.IndexFlatIP(512)
-        logger.info(f"Создание новой БД в {SAVE_DIR}")
-
-    # 2. Сначала сопоставляем каждое новое лицо с существующими пользователями
-    unmatched_faces = []  # лица, которые не совпали с существующими пользователями
-    
-    for face_info in new_face_infos:
-        emb = np.array(face_info["embedding"], dtype=np.float32)
-        emb /= np.linalg.norm(emb)
-        matched = False
-        
-        # ищем ближайшего существующего пользователя
-        if db.index.ntotal > 0:
-            query = np.expand_dims(emb, axis=0).astype(np.float32)
-            sims, indices = db.index.search(query, k=1)
-            sim = float(sims[0][0])
-            best_idx = int(indices[0][0])
-            
-            if best_idx >= 0 and best_idx < len(db.meta) and sim >= THRESHOLD:
-                # Найдено совпадение с существующим пользователем
-                cluster_meta = db.meta[best_idx]
-                old_embedding = np.array(db.index.reconstruct(best_idx), dtype=np.float32)
-                n_old_faces = cluster_meta["count"]
-                
-                # Обновляем усредненный вектор (добавляем одно новое лицо)
-                updated_embedding = (old_embedding * n_old_faces + emb) / (n_old_faces + 1)
-                updated_embedding /= np.linalg.norm(updated_embedding)
-                
-                # Добавляем photo_id если его еще нет
-                if face_info["photo_id"] not in cluster_meta["photo_ids"]:
-                    cluster_meta["photo_ids"].append(face_info["photo_id"])
-                
-                # Обновляем count
-                cluster_meta["count"] = n_old_faces + 1
-                
-                # Сохраняем обновленный вектор
-                cluster_meta["_updated_embedding"] = updated_embedding.tolist()
-                
-                total_photos = len(cluster_meta["photo_ids"])
-                logger.info(f"Обновлён пользователь: {cluster_meta['user_id']} (теперь {total_photos} фото)")
-                matched = True
-        
-        if not matched:
-            # Не совпало с существующими - добавим в список для кластеризации
-            unmatched_faces.append(face_info)
-    
-    # 3. Кластеризуем только те лица, которые не совпали с существующими
-    if unmatched_faces:
-        temp_db = FaceEmbeddingDatabaseFAISS(embedding_dim=512, threshold=THRESHOLD)
-        temp_db.add_from_aligned_info(unmatched_faces)
-        new_averaged_vectors, new_clusters = temp_db.cluster_embeddings()
-        
-        # 4. Создаём новых пользователей из несовпавших кластеров
-        for idx, cluster_meta in enumerate(new_clusters):
-            new_vec = new_averaged_vectors[idx]
-            new_user_id = max([int(m["user_id"]) for m in db.meta], default=0) + 1
-            unique_photo_ids = list(set(cluster_meta["photo_ids"]))
-            
-            db.meta.append({
-                "user_id": f"{new_user_id:05d}",
-                "photo_ids": unique_photo_ids,
-                "count": cluster_meta["count"],
-                "_updated_embedding": new_vec.tolist()
-            })
-            logger.info(f"🆕 Добавлен новый пользователь: {new_user_id:05d} ({len(unique_photo_ids)} фото)")
-
-    # 5. Пересоздаём FAISS с обновлёнными усреднёнными векторами
-    embeddings = []
-    for m in db.meta:
-        if "_updated_embedding" in m:
-            # Используем обновленный вектор
-            embeddings.append(np.array(m["_updated_embedding"], dtype=np.float32))
-            # Удаляем временное поле
-            del m["_updated_embedding"]
-        else:
-            # Используем вектор из существующего индекса
-            idx = db.meta.index(m)
-            if idx < db.index.ntotal:
-                embeddings.append(np.array(db.index.reconstruct(idx), dtype=np.float32))
-            else:
-                # Если индекс меньше метаданных (не должно быть, но на всякий случай)
-                embeddings.append(np.zeros(512, dtype=np.float32))
-    
-    db.index = faiss.IndexFlatIP(512)
-    if embeddings:
-        db.index.add(np.array(embeddings, dtype=np.float32))
-
-    # 6. Сохраняем FAISS и метаданные
-    faiss.write_index(db.index, faiss_path)
-    with open(meta_path, "w", encoding="utf-8") as f:
-        json.dump(db.meta, f, ensure_ascii=False, indent=2)
-    logger.info(f"FAISS и метаданные сохранены: {SAVE_DIR}")
-
-    return db.meta
+        centroid_index = new_cluster_index(512)
+        logger.info(f"Создание новой БД в {save_dir}")
+
+    index_config = load_index_config()
+    if centroid_index.ntotal > 0:
+        search_index = load_search_index(save_dir, index_config, centroid_index)
+    else:
+        search_index = build_search_index(index_config, centroid_index)
+    changed_ids, removed_ids = [], []
+    # -- лица прежних и исходных фото (до того, как в хранилище появятся лица этого запуска)
+    replaced_faces, source_faces = np.empty(0, dtype=np.int64), {}
+    if store is not None and not rebuild:
+        # -- фото, чьи лица уже в хранилище (запуск упал после фиксации, но до записи манифеста обработки),
+        # заменяются, а не добавляются второй раз: иначе их лица вошли бы в центроиды дважды
+        incoming = sorted({f["photo_id"] for f in new_face_infos}
+                          | {photo_id for photo_id, (source_id, _) in copied_photos.items() if photo_id != source_id})
+        present = store.photo_faces(incoming)
+        if len(present):
+            stored = {store.photo_ids[i] for i in store.records()["photo_idx"][present].tolist()}
+            replaced_photo_ids = list(dict.fromkeys([*replaced_photo_ids, *sorted(stored)]))
+            logger.info(f"Уже в базе: {len(stored)} фото из прерванного запуска — их лица заменяются")
+        replaced_faces = store.photo_faces(replaced_photo_ids)
+        source_faces = {photo_id: store.photo_faces([source_id])
+                        for photo_id, (source_id, _) in copied_photos.items() if photo_id != source_id}
+
+    if new_face_infos:
+        embs = np.array([f["embedding"] for f in new_face_infos], dtype=np.float32)
+        embs /= np.linalg.norm(embs, axis=1, keepdims=True)
+    else:
+        embs = np.empty((0, 512), dtype=np.float32)
+
+    with meta_store.transaction():
+        if rebuild:
+            meta_store.replace_all([])
+
+        # 1a. Прежние лица заменённых фото уходят из кластеров, лица копий добавляются (до сопоставления новых лиц)
+        added_faces = np.concatenate([np.empty(0, dtype=np.int64), *source_faces.values()])
+        if len(replaced_faces) or len(added_faces):
+            changed_ids, removed_ids = _apply_face_delta(store, replaced_faces, added_faces, centroid_index, meta_store)
+            search_index = update_search_index(search_index, centroid_index, changed_ids, index_config, removed_ids)
+            logger.info(f"♻️ Заменено и переименовано фото: {len(replaced_photo_ids)}, копий: {len(copied_photos)}; "
+                        f"лиц убрано {len(replaced_faces)}, добавлено {len(added_faces)}, "
+                        f"удалено опустевших кластеров: {len(removed_ids)}")
+        meta_store.remove_photos(replaced_photo_ids)
+        face_clusters = store.records()["cluster_id"] if source_faces else None
+        for photo_id, faces in source_faces.items():
+            users = {int(c) for c in face_clusters[faces] if c >= 0 and int(c) not in removed_ids}
+            for user_id in sorted(users):
+                meta_store.add_photos(user_id, [photo_id])
+        meta_store.set_photo_paths({photo_id: path for photo_id, (_, path) in copied_photos.items()})
+
+        # пути к исходным фото — по ним бот собирает альбомы пользователей
+        meta_store.set_photo_paths({f["photo_id"]: f["path"] for f in new_face_infos if f.get("path")})
+
+        # 2. Сопоставляем все новые лица с существующими пользователями одним поиском
+        matched = np.zeros(len(embs), dtype=bool)
+        best_ids = np.full(len(embs), -1, dtype=np.int64)
+        if search_index.ntotal > 0 and len(embs) > 0:
+            with metrics.timer("update_match"):
+                sims, ids = search_centroids(search_index, centroid_index, embs, k=1)
+            best_ids = ids[:, 0]
+            matched = (best_ids >= 0) & (sims[:, 0] >= THRESHOLD)
+
+        if matched.any():
+            # группируем совпадения по кластерам и обновляем центроиды векторно
+            cluster_ids, inverse = np.unique(best_ids[matched], return_inverse=True)
+            new_sums = np.zeros((len(cluster_ids), embs.shape[1]), dtype=np.float32)
+            np.add.at(new_sums, inverse, embs[matched])
+            new_counts = np.bincount(inverse, minlength=len(cluster_ids))
+
+            counts = meta_store.counts(cluster_ids.tolist())
+            old_counts = np.array([counts[int(c)] for c in cluster_ids], dtype=np.float32)
+            old_vecs = centroid_index.reconstruct_batch(cluster_ids)
+
+            updated = (old_vecs * old_counts[:, None] + new_sums) / (old_counts + new_counts)[:, None]
+            updated /= np.linalg.norm(updated, axis=1, keepdims=True)
+
+            # Сохраняем обновленные векторы на месте
+            centroid_index.remove_ids(cluster_ids)
+            centroid_index.add_with_ids(updated.astype(np.float32), cluster_ids)
+            changed_ids.extend(cluster_ids.tolist())
+
+            # Обновляем count и добавляем photo_id, если его еще нет
+            photos_by_cluster = {}
+            for face_info, c in zip((f for f, m in zip(new_face_infos, matched) if m), best_ids[matched]):
+                photos_by_cluster.setdefault(int(c), []).append(face_info["photo_id"])
+                face_info["user_id"] = f"{int(c):05d}"
+            for c, n_new in zip(cluster_ids, new_counts):
+                meta_store.add_to_count(c, n_new)
+                meta_store.add_photos(c, list(dict.fromkeys(photos_by_cluster[int(c)])))
+
+            logger.info(f"Обновлено пользователей: {len(cluster_ids)} ({int(matched.sum())} лиц)")
+            metrics.inc("update_faces", int(matched.sum()), result="matched")
+            metrics.inc("clusters_updated", len(cluster_ids))
+
+        # 3. Кластеризуем только те лица, которые не совпали с существующими
+        unmatched_faces = [f for f, m in zip(new_face_infos, matched) if not m]
+        if unmatched_faces:
+            temp_db = FaceEmbeddingDatabaseFAISS(embedding_dim=512, threshold=THRESHOLD)
+            temp_db.add_from_aligned_info(unmatched_faces)
+            new_averaged_vectors, new_clusters = temp_db.cluster_embeddings()
+
+            # 4. Создаём новых пользователей из несовпавших кластеров
+            next_user_id = max([meta_store.max_user_id(), *removed_ids]) + 1    # номера удалённых кластеров не переиспользуем
+            new_ids = []
+            for idx, cluster_meta in enumerate(new_clusters):
+                new_user_id = next_user_id + idx
+                meta_store.add_cluster(new_user_id, list(dict.fromkeys(cluster_meta["photo_ids"])), cluster_meta["count"])
+                new_ids.append(new_user_id)
+
+            centroid_index.add_with_ids(np.array(new_averaged_vectors, dtype=np.float32), np.array(new_ids, dtype=np.int64))
+            changed_ids.extend(new_ids)
+            logger.info(f"🆕 Добавлено новых пользователей: {len(new_clusters)}")
+            metrics.inc("update_faces", len(unmatched_faces), result="new")
+            metrics.inc("clusters_created", len(new_clusters))
+
+            for face_info, rank in zip(unmatched_faces, temp_db.face_user_ids):
+                face_info["user_id"] = f"{next_user_id + rank - 1:05d}"
+
+        # 5. Индексы FAISS (поисковый и центроиды) пишутся рядом, на место встают после фиксации метаданных
+        with metrics.timer("index_write"):
+            centroid_ids = [c for c in dict.fromkeys(changed_ids) if c not in removed_ids]
+            search_index = update_search_index(search_index, centroid_index, centroid_ids, index_config, removed_ids)
+            files = [faiss_path]
+            if search_index is not centroid_index:
+                files.append(search_index_path(save_dir, index_config))
+                faiss.write_index(search_index, files[-1] + PENDING_SUFFIX)
+            faiss.write_index(centroid_index, faiss_path + PENDING_SUFFIX)
+
+        # 6. Эмбеддинги отдельных лиц (для пересборок без нейросетей) — тоже до фиксации, под журналом:
+        # после падения recover_update либо завершит обновление, либо откатит хранилище вместе с метаданными
+        journal = {"batch": uuid.uuid4().hex, "files": files, "store_len": len(store) if store is not None else 0,
+                   "removed": replaced_faces.tolist(),
+                   "removed_clusters": store.records()["cluster_id"][replaced_faces].tolist() if len(replaced_faces) else []}
+        _write_journal(save_dir, journal)
+        if store is not None:
+            store.append(new_face_infos)
+            for photo_id, faces in source_faces.items():
+                store.copy_faces(faces, photo_id)
+            store.remove(replaced_faces)
+        meta_store.set_state(UPDATE_BATCH_KEY, journal["batch"])
+
+    _finish_update(save_dir, journal)
+    logger.info(f"FAISS, метаданные и лица сохранены: {save_dir}")
+
+    # 7. Публикуем согласованную версию индексов и метаданных для поиска
+    with metrics.timer("snapshot_publish"):
+        publish_snapshot(save_dir, index_config, centroid_index=centroid_index, search_index=search_index)
+
+    meta_store.close()
+    return list(dict.fromkeys(changed_ids + removed_ids))
+
+def rebuild_from_store(store, threshold=THRESHOLD, refine=None, save_dir=SAVE_DIR):
+    """
+    Перекластеризует все лица из FaceEmbeddingStore и перезаписывает FAISS и метаданные.
+    Нейросети и исходные фото не нужны: используются сохранённые эмбеддинги.
+    refine="chinese_whispers" — уточнение кластеров после компонент связности.
+    save_dir — папка базы (общая или шард мероприятия).
+    Возвращает user_id (int) всех кластеров.
+    """
+    os.makedirs(save_dir, exist_ok=True)
+
+    db = FaceEmbeddingDatabaseFAISS.from_store(store, threshold=threshold)
+    if db.index.ntotal == 0:
+        logger.info("Хранилище лиц пусто, пересобирать нечего")
+        return []
+
+    db.save_database(save_dir, refine=refine)
+    store.set_clusters(np.array(db.face_user_ids, dtype=np.int32), indices=store.live())
+
+    meta_store = open_metadata_store(save_dir)
+
+    # поисковый индекс выбранного типа заново обучается на новых центроидах
+    index_config = load_index_config()
+    centroid_index = load_cluster_index(os.path.join(save_dir, "faiss_index.idx"), meta_store)
+    search_index = build_search_index(index_config, centroid_index)
+    write_search_index(save_dir, index_config, search_index)
+    publish_snapshot(save_dir, index_config, centroid_index=centroid_index, search_index=search_index)
 
+    user_ids = [int(m["user_id"]) for m in meta_store.all()]
+    meta_store.close()
+    return user_ids
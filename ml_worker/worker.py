@@ -1,90 +1,241 @@
 import os
 import shutil
-import json
-from update import update_db            # реализуется сравнение и усреднение (+ обновление векторов существующего пользователя)
+import argparse
+from collections import Counter, deque
+from concurrent.futures import ProcessPoolExecutor
+from update import update_db, rebuild_from_store   # реализуется сравнение и усреднение (+ обновление векторов существующего пользователя)
 from detector import FaceDetector       # класс-детект
+from decode import ImagePrefetcher      # фоновое уменьшенное декодирование фото
+from quality import format_stats        # статистика фильтра качества лиц
+from manifest import IngestManifest     # учёт уже обработанных фото
+from face_store import FaceEmbeddingStore   # эмбеддинги всех лиц для пересборки без нейросетей
+from metadata_store import open_metadata_store
+from albums import RAW_DIR, USERS_DIR, PHOTO_EXTENSIONS, LINK_MODES, photo_id_for, sync_user_folders, user_album    # папки пользователей из ссылок на исходные фото
+from derivatives import DERIVATIVES_DIR, build_previews, prune_users     # превью альбомов для бота
+from events import shard_paths          # папки шарда мероприятия
+import metrics                          # время этапов и счётчики (выключено по умолчанию)
 import logging
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
-def save_user_photos(cluster_metadata, raw_photos_dir, users_dir):
-    """
-    raw_photos_dir — путь к исходным фото (input_dir)
-    users_dir — куда складываем по пользователям (кластерам)
-    cluster_metadata — результат cluster_embeddings
-    """
-    os.makedirs(users_dir, exist_ok=True)
+VECTOR_DIR = "data/vectors"
+POOL_INFLIGHT = 4       # фото в обработке на один процесс пула (ограничивает память при потоковой обработке)
+
+# детектор текущего процесса (в параллельном режиме — свой в каждом процессе пула)
+_detector = None
 
-    for _, cluster in enumerate(cluster_metadata, 1):
-        user_id = cluster["user_id"]
-        user_folder = os.path.join(users_dir, f"user_{user_id}")
-        os.makedirs(user_folder, exist_ok=True)
+def _init_detector(intra_op_threads=None, record_metrics=False):
+    global _detector
+    _detector = FaceDetector(device="cpu", intra_op_threads=intra_op_threads)
+    if record_metrics:
+        metrics.record_only()   # процесс пула: значения уходят в основной процесс вместе с результатом
 
-        # чтобы не копировать одно фото несколько раз
-        seen_photos = set()
+def analyze_photo(image):
+    """
+    Детекция, выравнивание и эмбеддинги одного фото за один проход моделей.
+    image — путь к фото или DecodedImage из ImagePrefetcher.
+    Ошибка на одном фото не прерывает обработку остальных: для такого фото возвращается None.
+    """
+    in_path = image if isinstance(image, str) else image.path
+    try:
+        aligned_faces_info, _ = _detector.analyze(image)
+    except Exception as e:
+        # -- нечитаемый файл (ValueError из analyze) — без трассировки: decode уже записал ошибку в лог
+        logger.error(f"Ошибка при обработке {in_path}: {e}", exc_info=not isinstance(e, ValueError))
+        metrics.inc("photos", result="error")
+        return None
+    metrics.inc("photos", result="ok")
+
+    for face_info in aligned_faces_info:
+        face_info["path"] = in_path
+    return aligned_faces_info
+
+def _analyze_in_pool(path):
+    """
+    analyze_photo для процесса пула: вместе с лицами возвращает статистику фильтра качества
+    и накопленные метрики процесса (если запись метрик включена).
+    """
+    return analyze_photo(path), _detector.quality.pop_stats(), metrics.pop_state() if metrics.enabled else None
 
-        for photo_id in cluster["photo_ids"]:
-            if photo_id in seen_photos:
+def iter_faces(paths, workers=1):
+    """
+    Обрабатывает фото последовательно или в пуле из workers процессов и выдаёт
+    (path, aligned_faces_info или None при ошибке) по мере готовности, в порядке paths.
+    paths может быть ленивым итератором (потоковая обработка во время скачивания, pipeline.py):
+    в обработке одновременно находится ограниченное число фото, поэтому память не растёт.
+    В последовательном режиме следующие фото декодируются в фоне, пока идёт инференс.
+    В пуле у каждого процесса своя FaceAnalysis, а потоки ONNX Runtime делятся между процессами,
+    чтобы пулы не конкурировали за ядра.
+    В конце пишет в лог статистику фильтра качества: сколько лиц принято и отклонено по каждой причине.
+    """
+    if workers <= 1:
+        if _detector is None:
+            _init_detector()
+        _detector.quality.pop_stats()
+        for in_path, decoded in ImagePrefetcher(paths):
+            if decoded is None:
+                # -- как в пуле, где analyze() бросает ValueError: ошибка, фото попробуем снова при следующем запуске
+                metrics.inc("photos", result="error")
+                yield in_path, None
                 continue
-            seen_photos.add(photo_id)
-
-            # поддержка форматов jpg/jpeg/png/webp
-            found = False
-            for ext in ('.jpg', '.jpeg', '.png', '.gif', '.bmp', '.webp'):
-                src_path = os.path.join(raw_photos_dir, f"{photo_id}{ext}")
-                if os.path.exists(src_path):
-                    shutil.copy2(src_path, user_folder)
-                    found = True
-                    break
-            
-            # Пропускаем предупреждения для старых legacy-фото, которых уже нет
-            if not found and not photo_id.startswith("legacy_"):
-                logger.error(f"Фото {photo_id} не найдено в {raw_photos_dir}")
-
-    logger.info(f"Фото {len(cluster_metadata)} пользователей сохранены в {users_dir}")
+            yield in_path, analyze_photo(decoded)
+        logger.info(f"🧹 Фильтр качества лиц: {format_stats(_detector.quality.pop_stats())}")
+        return
+
+    intra_op_threads = max(1, (os.cpu_count() or 1) // workers)
+    logger.info(f"Параллельная обработка: {workers} процессов × {intra_op_threads} потоков ONNX Runtime")
+
+    quality_stats = Counter()
+    with ProcessPoolExecutor(max_workers=workers, initializer=_init_detector,
+                             initargs=(intra_op_threads, metrics.enabled)) as executor:
+        pending = deque()
+        for path in paths:
+            pending.append((path, executor.submit(_analyze_in_pool, path)))
+            if len(pending) < workers * POOL_INFLIGHT:
+                continue
+            path, future = pending.popleft()
+            faces_info, stats, metrics_state = future.result()
+            quality_stats.update(stats)
+            metrics.merge(metrics_state)
+            yield path, faces_info
+        while pending:
+            path, future = pending.popleft()
+            faces_info, stats, metrics_state = future.result()
+            quality_stats.update(stats)
+            metrics.merge(metrics_state)
+            yield path, faces_info
+    logger.info(f"🧹 Фильтр качества лиц: {format_stats(quality_stats)}")
+
+def collect_faces(paths, workers=1):
+    """Список (path, aligned_faces_info или None при ошибке) для всех paths — см. iter_faces."""
+    return list(iter_faces(paths, workers))
+
+def commit_batch(results, store, manifest, rebuild=False, user_folders="hardlink", copies=None,
+                 input_dir=RAW_DIR, users_dir=USERS_DIR, vector_dir=VECTOR_DIR, derivatives_dir=DERIVATIVES_DIR):
+    """
+    Добавляет лица обработанных фото в базу (с публикацией снимка), обновляет папки и превью
+    изменившихся пользователей и только после этого отмечает фото в манифесте.
+    results — список (path, aligned_faces_info или None при ошибке). Возвращает число добавленных лиц.
+    copies — {путь: исходный путь} из IngestManifest.filter_new: копии и переименования обработанных фото.
+    Прежние лица фото, которые уже были в манифесте и проанализированы заново, заменяются новыми.
+    Папки — общие (data/vectors, data/photos) или шарда мероприятия (events.shard_paths).
+    """
+    copies = copies or {}
+    all_new_faces = []
+    faces_by_path = {}
+    for in_path, aligned_faces_info in results:
+        if aligned_faces_info is None:
+            continue    # ошибка — фото попробуем снова при следующем запуске
+        all_new_faces.extend(aligned_faces_info)
+        faces_by_path[in_path] = len(aligned_faces_info)
+
+    # -- прежние лица уходят у файлов с новым содержимым на прежнем пути и у исходников переименований
+    copied = {photo_id_for(path): (photo_id_for(source), path) for path, source in copies.items()}
+    renamed_paths = sorted({source for source in copies.values() if not os.path.exists(source)})
+    replaced = [photo_id_for(path) for path in sorted(manifest.known_paths([*faces_by_path, *copies]))]
+    replaced += [photo_id_for(path) for path in renamed_paths if photo_id_for(path) not in copied]
+
+    if all_new_faces or rebuild or replaced or copied:
+        # --- 2. Добавляем все новые лица в базу одной функцией ---
+        changed_user_ids = update_db(all_new_faces, rebuild=rebuild, store=store, save_dir=vector_dir,
+                                     replaced_photo_ids=replaced, copied_photos=copied)
 
-if __name__ == "__main__":
-    detector = FaceDetector(device="cpu")
+        logger.info(f"Векторная база успешно обновлена: {vector_dir}")
 
-    input_dir = "data/photos/raw_uploads"
-    vector_dir = "data/vectors"
-    users_dir = "data/photos/users"
-    cluster_metadata_dir = "data/vectors/metadata.json"
+        # --- 3. Обновляем папки только изменившихся пользователей (ссылки вместо копий) ---
+        meta_store = open_metadata_store(vector_dir)
+        sync_user_folders(meta_store, changed_user_ids, users_dir, input_dir, mode=user_folders)
 
-    os.makedirs(vector_dir, exist_ok=True)
-    os.makedirs(users_dir, exist_ok=True)
+        # --- 4. Превью альбомов изменившихся пользователей (архивы бот соберёт по запросу) ---
+        if rebuild:
+            prune_users(changed_user_ids, derivatives_dir)
+        build_previews(meta_store, changed_user_ids, lambda ms, u: user_album(ms, u, input_dir), derivatives_dir)
+        meta_store.close()
+    else:
 
-    all_new_faces = []
+        logger.info("Новых лиц для добавления не найдено.")
 
-    # проход по всем изображениям
-    for filename in os.listdir(input_dir):
-        if filename.lower().endswith(('.jpg', '.jpeg', '.png', '.gif', '.bmp', '.webp')):
-            in_path = os.path.join(input_dir, filename)
+    # --- 5. Запоминаем обработанные фото (только после успешного обновления базы) ---
+    manifest.mark_processed(faces_by_path, copies)
+    manifest.forget(renamed_paths)
+    metrics.flush()
+    return len(all_new_faces)
+
+def run_worker(workers=1, rebuild=False, recluster=False, refine=None, user_folders="hardlink",
+               input_dir=RAW_DIR, users_dir=USERS_DIR, vector_dir=VECTOR_DIR, derivatives_dir=DERIVATIVES_DIR):
+    """
+    Обработка новых фото input_dir и обновление базы vector_dir (или полная пересборка).
+    recluster=True — пересборка кластеров из сохранённых эмбеддингов: фото и нейросети не нужны.
+    Возвращает число добавленных лиц (при recluster — число кластеров).
+    """
+    os.makedirs(vector_dir, exist_ok=True)
 
-            # -- детекция и рамки
-            success = detector.is_detect(in_path)
-            if success:
-                # -- выравнивание отдельных лиц и получение эмбеддингов
-                aligned_faces_info = detector.align_detected(in_path)
+    store = FaceEmbeddingStore(os.path.join(vector_dir, "faces"))
+
+    if recluster:
+        shutil.rmtree(users_dir, ignore_errors=True)
+        user_ids = rebuild_from_store(store, refine=refine, save_dir=vector_dir)
+        meta_store = open_metadata_store(vector_dir)
+        sync_user_folders(meta_store, user_ids, users_dir, input_dir, mode=user_folders)
+        prune_users(user_ids, derivatives_dir)
+        build_previews(meta_store, user_ids, lambda ms, u: user_album(ms, u, input_dir), derivatives_dir)
+        meta_store.close()
+        return len(user_ids)
+
+    manifest = IngestManifest(os.path.join(vector_dir, "ingest_manifest.sqlite"))
+    if rebuild:
+        # полная пересборка: забываем обработанные фото, старые кластеры, эмбеддинги и папки пользователей
+        logger.info("Режим --rebuild: манифест игнорируется, база собирается заново")
+        manifest.clear()
+        store.clear()
+        shutil.rmtree(users_dir, ignore_errors=True)
 
-                # -- добавляем каждое лицо через update_db
-                for face_info in aligned_faces_info:
-                    face_info["path"] = in_path
-                    all_new_faces.append(face_info)
+    os.makedirs(users_dir, exist_ok=True)
+    os.makedirs(input_dir, exist_ok=True)
 
-    if all_new_faces:
-        # --- 2. Добавляем все новые лица в базу одной функцией ---
-        returned_meta = update_db(all_new_faces)  # update_db умеет принимать список
+    # проход по всем изображениям (в стабильном порядке)
+    paths = [
+        os.path.join(input_dir, filename)
+        for filename in sorted(os.listdir(input_dir))
+        if filename.lower().endswith(PHOTO_EXTENSIONS)
+    ]
 
-        logger.info(f"Векторная база успешно обновлена: {vector_dir}")
+    # -- только новые и изменённые фото (копии обработанных попадут в базу без анализа)
+    paths, copies = manifest.filter_new(paths)
 
-        # --- 3. Сохраняем фотографии пользователей ---
-        if os.path.exists(cluster_metadata_dir):
-            with open(cluster_metadata_dir, "r", encoding="utf-8") as f:
-                cluster_metadata = json.load(f)
+    # -- детекция, выравнивание и эмбеддинги
+    results = collect_faces(paths, workers=workers)
 
-            save_user_photos(cluster_metadata, input_dir, users_dir)
-    else:
+    # -- база, папки и превью пользователей, манифест
+    try:
+        return commit_batch(results, store, manifest, rebuild=rebuild, user_folders=user_folders, copies=copies,
+                            input_dir=input_dir, users_dir=users_dir, vector_dir=vector_dir,
+                            derivatives_dir=derivatives_dir)
+    finally:
+        manifest.close()
 
-        logger.info("Новых лиц для добавления не найдено.")
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Обработка новых фото и обновление векторной базы")
+    parser.add_argument("--workers", type=int, default=1, help="число процессов для параллельной обработки фото")
+    parser.add_argument("--rebuild", action="store_true",
+                        help="игнорировать манифест и пересобрать базу по всем фото заново")
+    parser.add_argument("--recluster", action="store_true",
+                        help="перекластеризовать сохранённые эмбеддинги лиц без обработки фото")
+    parser.add_argument("--refine", choices=["chinese_whispers"],
+                        help="уточнение кластеров при --recluster")
+    parser.add_argument("--user-folders", choices=LINK_MODES, default="hardlink",
+                        help="как собирать папки data/photos/users (бот берёт альбомы из метаданных и без них)")
+    parser.add_argument("--event", help="мероприятие: фото и база в data/events/<мероприятие> (см. events.py)")
+    parser.add_argument("--metrics", default=os.getenv(metrics.METRICS_ENV, "off"),
+                        help="экспорт метрик: off, file:<путь> (формат Prometheus) или http:<порт>")
+    args = parser.parse_args()
+
+    metrics.configure(args.metrics)
+    metrics.install_toggle_signal()
+
+    paths = shard_paths(args.event)
+    run_worker(workers=args.workers, rebuild=args.rebuild, recluster=args.recluster, refine=args.refine,
+               user_folders=args.user_folders, input_dir=paths["raw_dir"], users_dir=paths["users_dir"],
+               vector_dir=paths["vector_dir"], derivatives_dir=paths["derivatives_dir"])
+    metrics.close()
@@ -1,10 +1,18 @@
 import os
 import io
 import re
+import time
+import sqlite3
+import hashlib
+import argparse
+import itertools
+import threading
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
 from dotenv import load_dotenv
 from googleapiclient.discovery import build
 from googleapiclient.http import MediaIoBaseDownload
 from google.oauth2 import service_account
+from google.auth.credentials import AnonymousCredentials
 import logging
 
 logging.basicConfig(level=logging.INFO)
@@ -13,14 +21,37 @@ logger = logging.getLogger(__name__)
 load_dotenv()
 
 SERVICE_ACCOUNT_FILE = os.getenv("SERVICE_ACCOUNT_FILE")  # путь к файлу service account
+DRIVE_API_URL = os.getenv("DRIVE_API_URL")  # другой адрес Drive API (например, локальная заглушка из bench/)
 SCOPES = ['https://www.googleapis.com/auth/drive.readonly']
 ALLOWED_EXTENSIONS = {'.jpg', '.jpeg', '.png', '.gif', '.bmp', '.webp'}
+FOLDER_MIME_TYPE = 'application/vnd.google-apps.folder'
 
-# Авторизация
-credentials = service_account.Credentials.from_service_account_file(
-    SERVICE_ACCOUNT_FILE, scopes=SCOPES
-)
-drive_service = build('drive', 'v3', credentials=credentials)
+DOWNLOAD_DIR = "data/photos/raw_uploads"
+SYNC_MANIFEST_PATH = "data/photos/drive_manifest.sqlite"   # Drive file id → локальный файл, md5, modifiedTime
+EVENTS_DIR = "data/events"   # фото мероприятия: data/events/<мероприятие>/photos (как в ml_worker/events.py)
+LIST_THREADS = 8         # параллельных запросов списка папок
+DOWNLOAD_THREADS = 8     # параллельных скачиваний
+DOWNLOAD_WINDOW = 2      # задач в работе на один поток скачивания
+DOWNLOAD_CHUNK = 8 * 2 ** 20
+DOWNLOAD_RETRIES = 3     # повторов запроса при 5xx и сетевых ошибках
+
+# httplib2 не потокобезопасен, поэтому у каждого потока свой клиент Drive
+_local = threading.local()
+
+def _credentials():
+    if SERVICE_ACCOUNT_FILE:
+        return service_account.Credentials.from_service_account_file(SERVICE_ACCOUNT_FILE, scopes=SCOPES)
+    if DRIVE_API_URL:
+        return AnonymousCredentials()    # заглушке авторизация не нужна
+    raise RuntimeError("Не задан SERVICE_ACCOUNT_FILE")
+
+def drive_service():
+    """Клиент Drive API текущего потока (создаётся при первом обращении)."""
+    if getattr(_local, "service", None) is None:
+        client_options = {"api_endpoint": DRIVE_API_URL} if DRIVE_API_URL else None
+        _local.service = build('drive', 'v3', credentials=_credentials(), client_options=client_options,
+                               cache_discovery=False)
+    return _local.service
 
 def extract_folder_id_from_url(url: str) -> str:
     """
@@ -35,65 +66,235 @@ def extract_folder_id_from_url(url: str) -> str:
     else:
         raise ValueError("Не удалось извлечь folder_id из ссылки")
 
+def file_md5(path):
+    h = hashlib.md5()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+class DriveManifest:
+    """
+    Манифест синхронизации в SQLite: Drive file id → имя локального файла, md5Checksum и modifiedTime.
+    Файл скачивается заново, только если на Drive изменились md5 или modifiedTime
+    либо локальная копия пропала. Записи пишет только основной поток.
+    """
+    def __init__(self, db_path=SYNC_MANIFEST_PATH):
+        os.makedirs(os.path.dirname(db_path) or ".", exist_ok=True)
+        self.conn = sqlite3.connect(db_path)
+        self.conn.execute("""
+            CREATE TABLE IF NOT EXISTS drive_files (
+                file_id TEXT PRIMARY KEY,
+                name TEXT NOT NULL,
+                local_name TEXT NOT NULL UNIQUE,
+                md5 TEXT,
+                modified_time TEXT,
+                size INTEGER,
+                synced_at REAL NOT NULL
+            )
+        """)
+        self.conn.commit()
+
+    def close(self):
+        self.conn.close()
+
+    def entries(self):
+        """{file_id: (local_name, md5, modified_time)}."""
+        rows = self.conn.execute("SELECT file_id, local_name, md5, modified_time FROM drive_files")
+        return {file_id: (local_name, md5, modified) for file_id, local_name, md5, modified in rows}
+
+    def record(self, item, local_name):
+        with self.conn:
+            self.conn.execute(
+                "INSERT OR REPLACE INTO drive_files VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (item['id'], item['name'], local_name, item.get('md5Checksum'), item.get('modifiedTime'),
+                 int(item['size']) if item.get('size') else None, time.time())
+            )
+
+
 def list_files_in_folder(folder_id):
     """Возвращает список всех файлов и папок в папке."""
     query = f"'{folder_id}' in parents and trashed=false"
     results = []
     page_token = None
     while True:
-        response = drive_service.files().list(
+        response = drive_service().files().list(
             q=query,
             spaces='drive',
-            fields='nextPageToken, files(id, name, mimeType)',
+            fields='nextPageToken, files(id, name, mimeType, md5Checksum, modifiedTime, size)',
+            pageSize=1000,
             pageToken=page_token
-        ).execute()
+        ).execute(num_retries=DOWNLOAD_RETRIES)
         results.extend(response.get('files', []))
         page_token = response.get('nextPageToken', None)
         if page_token is None:
             break
     return results
 
-def download_file(file_id, file_path):
-    """Скачивает один файл по ID."""
-    if os.path.exists(file_path):
-        logger.info(f"{file_path} уже скачан, пропускаем.")
-        return
-
-    request = drive_service.files().get_media(fileId=file_id)
-    fh = io.FileIO(file_path, 'wb')
-    downloader = MediaIoBaseDownload(fh, request)
-    done = False
-    while not done:
-        status, done = downloader.next_chunk()
-        if status:
-            logger.info(f"{os.path.basename(file_path)}: {int(status.progress() * 100)}% скачано")
-    logger.info(f"{os.path.basename(file_path)} скачан успешно!")
-
-def download_images_recursively(folder_id, local_path):
-    """Рекурсивно скачивает все изображения из папки и подпапок."""
-    os.makedirs(local_path, exist_ok=True)
-    items = list_files_in_folder(folder_id)
+def list_images_recursively(folder_id, threads=LIST_THREADS):
+    """
+    Обходит папку и все подпапки, запрашивая списки нескольких папок параллельно.
+    Возвращает изображения (словари Drive API) в стабильном порядке.
+    """
+    images, seen = [], {folder_id}
+    with ThreadPoolExecutor(max_workers=threads, thread_name_prefix="drive-list") as executor:
+        pending = {executor.submit(list_files_in_folder, folder_id)}
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                for item in future.result():
+                    if item['mimeType'] == FOLDER_MIME_TYPE:
+                        if item['id'] not in seen:       # папка может быть добавлена в несколько родителей
+                            seen.add(item['id'])
+                            pending.add(executor.submit(list_files_in_folder, item['id']))
+                    elif os.path.splitext(item['name'])[1].lower() in ALLOWED_EXTENSIONS:
+                        images.append(item)
+                    else:
+                        logger.info(f"{item['name']} пропущен (не изображение)")
+    logger.info(f"📂 Просмотрено папок: {len(seen)}, изображений: {len(images)}")
+    return sorted({item['id']: item for item in images}.values(), key=lambda item: (item['name'], item['id']))
 
+def download_file(file_id, file_path, md5=None):
+    """
+    Скачивает один файл по ID во временный файл рядом с file_path и атомарно переименовывает его.
+    Недокачанный файл никогда не оказывается под именем фото; при несовпадении md5 — ошибка.
+    """
+    tmp_path = f"{file_path}.{threading.get_ident()}.part"
+    try:
+        request = drive_service().files().get_media(fileId=file_id)
+        with io.FileIO(tmp_path, 'wb') as fh:
+            downloader = MediaIoBaseDownload(fh, request, chunksize=DOWNLOAD_CHUNK)
+            done = False
+            while not done:
+                _, done = downloader.next_chunk(num_retries=DOWNLOAD_RETRIES)
+        if md5 and file_md5(tmp_path) != md5:
+            raise IOError(f"md5 не совпадает с Drive: {os.path.basename(file_path)}")
+        os.replace(tmp_path, file_path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+def _local_name(item, taken):
+    """
+    Имя локального файла: исходное имя, а при совпадении с файлом из другой подпапки —
+    с суффиксом из Drive file id (все фото лежат в одной папке и не должны перезаписывать друг друга).
+    """
+    name = item['name'].replace('/', '_').replace(os.sep, '_')
+    if name not in taken:
+        return name
+    stem, ext = os.path.splitext(name)
+    for suffix in (item['id'][:8], item['id']):
+        candidate = f"{stem}_{suffix}{ext}"
+        if candidate not in taken:
+            return candidate
+    raise ValueError(f"Не удалось подобрать имя для {item['name']} ({item['id']})")
+
+def plan_sync(items, entries, local_path):
+    """
+    Решает, что скачивать. Возвращает (to_download: [(item, local_name)], adopted: [(item, local_name)]).
+    Неизменившиеся файлы пропускаются; файлы, скачанные до появления манифеста, принимаются без
+    скачивания, если их md5 совпадает с Drive.
+    """
+    taken = {local_name for local_name, _, _ in entries.values()}
+    to_download, adopted = [], []
     for item in items:
-        item_name = item['name']
-        item_id = item['id']
-        mime_type = item['mimeType']
+        entry = entries.get(item['id'])
+        if entry is not None:
+            local_name, md5, modified = entry
+            if (md5, modified) == (item.get('md5Checksum'), item.get('modifiedTime')) \
+                    and os.path.exists(os.path.join(local_path, local_name)):
+                continue
+            to_download.append((item, local_name))
+            continue
 
-        if mime_type == 'application/vnd.google-apps.folder':
-            # Рекурсивно спускаемся, но все файлы сохраняем в один local_path
-            download_images_recursively(item_id, local_path)
+        local_name = _local_name(item, taken)
+        taken.add(local_name)
+        legacy_path = os.path.join(local_path, local_name)
+        if item.get('md5Checksum') and os.path.exists(legacy_path) and file_md5(legacy_path) == item['md5Checksum']:
+            adopted.append((item, local_name))
         else:
-            ext = os.path.splitext(item_name)[1].lower()
-            if ext in ALLOWED_EXTENSIONS:
-                download_file(item_id, os.path.join(local_path, item_name))
-            else:
-                logger.info(f"{item_name} пропущен (не изображение)")
+            if os.path.exists(legacy_path):
+                # -- файл с таким именем есть, но это другое фото: берём свободное имя
+                local_name = _local_name(item, taken | {local_name})
+                taken.add(local_name)
+            to_download.append((item, local_name))
+    return to_download, adopted
+
+def sync_folder(folder_id, local_path=DOWNLOAD_DIR, manifest_path=SYNC_MANIFEST_PATH,
+                list_threads=LIST_THREADS, download_threads=DOWNLOAD_THREADS, on_file=None):
+    """
+    Инкрементальная синхронизация папки Google Drive (с подпапками) в local_path.
+    Прерванный запуск можно просто повторить: в манифест попадают только полностью скачанные файлы.
+    Удалённые на Drive файлы локально не удаляются. Возвращает статистику запуска.
+    on_file(path) вызывается для каждого скачанного файла сразу после загрузки
+    (потоковая обработка, ml_worker/pipeline.py) в порядке завершения загрузок;
+    может блокироваться, если обработка отстаёт — тогда приостанавливаются и новые скачивания.
+    """
+    os.makedirs(local_path, exist_ok=True)
+    manifest = DriveManifest(manifest_path)
+    stats = {"listed": 0, "downloaded": 0, "skipped": 0, "adopted": 0, "failed": 0, "bytes": 0}
+    started = time.perf_counter()
+    try:
+        items = list_images_recursively(folder_id, list_threads)
+        to_download, adopted = plan_sync(items, manifest.entries(), local_path)
+        for item, local_name in adopted:
+            manifest.record(item, local_name)
+        stats.update(listed=len(items), adopted=len(adopted), skipped=len(items) - len(to_download) - len(adopted))
+        logger.info(f"Манифест Drive: к скачиванию {len(to_download)} из {len(items)} изображений")
+
+        def fetch(task):
+            item, local_name = task
+            try:
+                download_file(item['id'], os.path.join(local_path, local_name), item.get('md5Checksum'))
+            except Exception as e:
+                return item, local_name, e
+            return item, local_name, None
+
+        with ThreadPoolExecutor(max_workers=download_threads, thread_name_prefix="drive-download") as executor:
+            # в работе не больше DOWNLOAD_WINDOW задач на поток: on_file вызывается по мере готовности файлов,
+            # а медленный on_file притормаживает постановку новых скачиваний
+            queue = iter(to_download)
+            window = download_threads * DOWNLOAD_WINDOW
+            pending = {executor.submit(fetch, task) for task in itertools.islice(queue, window)}
+            while pending:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                pending.update(executor.submit(fetch, task) for task in itertools.islice(queue, len(done)))
+                for future in done:
+                    item, local_name, error = future.result()
+                    if error is not None:
+                        stats["failed"] += 1
+                        logger.error(f"Ошибка при скачивании {item['name']} ({item['id']}): {error}")
+                        continue
+                    manifest.record(item, local_name)
+                    if on_file is not None:
+                        on_file(os.path.join(local_path, local_name))
+                    stats["downloaded"] += 1
+                    stats["bytes"] += int(item.get('size') or 0)
+                    logger.info(f"{local_name} скачан успешно! ({stats['downloaded']}/{len(to_download)})")
+    finally:
+        manifest.close()
+
+    stats["total_s"] = round(time.perf_counter() - started, 3)
+    logger.info(f"✅ Синхронизация: скачано {stats['downloaded']}, без изменений {stats['skipped']}, "
+                f"принято из папки {stats['adopted']}, ошибок {stats['failed']}")
+    return stats
 
 if __name__ == "__main__":
-    download_dir = "data/photos/raw_uploads"
-    os.makedirs(download_dir, exist_ok=True)
+    parser = argparse.ArgumentParser(description="Синхронизация фото из папки Google Drive")
+    parser.add_argument("url", nargs="?", help="ссылка на папку Google Drive (если не указана — будет запрошена)")
+    parser.add_argument("--threads", type=int, default=DOWNLOAD_THREADS, help="параллельных скачиваний")
+    parser.add_argument("--event", help="мероприятие: фото скачиваются в data/events/<мероприятие>/photos/raw_uploads")
+    args = parser.parse_args()
+
+    download_dir, manifest_path = DOWNLOAD_DIR, SYNC_MANIFEST_PATH
+    if args.event:
+        if not re.fullmatch(r"[A-Za-z0-9_-]{1,64}", args.event):
+            parser.error("имя мероприятия — до 64 символов A-Z, a-z, 0-9, _ и -")
+        photos_dir = os.path.join(EVENTS_DIR, args.event, "photos")
+        download_dir, manifest_path = os.path.join(photos_dir, "raw_uploads"), os.path.join(photos_dir, "drive_manifest.sqlite")
 
-    admin_url = input("Вставьте ссылку на папку Google Drive: ")
+    admin_url = args.url or input("Вставьте ссылку на папку Google Drive: ")
     folder_id = extract_folder_id_from_url(admin_url)
-    download_images_recursively(folder_id, download_dir)
+    sync_folder(folder_id, download_dir, manifest_path, download_threads=args.threads)
     logger.info("Загрузка завершена.")